@@ -0,0 +1,81 @@
+"""Bounded activity log of the client.
+
+Messages go into a ring buffer of the last LOG_CAPACITY entries and into a
+queue of entries the display has not picked up yet, which it takes in
+batches. The buffer lets the display be rebuilt, e.g. when the level shown
+changes, without the display ever holding more than the buffer does.
+Optionally every message is also written to a log file rotated at
+LOG_FILE_SIZE, so nothing is lost over long sessions.
+"""
+import collections
+import logging
+import logging.handlers
+import os
+import time
+
+# Entries kept in memory and shown at most
+LOG_CAPACITY = 5000
+LOG_FILE_SIZE = 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+# Message types by severity; showing a level shows the more severe ones too
+LEVELS = {'info': 0, 'server': 0, 'success': 1, 'error': 2}
+FILE_LEVELS = {'info': logging.INFO, 'server': logging.INFO, 'success': logging.INFO, 'error': logging.ERROR}
+
+
+class LogEntry(collections.namedtuple('LogEntry', ['time', 'level', 'message'])):
+    def format(self):
+        return f"[{time.strftime('%H:%M:%S', time.localtime(self.time))}] {self.message}\n"
+
+
+class ActivityLog:
+    def __init__(self, capacity=LOG_CAPACITY):
+        self.entries = collections.deque(maxlen=capacity)
+        # Entries added since the display last took them; bounded too, in case it never does
+        self.pending = collections.deque(maxlen=capacity)
+        self.level = 'info'
+        self.logger = None
+
+    def add(self, message, level='info'):
+        entry = LogEntry(time.time(), level if level in LEVELS else 'info', message)
+        self.entries.append(entry)
+        self.pending.append(entry)
+        if self.logger is not None:
+            self.logger.log(FILE_LEVELS[entry.level], message)
+
+    def shown(self, entry):
+        return LEVELS[entry.level] >= LEVELS[self.level]
+
+    def take_pending(self):
+        """Entries added since the last call, at the level shown"""
+        entries = []
+        while self.pending:
+            entry = self.pending.popleft()
+            if self.shown(entry):
+                entries.append(entry)
+        return entries
+
+    def set_level(self, level):
+        """Show entries of this level and more severe, return all such entries in the buffer"""
+        self.level = level
+        self.pending.clear()
+        return [entry for entry in self.entries if self.shown(entry)]
+
+    def spill_to(self, path):
+        """Also write every message to a rotating log file, or stop doing so if path is None"""
+        if self.logger is not None:
+            for handler in self.logger.handlers[:]:
+                self.logger.removeHandler(handler)
+                handler.close()
+            self.logger = None
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_FILE_SIZE, backupCount=LOG_FILE_BACKUPS,
+                                                       encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        # A logger of its own, so the file gets only the activity log and no other logging does
+        self.logger = logging.getLogger(f"{__name__}.{id(self)}")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(handler)
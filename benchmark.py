@@ -0,0 +1,641 @@
+"""Transfer benchmarks for the file transfer server.
+
+Each benchmark runs the server in a child process over loopback and reports
+throughput together with the server's peak resident memory.
+
+    python benchmark.py upload --sizes 10M,1G,8G
+    python benchmark.py upload --sizes 1G --checksum both
+    python benchmark.py download --sizes 10M,1G --engine legacy
+    python benchmark.py load --clients 200 --engines threaded,async
+    python benchmark.py listing --entries 1K,100K,1M
+    python benchmark.py listing --entries 1M --page 500 --sort size
+    python benchmark.py batch --count 10000 --sizes 1K,16K,64K
+    python benchmark.py delta --sizes 1G --edits 1,10,100
+    python benchmark.py control --size 1G --transfers 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+import server as server_module
+from delta import DeltaEncoder, send_delta, signature_table
+from file_index import RACY_MTIME_NS
+from protocol import (Connection, FRAME_DATA, HEADER, CHECKSUM_ALGORITHM, decode_header, encode_command,
+                      encode_header, new_checksum, verify_trailer)
+
+CHUNK_SIZE = 1024 * 1024
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+class LegacyServer(server_module.Server):
+    """Server using the original in-memory upload and download paths"""
+
+    def receive_file(self, conn, filename, file_size, *args):
+        frame = conn.read_frame()
+        received_data = conn.read_exact(frame.length)
+        with open(os.path.join(self.shared_space, filename), 'wb') as f:
+            f.write(received_data)
+
+    def list_files(self, request=None):
+        file_list = []
+        with os.scandir(self.shared_space) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    file_list.append({
+                        'name': entry.name,
+                        'size': entry.stat().st_size,
+                        'modified': entry.stat().st_mtime
+                    })
+        return {'type': 'file_list', 'files': file_list}
+
+    def send_file(self, request, conn):
+        file_info = self.file_list[int(request['index'])]
+        with open(os.path.join(self.shared_space, file_info['name']), 'rb') as f:
+            file_data = f.read()
+        conn.send_message({'type': 'file_transfer', 'name': file_info['name'], 'size': len(file_data)})
+        conn.send_frame(FRAME_DATA, file_data)
+
+
+ENGINES = {
+    'threaded': server_module.Server,
+    'async': server_module.AsyncServer,
+    'legacy': LegacyServer,
+}
+
+
+def parse_size(text):
+    """Parse a size such as 10M or 1G into bytes"""
+    text = text.strip().upper()
+    if text and text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def parse_count(text):
+    """Parse a count such as 100K or 1M"""
+    text = text.strip().upper()
+    if text and text[-1] in ('K', 'M'):
+        return int(float(text[:-1]) * (1000 if text[-1] == 'K' else 1000 ** 2))
+    return int(text)
+
+
+def format_size(size_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size_bytes < 1024 or unit == 'GB':
+            return f"{size_bytes:.1f} {unit}"
+        size_bytes /= 1024.0
+
+
+def peak_rss_bytes():
+    """Peak resident set size of the current process"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _serve(engine, shared_space, port, pipe):
+    """Child process: run a server until told to stop, then report peak RSS"""
+    sys.stdout = open(os.devnull, 'w')
+    srv = ENGINES[engine](host='127.0.0.1', port=port)
+    srv.set_shared_space(shared_space)
+    srv.start_server()
+    pipe.send('ready')
+    pipe.recv()
+    srv.stop_server()
+    pipe.send(peak_rss_bytes())
+
+
+class ServerProcess:
+    """Context manager running a benchmark server in a child process"""
+
+    def __init__(self, engine, shared_space):
+        self.engine = engine
+        self.shared_space = shared_space
+        self.port = free_port()
+        self.peak_rss = None
+
+    def __enter__(self):
+        self.pipe, child_pipe = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_serve, args=(self.engine, self.shared_space, self.port, child_pipe))
+        self.process.start()
+        self.pipe.recv()
+        return self
+
+    def __exit__(self, *exc):
+        self.pipe.send('stop')
+        self.peak_rss = self.pipe.recv()
+        self.process.join()
+
+
+def send_pattern(sock, size, checksum=None):
+    """Send size bytes from a reused buffer without materialising the payload"""
+    payload = memoryview(os.urandom(CHUNK_SIZE))
+    remaining = size
+    while remaining > 0:
+        n = min(CHUNK_SIZE, remaining)
+        if checksum is not None:
+            checksum.update(payload[:n])
+        sock.sendall(payload[:n])
+        remaining -= n
+
+
+def write_pattern(path, size):
+    """Create a file of random content without holding it in memory"""
+    payload = memoryview(os.urandom(CHUNK_SIZE))
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            n = min(CHUNK_SIZE, remaining)
+            f.write(payload[:n])
+            remaining -= n
+
+
+def recv_exact_count(conn, size, checksum=None):
+    """Receive and discard size bytes of a DATA frame, return the number received"""
+    buffer = memoryview(bytearray(CHUNK_SIZE))
+    received = 0
+    while received < size:
+        n = conn.recv_into(buffer, min(CHUNK_SIZE, size - received))
+        if not n:
+            break
+        if checksum is not None:
+            checksum.update(buffer[:n])
+        received += n
+    return received
+
+
+def checksum_modes(args):
+    """Whether to run without and/or with checksum trailers"""
+    return {'off': [False], 'on': [True], 'both': [False, True]}[args.checksum]
+
+
+def wait_for_file(path, size, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def bench_upload(args):
+    print(f"{'engine':<10} {'size':>10} {'checksum':>9} {'MB/s':>10} {'peak RSS':>12}")
+    for size_text in args.sizes.split(','):
+        size = parse_size(size_text)
+        for checksums in checksum_modes(args):
+            shared_space = tempfile.mkdtemp(prefix='bench-upload-', dir=args.dir)
+            try:
+                with ServerProcess(args.engine, shared_space) as srv:
+                    filename = 'upload.bin'
+                    checksum = new_checksum() if checksums else None
+                    with socket.create_connection(('127.0.0.1', srv.port)) as sock:
+                        conn = Connection(sock)
+                        start = time.perf_counter()
+                        if checksums:
+                            conn.send_command("UPLOAD", name=filename, size=size, checksum=CHECKSUM_ALGORITHM)
+                        else:
+                            conn.send_command("UPLOAD", name=filename, size=size)
+                        sock.sendall(encode_header(FRAME_DATA, size))
+                        send_pattern(sock, size, checksum)
+                        if checksum is not None:
+                            conn.send_trailer(checksum)
+                        complete = wait_for_file(os.path.join(shared_space, filename), size, args.timeout)
+                        elapsed = time.perf_counter() - start
+                rate = size / elapsed / 1024 ** 2 if complete else 0.0
+                status = '' if complete else '  (incomplete)'
+                print(f"{args.engine:<10} {format_size(size):>10} {'yes' if checksums else 'no':>9} {rate:>10.1f} "
+                      f"{format_size(srv.peak_rss):>12}{status}")
+            finally:
+                shutil.rmtree(shared_space, ignore_errors=True)
+
+
+def bench_download(args):
+    print(f"{'engine':<10} {'size':>10} {'checksum':>9} {'MB/s':>10} {'peak RSS':>12}")
+    for size_text in args.sizes.split(','):
+        size = parse_size(size_text)
+        for checksums in checksum_modes(args):
+            shared_space = tempfile.mkdtemp(prefix='bench-download-', dir=args.dir)
+            try:
+                write_pattern(os.path.join(shared_space, 'download.bin'), size)
+                with ServerProcess(args.engine, shared_space) as srv:
+                    with socket.create_connection(('127.0.0.1', srv.port)) as sock:
+                        sock.settimeout(args.timeout)
+                        conn = Connection(sock)
+                        checksum = new_checksum() if checksums else None
+                        start = time.perf_counter()
+                        if checksums:
+                            conn.send_command("GET_FILE", index=0, checksum=CHECKSUM_ALGORITHM)
+                        else:
+                            conn.send_command("GET_FILE", index=0)
+                        conn.read_frame()
+                        frame = conn.read_frame()
+                        received = recv_exact_count(conn, frame.length, checksum)
+                        if checksum is not None:
+                            verify_trailer(conn.read_frame(), checksum)
+                        elapsed = time.perf_counter() - start
+                rate = received / elapsed / 1024 ** 2
+                status = '' if received == size else f"  (incomplete: {received} bytes)"
+                print(f"{args.engine:<10} {format_size(size):>10} {'yes' if checksums else 'no':>9} {rate:>10.1f} "
+                      f"{format_size(srv.peak_rss):>12}{status}")
+            finally:
+                shutil.rmtree(shared_space, ignore_errors=True)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def _load_client(port, commands, connected, latencies):
+    """One simulated client: connect, then issue commands back to back"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    connected.append(time.perf_counter())
+    for i in range(commands):
+        request = encode_command("LIST_FILES") if i % 2 == 0 else encode_command("FILE_INFO", index=0)
+        start = time.perf_counter()
+        writer.write(request)
+        await writer.drain()
+        frame_type, flags, length = decode_header(await reader.readexactly(HEADER.size))
+        await reader.readexactly(length)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def _run_load(port, clients, commands):
+    connected, latencies = [], []
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(_load_client(port, commands, connected, latencies) for _ in range(clients)),
+        return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    failures = sum(1 for r in results if isinstance(r, Exception))
+    connect_span = (max(connected) - start) if connected else elapsed
+    return len(connected) / connect_span, latencies, failures, elapsed
+
+
+def bench_load(args):
+    print(f"{'engine':<10} {'clients':>8} {'conn/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'cmd/s':>10} {'failed':>7} {'peak RSS':>10}")
+    shared_space = tempfile.mkdtemp(prefix='bench-load-', dir=args.dir)
+    try:
+        for i in range(args.files):
+            write_pattern(os.path.join(shared_space, f"file{i:05d}.bin"), 1024)
+        for engine in args.engines.split(','):
+            with ServerProcess(engine, shared_space) as srv:
+                rate, latencies, failures, elapsed = asyncio.run(
+                    _run_load(srv.port, args.clients, args.commands))
+            p50 = percentile(latencies, 0.50) * 1000 if latencies else 0.0
+            p99 = percentile(latencies, 0.99) * 1000 if latencies else 0.0
+            print(f"{engine:<10} {args.clients:>8} {rate:>10.0f} {p50:>8.2f} {p99:>8.2f} "
+                  f"{len(latencies) / elapsed:>10.0f} {failures:>7} {format_size(srv.peak_rss):>10}")
+    finally:
+        shutil.rmtree(shared_space, ignore_errors=True)
+
+
+def create_entries(directory, count):
+    """Create count empty files"""
+    for i in range(count):
+        open(os.path.join(directory, f"file{i:07d}.dat"), 'wb').close()
+
+
+def timed_listing(sock, **query):
+    """Issue LIST_FILES and read the raw response, return (seconds, bytes)"""
+    start = time.perf_counter()
+    sock.sendall(encode_command("LIST_FILES", **query))
+    header = recv_exact(sock, HEADER.size)
+    frame_type, flags, length = decode_header(header)
+    recv_exact(sock, length)
+    return time.perf_counter() - start, length
+
+
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if not n:
+            raise ConnectionError("connection closed")
+        received += n
+    return buffer
+
+
+def bench_listing(args):
+    print(f"{'engine':<10} {'entries':>9} {'response':>10} {'first ms':>9} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'peak RSS':>10}")
+    for count_text in args.entries.split(','):
+        count = parse_count(count_text)
+        shared_space = tempfile.mkdtemp(prefix='bench-listing-', dir=args.dir)
+        try:
+            create_entries(shared_space, count)
+            # A page from the middle of the listing, or the first page
+            query = {}
+            if args.page:
+                query = {'offset': count // 2, 'limit': args.page, 'sort': args.sort}
+            for engine in args.engines.split(','):
+                with ServerProcess(engine, shared_space) as srv:
+                    with socket.create_connection(('127.0.0.1', srv.port)) as sock:
+                        first, size = timed_listing(sock, **query)
+                        latencies = [timed_listing(sock, **query)[0] for _ in range(args.repeat)]
+                print(f"{engine:<10} {count:>9} {format_size(size):>10} {first * 1000:>9.1f} "
+                      f"{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.99) * 1000:>8.1f} "
+                      f"{format_size(srv.peak_rss):>10}")
+        finally:
+            shutil.rmtree(shared_space, ignore_errors=True)
+
+
+def fetch_one_by_one(conn, names):
+    """GET_FILE every file in turn, return the number received"""
+    for name in names:
+        conn.send_command("GET_FILE", name=name)
+        conn.read_frame()
+        conn.discard(conn.read_frame().length)
+    return len(names)
+
+
+def fetch_batch(conn, names):
+    """GET_BATCH all files at once, return the number received"""
+    conn.send_command("GET_BATCH", names=names)
+    while True:
+        message = conn.read_frame().payload
+        if message.get('type') == 'batch_complete':
+            return message['count']
+        conn.discard(conn.read_frame().length)
+
+
+def bench_batch(args):
+    print(f"{'engine':<10} {'mode':<8} {'size':>6} {'files':>7} {'files/s':>9} {'MB/s':>8}")
+    for size_text in args.sizes.split(','):
+        size = parse_size(size_text)
+        shared_space = tempfile.mkdtemp(prefix='bench-batch-', dir=args.dir)
+        try:
+            names = [f"file{i:07d}.dat" for i in range(args.count)]
+            content = b'x' * size
+            for name in names:
+                with open(os.path.join(shared_space, name), 'wb') as f:
+                    f.write(content)
+            for engine in args.engines.split(','):
+                with ServerProcess(engine, shared_space) as srv:
+                    for mode, fetch in (('single', fetch_one_by_one), ('batch', fetch_batch)):
+                        with socket.create_connection(('127.0.0.1', srv.port)) as sock:
+                            sock.settimeout(args.timeout)
+                            start = time.perf_counter()
+                            received = fetch(Connection(sock), names)
+                            elapsed = time.perf_counter() - start
+                        print(f"{engine:<10} {mode:<8} {format_size(size):>6} {received:>7} "
+                              f"{received / elapsed:>9.0f} {received * size / elapsed / 1024 ** 2:>8.1f}")
+        finally:
+            shutil.rmtree(shared_space, ignore_errors=True)
+
+
+def write_random(path, size):
+    """Create a file of random content in which no block repeats"""
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            n = min(CHUNK_SIZE, remaining)
+            f.write(os.urandom(n))
+            remaining -= n
+
+
+def edit_copy(source, path, edits, edit_size, seed=0):
+    """Copy source to path and overwrite edits runs of edit_size random bytes in the copy"""
+    shutil.copyfile(source, path)
+    size = os.path.getsize(path)
+    rng = random.Random(seed)
+    with open(path, 'r+b') as f:
+        for _ in range(edits):
+            f.seek(rng.randrange(max(1, size - edit_size)))
+            f.write(os.urandom(edit_size))
+
+
+def full_upload(conn, name, path):
+    """Upload a whole file, return (bytes sent, bytes received)"""
+    size = os.path.getsize(path)
+    conn.send_command("UPLOAD", name=name, size=size)
+    conn.read_frame()
+    with open(path, 'rb') as f:
+        sent = conn.send_file_data(f, 0, size)
+    conn.read_frame()
+    return sent, 0
+
+
+def delta_upload(conn, name, path):
+    """Upload a file as a delta against the server's copy, return (bytes sent, bytes received)"""
+    conn.send_command("SIGNATURES", name=name)
+    signatures = conn.read_frame().payload
+    frame = conn.read_frame()
+    table = signature_table(conn.read_exact(frame.length))
+    conn.send_command("DELTA", name=name, size=os.path.getsize(path), version=signatures['version'])
+    conn.read_frame()
+    with open(path, 'rb') as f:
+        _, sent = send_delta(conn, DeltaEncoder(f, signatures['block_size'], table))
+    reply = conn.read_frame().payload
+    if not isinstance(reply, dict):
+        raise RuntimeError(reply)
+    return sent, frame.length
+
+
+def bench_delta(args):
+    print(f"{'engine':<10} {'size':>10} {'edits':>6} {'mode':<6} {'sent':>10} {'received':>10} {'seconds':>8}")
+    for size_text in args.sizes.split(','):
+        size = parse_size(size_text)
+        shared_space = tempfile.mkdtemp(prefix='bench-delta-', dir=args.dir)
+        local_space = tempfile.mkdtemp(prefix='bench-delta-local-', dir=args.dir)
+        try:
+            original = os.path.join(local_space, 'original.bin')
+            write_random(original, size)
+            for edits in (int(n) for n in args.edits.split(',')):
+                modified = os.path.join(local_space, 'modified.bin')
+                edit_copy(original, modified, edits, args.edit_size)
+                shutil.copyfile(original, os.path.join(shared_space, 'image.bin'))
+                with ServerProcess(args.engine, shared_space) as srv:
+                    with socket.create_connection(('127.0.0.1', srv.port)) as sock:
+                        sock.settimeout(args.timeout)
+                        conn = Connection(sock)
+                        for mode, upload, name in (('full', full_upload, 'full.bin'),
+                                                   ('delta', delta_upload, 'image.bin')):
+                            start = time.perf_counter()
+                            sent, received = upload(conn, name, modified)
+                            elapsed = time.perf_counter() - start
+                            print(f"{args.engine:<10} {format_size(size):>10} {edits:>6} {mode:<6} "
+                                  f"{format_size(sent):>10} {format_size(received):>10} {elapsed:>8.2f}")
+        finally:
+            shutil.rmtree(shared_space, ignore_errors=True)
+            shutil.rmtree(local_space, ignore_errors=True)
+
+
+def control_round_trip(conn, i):
+    """Time one command on a control connection, alternating listing and file info"""
+    start = time.perf_counter()
+    if i % 2 == 0:
+        conn.send_command("LIST_FILES", limit=100)
+    else:
+        conn.send_command("FILE_INFO", index=1)
+    conn.read_frame()
+    return time.perf_counter() - start
+
+
+def _download_repeatedly(port, token, timeout, stop, received):
+    """Child process: attach a data connection with token, download the first file until stop is set"""
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.settimeout(timeout)
+        conn = Connection(sock)
+        conn.send_command("ATTACH", token=token)
+        reply = conn.read_frame().payload
+        if not isinstance(reply, dict):
+            raise RuntimeError(reply)
+        while not stop.is_set():
+            conn.send_command("GET_FILE", index=0)
+            conn.read_frame()
+            frame = conn.read_frame()
+            count = recv_exact_count(conn, frame.length)
+            with received.get_lock():
+                received.value += count
+
+
+def bench_control(args):
+    print(f"{'engine':<10} {'transfers':<18} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>9} {'MB/s':>8}")
+    shared_space = tempfile.mkdtemp(prefix='bench-control-', dir=args.dir)
+    try:
+        write_pattern(os.path.join(shared_space, 'big.bin'), parse_size(args.size))
+        for i in range(args.files):
+            write_pattern(os.path.join(shared_space, f"file{i:05d}.bin"), 1024)
+        # Until the directory's mtime is old enough to trust, every listing rescans it
+        time.sleep(RACY_MTIME_NS / 10 ** 9)
+        for engine in args.engines.split(','):
+            with ServerProcess(engine, shared_space) as srv:
+                with socket.create_connection(('127.0.0.1', srv.port)) as sock:
+                    sock.settimeout(args.timeout)
+                    control = Connection(sock)
+                    latencies = [control_round_trip(control, i) for i in range(args.commands)]
+                    report_control(engine, 'none', latencies, 0, 1)
+
+                    # Downloads on data connections attached with tokens from this control
+                    # connection; run by other processes so they do not compete for our GIL
+                    stop = multiprocessing.Event()
+                    received = multiprocessing.Value('q', 0)
+                    downloaders = []
+                    for _ in range(args.transfers):
+                        control.send_command("DATA_TOKEN")
+                        token = control.read_frame().payload['token']
+                        downloaders.append(multiprocessing.Process(
+                            target=_download_repeatedly, args=(srv.port, token, args.timeout, stop, received)))
+                    start = time.perf_counter()
+                    for process in downloaders:
+                        process.start()
+                    time.sleep(0.5)
+                    latencies = [control_round_trip(control, i) for i in range(args.commands)]
+                    stop.set()
+                    for process in downloaders:
+                        process.join()
+                    elapsed = time.perf_counter() - start
+                    report_control(engine, f"{args.transfers} data conns", latencies, received.value, elapsed)
+
+                # A download on the connection itself holds up the commands behind it. The
+                # server refuses that on a control connection with data connections, so
+                # this one has none, as with an older client
+                with socket.create_connection(('127.0.0.1', srv.port)) as sock:
+                    sock.settimeout(args.timeout)
+                    plain = Connection(sock)
+                    latencies = []
+                    start = time.perf_counter()
+                    for i in range(3):
+                        plain.send_command("GET_FILE", index=0)
+                        sent = time.perf_counter()
+                        plain.send_command("FILE_INFO", index=1)
+                        plain.read_frame()
+                        frame = plain.read_frame()
+                        recv_exact_count(plain, frame.length)
+                        plain.read_frame()
+                        latencies.append(time.perf_counter() - sent)
+                    report_control(engine, 'same connection', latencies, 3 * frame.length,
+                                   time.perf_counter() - start)
+    finally:
+        shutil.rmtree(shared_space, ignore_errors=True)
+
+
+def report_control(engine, mode, latencies, transferred, elapsed):
+    p50 = percentile(latencies, 0.50) * 1000
+    p99 = percentile(latencies, 0.99) * 1000
+    print(f"{engine:<10} {mode:<18} {p50:>8.2f} {p99:>8.2f} {max(latencies) * 1000:>9.2f} "
+          f"{transferred / elapsed / 1024 ** 2:>8.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dir', default=None, help='directory for temporary shared spaces')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait per transfer')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    upload = subparsers.add_parser('upload', help='upload throughput and server memory')
+    upload.add_argument('--sizes', default='10M,1G,8G')
+    upload.add_argument('--engine', choices=sorted(ENGINES), default='threaded')
+    upload.add_argument('--checksum', choices=('off', 'on', 'both'), default='off',
+                        help='send a blake2b trailer with the upload')
+    upload.set_defaults(func=bench_upload)
+
+    download = subparsers.add_parser('download', help='download throughput and server memory')
+    download.add_argument('--sizes', default='10M,1G')
+    download.add_argument('--engine', choices=sorted(ENGINES), default='threaded')
+    download.add_argument('--checksum', choices=('off', 'on', 'both'), default='off',
+                          help='ask for a blake2b trailer with the download')
+    download.set_defaults(func=bench_download)
+
+    load = subparsers.add_parser('load', help='connection rate and command latency under many clients')
+    load.add_argument('--clients', type=int, default=200)
+    load.add_argument('--commands', type=int, default=20, help='commands per client')
+    load.add_argument('--files', type=int, default=100, help='files in the shared space')
+    load.add_argument('--engines', default='threaded,async')
+    load.set_defaults(func=bench_load)
+
+    listing = subparsers.add_parser('listing', help='LIST_FILES latency for large shared spaces')
+    listing.add_argument('--entries', default='1K,100K,1M')
+    listing.add_argument('--repeat', type=int, default=20, help='listings per measurement')
+    listing.add_argument('--engines', default='legacy,threaded')
+    listing.add_argument('--page', type=int, default=0, help='fetch pages of this many entries')
+    listing.add_argument('--sort', default='name', choices=('name', 'size', 'modified'))
+    listing.set_defaults(func=bench_listing)
+
+    batch = subparsers.add_parser('batch', help='files per second for many small files')
+    batch.add_argument('--count', type=int, default=10000, help='files per size')
+    batch.add_argument('--sizes', default='1K,16K,64K')
+    batch.add_argument('--engines', default='threaded,async')
+    batch.set_defaults(func=bench_batch)
+
+    delta = subparsers.add_parser('delta', help='bytes sent and time to re-upload a slightly edited file')
+    delta.add_argument('--sizes', default='100M,1G')
+    delta.add_argument('--edits', default='1,10,100', help='numbers of edited runs to try')
+    delta.add_argument('--edit-size', type=int, default=4096, help='bytes per edited run')
+    delta.add_argument('--engine', choices=('threaded', 'async'), default='threaded')
+    delta.set_defaults(func=bench_delta)
+
+    control = subparsers.add_parser('control', help='command latency while downloads run on data connections')
+    control.add_argument('--size', default='1G', help='size of the file downloaded')
+    control.add_argument('--transfers', type=int, default=4, help='concurrent downloads')
+    control.add_argument('--commands', type=int, default=200, help='commands timed per measurement')
+    control.add_argument('--files', type=int, default=1000, help='files in the shared space')
+    control.add_argument('--engines', default='threaded,async')
+    control.set_defaults(func=bench_control)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
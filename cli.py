@@ -0,0 +1,311 @@
+"""Command-line client for scripted and scheduled transfers.
+
+Runs the client without the GUI, so it works from cron, over SSH and on
+machines without Tk. Transfers go through the client's transfer queue, up to
+--parallel at a time; small files are fetched in GET_BATCH streams rather
+than one request each. Errors are written to stderr, everything else too with
+--verbose, or every event as a JSON line with --json. The exit status is 0
+if every transfer succeeded and 1 otherwise.
+
+    python cli.py --host 192.168.1.20 ls -l 'reports/*.csv'
+    python cli.py -o /data/incoming get reports/2024.csv photos
+    python cli.py put backup.tar exports/
+    python cli.py -o /data/mirror sync pull reports
+    python cli.py sync push /srv/exports
+    python cli.py --parallel 6 --json manifest nightly.txt
+    python cli.py stats
+
+A manifest has one get, put or sync command per line, with the arguments
+they take on the command line; blank lines and lines starting with # are
+skipped. All the transfers of a manifest share the queue.
+"""
+import argparse
+import json
+import os
+import shlex
+import sys
+import threading
+import time
+from datetime import datetime
+
+from client import Client, COMPRESSION_CODECS, walk_folder
+from transfers import DEFAULT_PARALLEL_TRANSFERS, DONE
+
+# Files smaller than this are downloaded in batches, up to BATCH_FILES per batch
+BATCH_MAX_SIZE = 1024 * 1024
+BATCH_FILES = 500
+# Modification times closer than this count as the same, for file systems
+# that store them coarsely
+SYNC_MTIME_TOLERANCE = 2.0
+# Least time between two progress events of a direction written with --json
+JSON_PROGRESS_INTERVAL = 1.0
+# Events carrying listings, left out of --json output
+LISTING_EVENTS = ('file_list', 'file_changes', 'dir_list', 'file_info')
+
+
+class EventSink:
+    """gui_callback of a client without a GUI: reports events and wakes up threads waiting on the client"""
+
+    def __init__(self, verbose=False, json_lines=False, stream=None):
+        self.verbose = verbose
+        self.json_lines = json_lines
+        self.stream = stream or sys.stderr
+        self.errors = 0
+        self.changed = threading.Condition()
+        self.last_progress = {}
+
+    def __call__(self, callback_type, data, log_type=None):
+        with self.changed:
+            if callback_type == 'log' and log_type == 'error':
+                self.errors += 1
+            if self.json_lines:
+                self.write_json(callback_type, data, log_type)
+            elif callback_type == 'log' and (self.verbose or log_type == 'error'):
+                print(f"{log_type or 'info'}: {data}", file=self.stream, flush=True)
+            self.changed.notify_all()
+
+    def write_json(self, callback_type, data, log_type):
+        if callback_type in LISTING_EVENTS:
+            return
+        if callback_type.endswith('_progress'):
+            now = time.monotonic()
+            if now - self.last_progress.get(callback_type, 0) < JSON_PROGRESS_INTERVAL:
+                return
+            self.last_progress[callback_type] = now
+        elif callback_type == 'transfers':
+            data = {'running': data['running'], 'queued': data['queued']}
+        event = {'time': time.time(), 'event': callback_type, 'data': data}
+        if log_type:
+            event['level'] = log_type
+        print(json.dumps(event, default=str), file=self.stream, flush=True)
+
+    def error(self, message):
+        self('log', message, 'error')
+
+    def wait_for(self, predicate, timeout):
+        """Wait until predicate() is true, re-checking after every event; False on timeout"""
+        with self.changed:
+            return self.changed.wait_for(predicate, timeout)
+
+
+def load_listing(client, sink, timeout, pattern='', sort='name', reverse=False):
+    """Fetch every page of the file list matching pattern, return it"""
+    client.list_query.update(sort=sort, reverse=reverse, pattern=pattern)
+    client.list_files()
+    while True:
+        settled = lambda: (not client.connected or client.generation is not None
+                           and not client.page_pending and not client.page_retry)
+        if not sink.wait_for(settled, timeout):
+            raise TimeoutError("no reply to the file list request")
+        if not client.connected:
+            raise ConnectionError("disconnected while listing files")
+        if len(client.file_list) >= client.list_total:
+            return client.file_list
+        client.fetch_next_page()
+
+
+def queue_downloads(client, files):
+    """Queue downloads of listing entries, the small files in batches; return the transfers"""
+    transfers = []
+    small = []
+    for file_info in files:
+        if file_info['size'] < BATCH_MAX_SIZE:
+            small.append(file_info['id'])
+        else:
+            transfers.append(client.queue_download(file_info['id']))
+    for start in range(0, len(small), BATCH_FILES):
+        transfers.append(client.queue_download_batch(small[start:start + BATCH_FILES]))
+    return transfers
+
+
+def up_to_date(file_info, size, mtime):
+    return file_info['size'] == size and abs(file_info['modified'] - mtime) < SYNC_MTIME_TOLERANCE
+
+
+class Job:
+    """Transfers planned from commands, run on one connected client"""
+
+    def __init__(self, client, sink, timeout):
+        self.client = client
+        self.sink = sink
+        self.timeout = timeout
+        self.transfers = []
+        self.listed = False
+
+    def files(self):
+        """The server's files by name, listed once per job"""
+        if not self.listed:
+            load_listing(self.client, self.sink, self.timeout)
+            self.listed = True
+        return self.client.files_by_name
+
+    def get(self, names):
+        files = self.files()
+        wanted = []
+        for name in names:
+            name = name.strip('/')
+            if name in files:
+                wanted.append(files[name])
+            elif any(other.startswith(name + '/') for other in files):
+                self.transfers.append(self.client.queue_download_folder(name))
+            else:
+                self.sink.error(f"Not found on the server: {name}")
+        self.transfers += queue_downloads(self.client, wanted)
+
+    def put(self, paths):
+        for path in paths:
+            if os.path.isdir(path):
+                self.transfers.append(self.client.queue_upload_folder(path))
+            elif os.path.isfile(path):
+                self.transfers.append(self.client.queue_upload(path))
+            else:
+                self.sink.error(f"Not found: {path}")
+
+    def sync(self, direction, path=''):
+        """Transfer the files missing or different on the other side; pull a server directory or push a folder"""
+        files = self.files()
+        if direction == 'pull':
+            prefix = path.strip('/') + '/' if path.strip('/') else ''
+            changed = []
+            for name, file_info in files.items():
+                if not name.startswith(prefix):
+                    continue
+                try:
+                    stat = os.stat(self.client.local_path(name))
+                except (OSError, ValueError):
+                    changed.append(file_info)
+                    continue
+                if not up_to_date(file_info, stat.st_size, stat.st_mtime):
+                    changed.append(file_info)
+            self.transfers += queue_downloads(self.client, changed)
+        else:
+            if not os.path.isdir(path):
+                self.sink.error(f"Folder not found: {path}")
+                return
+            for local, name in walk_folder(path, os.path.basename(os.path.normpath(path))):
+                try:
+                    stat = os.stat(local)
+                except OSError as e:
+                    self.sink.error(f"Skipping {local}: {e}")
+                    continue
+                if name not in files or not up_to_date(files[name], stat.st_size, stat.st_mtime):
+                    self.transfers.append(self.client.queue_upload(local, name=name))
+
+    def manifest(self, path):
+        with open(path, encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                words = shlex.split(line, comments=True)
+                if not words:
+                    continue
+                command, arguments = words[0], words[1:]
+                if command == 'get' and arguments:
+                    self.get(arguments)
+                elif command == 'put' and arguments:
+                    self.put(arguments)
+                elif command == 'sync' and arguments and arguments[0] in ('pull', 'push') and len(arguments) <= 2:
+                    self.sync(*arguments)
+                else:
+                    self.sink.error(f"{path}:{number}: not a get, put or sync command: {line.strip()}")
+
+    def wait(self):
+        """Wait for the planned transfers, True if they all succeeded"""
+        self.client.transfers.wait()
+        return all(transfer.state == DONE for transfer in self.transfers)
+
+
+def list_files(job, args):
+    files = load_listing(job.client, job.sink, job.timeout, args.pattern, args.sort, args.reverse)
+    for file_info in files:
+        if args.json:
+            print(json.dumps(file_info))
+        elif args.long:
+            modified = datetime.fromtimestamp(file_info['modified']).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"{file_info['size']:>14} {modified} {file_info['name']}")
+        else:
+            print(file_info['name'])
+
+
+def show_stats(job, args):
+    client = job.client
+    client.get_stats()
+    if not job.sink.wait_for(lambda: client.server_stats is not None or not client.connected, job.timeout):
+        raise TimeoutError("no reply to the STATS request")
+    if client.server_stats is None:
+        raise ConnectionError("disconnected before the server replied")
+    print(json.dumps(client.server_stats, indent=2))
+
+
+def run(args):
+    sink = EventSink(args.verbose, args.json)
+    client = Client(gui_callback=sink, download_dir=args.output)
+    client.verify_checksums = not args.no_checksum
+    client.compression = list(COMPRESSION_CODECS) if args.compress else []
+    client.transfers.set_parallelism(args.parallel)
+    if not client.connect(args.host, args.port):
+        return 1
+    job = Job(client, sink, args.timeout)
+    try:
+        args.command(job, args)
+        succeeded = job.wait()
+    except (OSError, TimeoutError) as e:
+        sink.error(str(e))
+        succeeded = False
+    except KeyboardInterrupt:
+        sink.error("Interrupted")
+        succeeded = False
+    finally:
+        client.disconnect()
+    return 0 if succeeded and not sink.errors else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('-o', '--output', default='downloads', help='folder downloads are saved in')
+    parser.add_argument('-j', '--parallel', type=int, default=DEFAULT_PARALLEL_TRANSFERS,
+                        help='transfers run at the same time')
+    parser.add_argument('--compress', action='store_true', help='compress transfers on the wire')
+    parser.add_argument('--no-checksum', action='store_true',
+                        help='skip the end-to-end checksum verification of transfers')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for the file list')
+    parser.add_argument('-v', '--verbose', action='store_true', help='report progress messages, not only errors')
+    parser.add_argument('--json', action='store_true', help='report every event as a JSON line on stderr')
+    subparsers = parser.add_subparsers(dest='name', required=True)
+
+    ls = subparsers.add_parser('ls', help='list the files on the server')
+    ls.add_argument('pattern', nargs='?', default='', help='glob, or prefix if it has no wildcards')
+    ls.add_argument('-l', '--long', action='store_true', help='show sizes and modification times')
+    ls.add_argument('--sort', choices=('name', 'size', 'modified'), default='name')
+    ls.add_argument('-r', '--reverse', action='store_true')
+    ls.set_defaults(command=list_files)
+
+    get = subparsers.add_parser('get', help='download files or directories')
+    get.add_argument('names', nargs='+')
+    get.set_defaults(command=lambda job, args: job.get(args.names))
+
+    put = subparsers.add_parser('put', help='upload files or folders')
+    put.add_argument('paths', nargs='+')
+    put.set_defaults(command=lambda job, args: job.put(args.paths))
+
+    sync = subparsers.add_parser('sync', help='transfer only what is missing or changed')
+    sync.add_argument('direction', choices=('pull', 'push'))
+    sync.add_argument('path', nargs='?', default='',
+                      help='server directory to pull (everything by default), or folder to push')
+    sync.set_defaults(command=lambda job, args: job.sync(args.direction, args.path))
+
+    manifest = subparsers.add_parser('manifest', help='run the commands of a manifest file')
+    manifest.add_argument('path')
+    manifest.set_defaults(command=lambda job, args: job.manifest(args.path))
+
+    stats = subparsers.add_parser('stats', help="show the server's metrics as JSON")
+    stats.set_defaults(command=show_stats)
+
+    args = parser.parse_args()
+    if args.name == 'sync' and args.direction == 'push' and not args.path:
+        parser.error("sync push needs a folder")
+    sys.exit(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,108 @@
+import bisect
+import queue
+import select
 import socket
 import threading
 import sys
-import json
 from datetime import datetime
 import os
 import time
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox, scrolledtext
 import platform
 import ctypes
+from protocol import (Connection, ProtocolError, ChecksumError, FRAME_RESPONSE, FRAME_TEXT, FRAME_DATA,
+                      FRAME_EVENT, RECV_SIZE, CHECKSUM_ALGORITHM, new_checksum, verify_trailer)
+from resume import PartialFile, CHECKPOINT_INTERVAL, is_partial_file
+from file_index import matches_pattern, normalize_path, MAX_DEPTH
+from compression import choose_encoding, read_compressed, send_compressed
+from delta import DELTA_MIN_SIZE, DeltaEncoder, send_delta, signature_table
+from dedup import DEDUP_MIN_SIZE
+from hash_cache import HashCache
+from transfers import TransferQueue, PRIORITY_NORMAL, FAILED, current_transfer_id
+from progress import ProgressBus, PROGRESS_RATE
+from activity_log import ActivityLog, LOG_CAPACITY
+
+try:
+    import tkinter as tk
+    from tkinter import ttk, filedialog, messagebox, scrolledtext, simpledialog
+    from file_view import FileColumns, FileListView
+except ImportError:
+    # Only the GUI needs Tk; Client runs without it, e.g. from cli.py on a headless machine
+    tk = None
+
+# Files at least this large are downloaded as byte ranges over parallel connections
+PARALLEL_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+SEGMENT_SIZE = 8 * 1024 * 1024
+INITIAL_DOWNLOAD_STREAMS = 2
+MAX_DOWNLOAD_STREAMS = 8
+# How often parallel downloads report progress and reconsider the stream count
+TUNE_INTERVAL = 0.5
+# Seconds between records of a parallel download's finished segments; each
+# record fsyncs the file, so it is made by the coordinating thread, not per segment
+SEGMENT_CHECKPOINT_INTERVAL = 2.0
+# Read timeout on data connections, which have no idle periods to wait through
+DATA_TIMEOUT = 30
+# Idle data connections kept open for the next transfer, and for how many seconds
+DATA_POOL_SIZE = 4
+DATA_IDLE_TIMEOUT = 60
+# How often batch downloads report progress
+BATCH_PROGRESS_INTERVAL = 0.1
+# Files fetched per LIST_FILES page; further pages are requested as the list is scrolled
+PAGE_SIZE = 500
+# Folder uploads send up to this many files ahead of the server's replies
+UPLOAD_PIPELINE_DEPTH = 32
+# Codecs offered when compressed transfers are turned on, in order of preference
+COMPRESSION_CODECS = ['zlib']
+# Where the activity log is saved when saving is turned on, rotated as it grows
+LOG_FILE = os.path.join("logs", "activity.log")
+# Activity log levels offered, each showing the more severe ones too
+LOG_FILTERS = {"All": "info", "Success and errors": "success", "Errors": "error"}
+
+
+def discard_event(callback_type, data, log_type=None):
+    """gui_callback of a Client created without one"""
+
 
 class Client:
-    def __init__(self, gui_callback=None):
+    def __init__(self, gui_callback=None, download_dir="downloads"):
         self.socket = None
+        self.conn = None
         self.connected = False
         self.host = None
         self.port = None
-        self.download_dir = "downloads"
+        # Created with the first download saved in it
+        self.download_dir = download_dir
+        # Listing pages loaded so far, the same entries by name and by file id,
+        # and the index generation they reflect
         self.file_list = []
-        self.gui_callback = gui_callback
+        self.files_by_name = {}
+        self.files_by_id = {}
+        self.generation = None
+        self.list_query = {'sort': 'name', 'reverse': False, 'pattern': ''}
+        self.list_total = 0
+        self.page_pending = False
+        self.page_retry = False
+        # Latest STATS reply
+        self.server_stats = None
+        # Codecs offered for compressed transfers; empty to always transfer raw bytes
+        self.compression = []
+        # Have every transfer end with a checksum trailer, checked before a file is kept.
+        # Whole files whose digest the sender has cached still go with sendfile
+        self.verify_checksums = True
+        # Re-upload files the server already has as a delta of the changed blocks
+        self.delta_uploads = True
+        # Name the digest of uploads so the server can skip content it already has;
+        # digests of local files are cached until the file changes
+        self.deduplicate_uploads = True
+        self.hashes = HashCache()
+        # Uploads and downloads started from the GUI, run a few at a time
+        self.transfers = TransferQueue(on_change=self.transfer_changed)
+        # Data connection tokens received on the control connection, and idle
+        # data connections as (connection, idle since)
+        self.data_tokens = queue.Queue()
+        self.data_pool = []
+        self.pool_lock = threading.Lock()
+        self.gui_callback = gui_callback or discard_event
         self.connection_timeout = 5
-        
-        if not os.path.exists(self.download_dir):
-            os.makedirs(self.download_dir)
     
     def connect(self, host, port=8888):
         """Connect to the server"""
@@ -35,6 +115,8 @@ class Client:
             
             self.socket.connect((host, port))
             self.socket.settimeout(2.0)
+            self.conn = Connection(self.socket)
+            self.generation = None
             
             self.connected = True
             self.host = host
@@ -48,6 +130,9 @@ class Client:
             listen_thread.daemon = True
             listen_thread.start()
             
+            # Have the server push changes to the file list
+            self.send_command("WATCH")
+            
             return True
             
         except Exception as e:
@@ -59,42 +144,21 @@ class Client:
     
     def listen_for_messages(self):
         """Listen for messages from server"""
-        buffer = ""
         while self.connected:
             try:
-                data = self.socket.recv(16384).decode('utf-8')
-                if not data:
+                frame = self.conn.read_frame()
+                if frame is None:
                     break
-                    
-                buffer += data
                 
-                # Process complete JSON objects
-                while buffer:
-                    if buffer.startswith('{'):
-                        brace_count = 0
-                        json_end = -1
-                        
-                        for i, char in enumerate(buffer):
-                            if char == '{':
-                                brace_count += 1
-                            elif char == '}':
-                                brace_count -= 1
-                                if brace_count == 0:
-                                    json_end = i + 1
-                                    break
-                        
-                        if json_end > 0:
-                            json_str = buffer[:json_end]
-                            buffer = buffer[json_end:]
-                            self.process_json_message(json_str)
-                            continue
-                    
-                    if '\n' in buffer:
-                        line, buffer = buffer.split('\n', 1)
-                        if line.strip():
-                            self.process_text_message(line.strip())
-                    else:
-                        break
+                if frame.type == FRAME_RESPONSE:
+                    self.process_json_message(frame.payload)
+                elif frame.type == FRAME_TEXT:
+                    self.process_text_message(frame.payload.strip())
+                elif frame.type == FRAME_EVENT:
+                    self.process_event(frame.payload)
+                elif frame.type == FRAME_DATA:
+                    # File data is only expected right after a file_transfer response
+                    self.conn.discard(frame.length)
                         
             except socket.timeout:
                 continue
@@ -106,28 +170,123 @@ class Client:
         if self.connected:
             self.disconnect()
     
-    def process_json_message(self, json_str):
+    def process_json_message(self, data):
         """Process JSON message from server"""
-        try:
-            data = json.loads(json_str)
-            msg_type = data.get('type')
+        msg_type = data.get('type')
+        
+        if msg_type == 'file_list':
+            self.apply_file_list(data)
+        
+        elif msg_type == 'file_changes':
+            self.apply_file_changes(data)
+        
+        elif msg_type == 'file_info':
+            if self.gui_callback:
+                self.gui_callback("file_info", data)
+        
+        elif msg_type == 'dir_list':
+            if self.gui_callback:
+                self.gui_callback("dir_list", data)
+        
+        elif msg_type == 'data_token':
+            self.data_tokens.put(data['token'])
+        
+        elif msg_type == 'stats':
+            self.server_stats = data
+            self.gui_callback("stats", data)
+    
+    def process_event(self, data):
+        """Process an event pushed by the server"""
+        if data.get('type') == 'file_changes':
+            if self.generation is None or data['generation'] <= self.generation:
+                return  # No listing yet, or already up to date
+            if data.get('since') != self.generation:
+                # Missed some changes, e.g. while a page was in flight; ask for them
+                self.list_changes()
+            else:
+                self.apply_file_changes(data)
+    
+    def apply_file_list(self, data):
+        """Take in a page of the file list"""
+        files = data.get('files', [])
+        offset = data.get('offset', 0)
+        total = data.get('total', len(files))
+        self.page_pending = False
+        if offset == 0:
+            self.file_list = files
+            self.files_by_name = {}
+            self.files_by_id = {}
+            self.generation = data.get('generation')
+        elif offset != len(self.file_list):
+            return  # A page of a listing that has since been replaced
+        elif data.get('generation') != self.generation:
+            # Files changed since the earlier pages: catch up, then fetch the page again
+            self.page_retry = True
+            self.list_changes()
+            return
+        else:
+            self.file_list = self.file_list + files
+        self.files_by_name.update((file_info['name'], file_info) for file_info in files)
+        self.files_by_id.update((file_info['id'], file_info) for file_info in files)
+        self.list_total = total
+        if self.gui_callback:
+            self.gui_callback("file_list", {'files': files, 'offset': offset, 'total': total})
+            if offset == 0:
+                self.gui_callback("log", f"File list updated: {total} files", "success")
+    
+    def apply_file_changes(self, data):
+        """Apply a LIST_CHANGES reply to the loaded part of the file list"""
+        if data.get('reset') or data.get('since') != self.generation:
+            self.list_files()
+            return
+        
+        added = data.get('added', [])
+        modified = data.get('modified', [])
+        removed = data.get('removed', [])
+        self.generation = data['generation']
+        
+        if added or modified or removed:
+            changed = set(removed).union(file_info['name'] for file_info in modified)
+            rows = [file_info for file_info in self.file_list if file_info['name'] not in changed]
             
-            if msg_type == 'file_list':
-                files = data.get('files', [])
-                self.file_list = files
-                if self.gui_callback:
-                    self.gui_callback("file_list", files)
-                    self.gui_callback("log", f"File list updated: {len(files)} files", "success")
+            pattern = self.list_query['pattern']
+            complete = len(self.file_list) >= self.list_total
+            self.list_total += sum(1 for file_info in added if matches_pattern(file_info['name'], pattern))
+            self.list_total -= sum(1 for name in removed if matches_pattern(name, pattern))
             
-            elif msg_type == 'file_info':
-                if self.gui_callback:
-                    self.gui_callback("file_info", data)
+            # Place new and modified files among the loaded rows, unless they sort
+            # into the part of the list that has not been loaded yet
+            sort, reverse = self.list_query['sort'], self.list_query['reverse']
+            if sort == 'name':
+                key = lambda file_info: file_info['name']
+            else:
+                key = lambda file_info: (file_info[sort], file_info['name'])
+            ordered = rows[::-1] if reverse else rows
+            keys = [key(file_info) for file_info in ordered]
+            for file_info in added + modified:
+                if not matches_pattern(file_info['name'], pattern):
+                    continue
+                position = bisect.bisect_left(keys, key(file_info))
+                if complete or (0 < position if reverse else position < len(keys)):
+                    keys.insert(position, key(file_info))
+                    ordered.insert(position, file_info)
             
-            elif msg_type == 'file_transfer':
-                self.receive_file_with_progress(data)
+            rows = ordered[::-1] if reverse else ordered
+            dropped = [name for name in self.files_by_name if name in changed]
+            self.file_list = rows
+            self.files_by_name = {file_info['name']: file_info for file_info in rows}
+            self.files_by_id = {file_info['id']: file_info for file_info in rows}
+            dropped = [name for name in dropped if name not in self.files_by_name]
+            updated = [file_info for file_info in added + modified if file_info['name'] in self.files_by_name]
             
-        except json.JSONDecodeError:
-            pass
+            if self.gui_callback:
+                self.gui_callback("file_changes", {'rows': rows, 'dropped': dropped, 'updated': updated})
+                self.gui_callback("log", f"File list updated: {len(added)} added, {len(removed)} removed, "
+                                         f"{len(modified)} modified", "success")
+        
+        if self.page_retry:
+            self.page_retry = False
+            self.fetch_next_page()
     
     def process_text_message(self, message):
         """Process text message from server"""
@@ -138,14 +297,14 @@ class Client:
         else:
             self.gui_callback("log", f"Server: {message}", "server")
     
-    def send_command(self, command):
+    def send_command(self, command, **args):
         """Send command to server"""
         if not self.connected:
             self.gui_callback("log", "Not connected to server", "error")
             return False
         
         try:
-            self.socket.send(command.encode('utf-8'))
+            self.conn.send_command(command, **args)
             return True
         except Exception as e:
             self.gui_callback("log", f"Send error: {e}", "error")
@@ -153,27 +312,106 @@ class Client:
             self.gui_callback("status", "Disconnected")
             return False
     
-    def list_files(self):
-        """Request file list from server"""
-        return self.send_command("LIST_FILES")
+    def list_files(self, offset=0):
+        """Request a page of the file list from server"""
+        query = {key: value for key, value in self.list_query.items() if value}
+        # Set before sending, since the reply may be processed before send_command returns
+        self.page_pending = True
+        if not self.send_command("LIST_FILES", offset=offset, limit=PAGE_SIZE, **query):
+            self.page_pending = False
+        return self.page_pending
+    
+    def list_changes(self):
+        """Request the changes to the file list since the loaded listing"""
+        return self.send_command("LIST_CHANGES", since=self.generation)
+    
+    def refresh_file_list(self):
+        """Bring the file list up to date, fetching only what changed if possible"""
+        if self.generation is None:
+            return self.list_files()
+        return self.list_changes()
+    
+    def fetch_next_page(self):
+        """Request the next page of the file list, if there is one and none is in flight"""
+        if self.page_pending or len(self.file_list) >= self.list_total:
+            return False
+        return self.list_files(len(self.file_list))
+    
+    def set_list_query(self, **query):
+        """Change the sort order or filter of the file list and reload it"""
+        self.list_query.update(query)
+        return self.list_files()
+    
+    def list_dir(self, path=''):
+        """Request the subdirectories and files directly inside a server directory"""
+        return self.send_command("LIST_DIR", path=path)
+    
+    def local_path(self, name):
+        """Where a file of the shared space is saved; raises ValueError for names outside of it"""
+        return os.path.join(self.download_dir, *normalize_path(name).split('/'))
     
-    def get_file_info(self, file_index):
+    def checksum_args(self):
+        """Request arguments asking for a checksum trailer, if checksums are on"""
+        return {'checksum': CHECKSUM_ALGORITHM} if self.verify_checksums else {}
+    
+    def get_cached_file(self, file_id):
+        """The listing entry of a file by its id"""
+        return self.files_by_id[file_id]
+    
+    def get_file_info(self, file_id):
         """Request file information"""
-        return self.send_command(f"FILE_INFO {file_index}")
+        return self.send_command("FILE_INFO", id=file_id)
     
-    def download_file(self, file_index):
-        """Request file download"""
-        self.gui_callback("log", f"Downloading file...", "info")
-        return self.send_command(f"GET_FILE {file_index}")
+    def get_stats(self):
+        """Request the server's metrics"""
+        self.server_stats = None
+        return self.send_command("STATS")
     
-    def upload_file(self, filepath):
-        """Upload file to server"""
+    def download_file(self, file_id):
+        """Download a file over a dedicated connection, continuing a partial download if one is on disk"""
+        file_info = self.get_cached_file(file_id)
+        offset = self.partial_download(file_info).resume_offset()
+        conn = None
+        complete = False
+        try:
+            conn = self.open_data_connection()
+            if offset:
+                self.gui_callback("log", f"Resuming {file_info['name']} from {self.format_file_size(offset)}", "info")
+                conn.send_command("GET_RANGE", id=file_id, offset=offset, compress=self.compression,
+                                  **self.checksum_args())
+            else:
+                conn.send_command("GET_FILE", id=file_id, compress=self.compression, **self.checksum_args())
+            frame = conn.read_frame()
+            if frame is None:
+                raise ConnectionError("connection closed by the server")
+            if frame.type == FRAME_TEXT:
+                raise IOError(frame.payload)
+            if frame.type != FRAME_RESPONSE:
+                raise ProtocolError("Expected the file details")
+            complete = self.receive_file_with_progress(conn, frame.payload)
+            return complete
+        except Exception as e:
+            self.gui_callback("log", f"Download failed: {e}", "error")
+            return False
+        finally:
+            if conn is not None:
+                self.release_data_connection(conn, complete)
+    
+    def partial_download(self, file_info):
+        """The on-disk state of an interrupted download of this version of a file"""
+        return PartialFile(self.download_dir, normalize_path(file_info['name']), file_info['size'],
+                           {'modified': file_info['modified']})
+    
+    def upload_file(self, filepath, name=None):
+        """Upload file to server as name (its own name by default), resuming where an interrupted upload stopped"""
         if not os.path.exists(filepath):
             self.gui_callback("log", f"File not found: {filepath}", "error")
             return False
         
+        conn = None
+        complete = False
         try:
-            filename = os.path.basename(filepath)
+            filename = name or os.path.basename(filepath)
             file_size = os.path.getsize(filepath)
             
             self.gui_callback("log", f"Uploading: {filename}", "info")
@@ -182,34 +420,86 @@ class Client:
                 'size': file_size
             })
             
-            upload_command = f"UPLOAD:{filename}:{file_size}"
-            self.socket.send(upload_command.encode('utf-8'))
-            time.sleep(0.1)
+            conn = self.open_data_connection()
+            if self.delta_uploads and file_size >= DELTA_MIN_SIZE:
+                start_time = time.time()
+                if self.upload_delta(conn, filepath, filename, file_size):
+                    self.gui_callback("upload_complete", {
+                        'filename': filename,
+                        'total_time': time.time() - start_time
+                    })
+                    self.gui_callback("log", f"Upload complete", "success")
+                    complete = True
+                    return True
+            
+            encoding = None
+            if self.compression:
+                with open(filepath, 'rb') as f:
+                    encoding = choose_encoding(f, filename, 0, file_size, self.compression)
+            
+            digest = None
+            if self.deduplicate_uploads and file_size >= DEDUP_MIN_SIZE:
+                digest = self.content_digest(filepath)
             
-            sent_size = 0
+            # The server answers with how many bytes of this file it already holds,
+            # and whether it takes the content compressed
             start_time = time.time()
-            chunk_size = 65536
+            conn.send_command("UPLOAD", name=filename, size=file_size, resume=True,
+                              modified=os.path.getmtime(filepath), encoding=encoding, **self.checksum_args(),
+                              **({CHECKSUM_ALGORITHM: digest} if digest else {}))
+            response = conn.read_frame()
+            if response is None or response.type != FRAME_RESPONSE:
+                raise ProtocolError(response.payload if response else "Connection closed")
+            if response.payload.get('type') == 'upload_complete':
+                # The server had the same content under another name
+                self.gui_callback("upload_complete", {
+                    'filename': filename,
+                    'total_time': time.time() - start_time
+                })
+                self.gui_callback("log", f"Upload complete, the server already had this content", "success")
+                complete = True
+                return True
+            offset = response.payload['offset']
+            encoding = response.payload.get('encoding')
+            checksum = new_checksum() if response.payload.get('checksum') else None
+            if offset:
+                self.gui_callback("log", f"Resuming upload from {self.format_file_size(offset)}", "info")
+            
+            start_time = time.time()
+            
+            def report_progress(sent_size, wire_size=None):
+                progress = (offset + sent_size) / file_size
+                elapsed = time.time() - start_time
+                speed = sent_size / elapsed if elapsed > 0 else 0
+                
+                self.gui_callback("upload_progress", {
+                    'progress': progress,
+                    'sent_size': offset + sent_size,
+                    'total_size': file_size,
+                    'speed': speed,
+                    'wire_speed': (sent_size if wire_size is None else wire_size) / elapsed if elapsed > 0 else 0,
+                    'eta': (file_size - offset - sent_size) / speed if speed > 0 else 0
+                })
             
             with open(filepath, 'rb') as f:
-                while sent_size < file_size:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                    
-                    self.socket.sendall(chunk)
-                    sent_size += len(chunk)
-                    
-                    progress = sent_size / file_size
-                    elapsed = time.time() - start_time
-                    speed = sent_size / elapsed if elapsed > 0 else 0
-                    
-                    self.gui_callback("upload_progress", {
-                        'progress': progress,
-                        'sent_size': sent_size,
-                        'total_size': file_size,
-                        'speed': speed,
-                        'eta': (file_size - sent_size) / speed if speed > 0 else 0
-                    })
+                # A digest cached for deduplication trails the whole file as is, so it goes with sendfile
+                digest = self.hashes.cached(os.fstat(f.fileno())) if checksum is not None and not offset else None
+                running = checksum if digest is None else None
+                if encoding:
+                    sent_size, wire_size = send_compressed(conn, f, offset, file_size - offset, encoding,
+                                                           progress=report_progress, checksum=running)
+                else:
+                    sent_size = conn.send_file_data(f, offset, file_size - offset, progress=report_progress,
+                                                    checksum=running)
+            
+            if sent_size != file_size - offset:
+                raise IOError(f"file changed during upload ({offset + sent_size}/{file_size} bytes)")
+            if checksum is not None:
+                conn.send_trailer(digest or checksum)
+            
+            response = conn.read_frame()
+            if response is None or response.type != FRAME_RESPONSE:
+                raise ProtocolError(response.payload if response else "Connection closed")
             
             total_time = time.time() - start_time
             self.gui_callback("upload_complete", {
@@ -217,19 +507,221 @@ class Client:
                 'total_time': total_time
             })
             self.gui_callback("log", f"Upload complete", "success")
-            
+            complete = True
             return True
             
         except Exception as e:
             self.gui_callback("log", f"Upload failed: {e}", "error")
             return False
+        finally:
+            if conn:
+                self.release_data_connection(conn, complete)
     
-    def receive_file_with_progress(self, file_info):
-        """Receive file from server"""
+    def content_digest(self, filepath):
+        """Hex digest of a local file's content, None if it cannot be computed"""
+        try:
+            digest = self.hashes.compute(filepath)
+        except Exception:
+            return None
+        return digest and digest.hex()
+    
+    def upload_delta(self, conn, filepath, filename, file_size):
+        """Upload a file as the changes to the server's copy, False if it has no copy to change.
+        
+        The server sends signatures of its copy's blocks; blocks found in
+        the local file are sent as references, the rest as literal bytes.
+        Also False if the server holds an interrupted upload of this version,
+        which a plain upload resumes.
+        """
+        conn.send_command("SIGNATURES", name=filename, size=file_size, modified=os.path.getmtime(filepath))
+        response = conn.read_frame()
+        if response is None:
+            raise ConnectionError("Connection closed")
+        if response.type != FRAME_RESPONSE or response.payload.get('type') == 'resumable':
+            return False
+        frame = conn.read_frame()
+        if frame is None or frame.type != FRAME_DATA:
+            raise ProtocolError("Expected block signatures")
+        table = signature_table(conn.read_exact(frame.length))
+        signatures = response.payload
+        
+        conn.send_command("DELTA", name=filename, size=file_size, version=signatures['version'],
+                          modified=os.path.getmtime(filepath), **self.checksum_args())
+        response = conn.read_frame()
+        if response is None:
+            raise ConnectionError("Connection closed")
+        if response.type != FRAME_RESPONSE:
+            # The server's copy changed in the meantime
+            return False
+        checksum = new_checksum() if response.payload.get('checksum') else None
+        self.gui_callback("log", "Server has a copy, sending only the changes", "info")
+        
+        start_time = time.time()
+        
+        def report_progress(sent_size, wire_size):
+            elapsed = time.time() - start_time
+            speed = sent_size / elapsed if elapsed > 0 else 0
+            self.gui_callback("upload_progress", {
+                'progress': sent_size / file_size,
+                'sent_size': sent_size,
+                'total_size': file_size,
+                'speed': speed,
+                'wire_speed': wire_size / elapsed if elapsed > 0 else 0,
+                'eta': (file_size - sent_size) / speed if speed > 0 else 0
+            })
+        
+        with open(filepath, 'rb') as f:
+            encoder = DeltaEncoder(f, signatures['block_size'], table, checksum)
+            sent_size, wire_size = send_delta(conn, encoder, progress=report_progress)
+        if sent_size != file_size:
+            raise IOError(f"file changed during upload ({sent_size}/{file_size} bytes)")
+        if checksum is not None:
+            conn.send_trailer(checksum)
+        
+        response = conn.read_frame()
+        if response is None or response.type != FRAME_RESPONSE:
+            raise ProtocolError(response.payload if response else "Connection closed")
+        self.gui_callback("log", f"Sent {self.format_file_size(encoder.literal)} of changes, reused "
+                          f"{self.format_file_size(encoder.copied)}", "info")
+        return True
+    
+    def upload_folder(self, folder):
+        """Upload a folder and everything below it over one dedicated connection.
+
+        Files are sent as the folder is walked, without waiting for the server
+        to acknowledge each: up to UPLOAD_PIPELINE_DEPTH uploads are in flight
+        while a second thread reads the replies. Returns the number uploaded.
+        """
+        if not os.path.isdir(folder):
+            self.gui_callback("log", f"Folder not found: {folder}", "error")
+            return 0
+        
+        top = os.path.basename(os.path.normpath(folder))
+        window = threading.Semaphore(UPLOAD_PIPELINE_DEPTH)
+        # Names of the uploads whose replies are still to be read, None once all are sent
+        in_flight = queue.Queue()
+        state = {'uploaded': 0, 'failed': 0, 'sending': True, 'error': None}
+        conn = None
+        complete = False
+        
+        def read_replies():
+            try:
+                while True:
+                    filename = in_flight.get()
+                    if filename is None:
+                        return
+                    # upload_ready then upload_complete, or an error at either step
+                    frame = read_reply()
+                    if frame.type == FRAME_RESPONSE and frame.payload.get('type') == 'upload_ready':
+                        frame = read_reply()
+                    if frame.type == FRAME_RESPONSE and frame.payload.get('type') == 'upload_complete':
+                        state['uploaded'] += 1
+                    else:
+                        state['failed'] += 1
+                        self.gui_callback("log", f"Upload of {filename} failed: {frame.payload}", "error")
+                    window.release()
+            except Exception as e:
+                state['error'] = e
+                window.release()
+        
+        def read_reply():
+            while True:
+                try:
+                    frame = conn.read_frame()
+                except socket.timeout:
+                    # A large file can take longer to send than the read timeout
+                    if state['sending']:
+                        continue
+                    raise
+                if frame is None:
+                    raise ConnectionError("connection closed during the upload")
+                return frame
+        
+        self.gui_callback("log", f"Uploading folder: {top}", "info")
+        self.gui_callback("upload_start", {
+            'filename': f"{top}/",
+            'size': None
+        })
+        reader = threading.Thread(target=read_replies, daemon=True)
+        try:
+            conn = self.open_data_connection()
+            reader.start()
+            start_time = time.time()
+            last_report = start_time
+            sent_files = 0
+            sent_bytes = 0
+            for path, filename in walk_folder(folder, top):
+                window.acquire()
+                if state['error']:
+                    break
+                try:
+                    f = open(path, 'rb')
+                except OSError as e:
+                    self.gui_callback("log", f"Skipping {filename}: {e}", "error")
+                    window.release()
+                    continue
+                with f:
+                    stat = os.fstat(f.fileno())
+                    in_flight.put(filename)
+                    # Sent without waiting for upload_ready, so a checksum is sent if asked for
+                    checksum = new_checksum() if self.verify_checksums else None
+                    digest = self.hashes.cached(stat) if checksum is not None else None
+                    with conn.send_lock:
+                        conn.send_command("UPLOAD", name=filename, size=stat.st_size, modified=stat.st_mtime,
+                                          **self.checksum_args())
+                        sent_size = conn.send_file_data(f, 0, stat.st_size,
+                                                        checksum=checksum if digest is None else None)
+                        if checksum is not None and sent_size == stat.st_size:
+                            conn.send_trailer(digest or checksum)
+                if sent_size != stat.st_size:
+                    raise IOError(f"{filename} changed during upload")
+                sent_files += 1
+                sent_bytes += sent_size
+                
+                now = time.time()
+                if now - last_report >= BATCH_PROGRESS_INTERVAL:
+                    last_report = now
+                    elapsed = now - start_time
+                    self.gui_callback("upload_progress", {
+                        'progress': None,
+                        'files': sent_files,
+                        'sent_size': sent_bytes,
+                        'speed': sent_bytes / elapsed if elapsed > 0 else 0
+                    })
+            
+            state['sending'] = False
+            in_flight.put(None)
+            reader.join()
+            if state['error']:
+                raise state['error']
+            
+            self.gui_callback("upload_complete", {
+                'filename': f"{top}/",
+                'total_time': time.time() - start_time
+            })
+            if state['failed']:
+                self.gui_callback("log", f"{state['failed']} files of {top} could not be uploaded", "error")
+            self.gui_callback("log", f"Folder upload complete ({state['uploaded']} files)", "success")
+            complete = True
+        except Exception as e:
+            self.gui_callback("log", f"Folder upload failed after {state['uploaded']} files: {e}", "error")
+        finally:
+            state['sending'] = False
+            in_flight.put(None)
+            if conn is not None:
+                self.release_data_connection(conn, complete)
+        return state['uploaded']
+    
+    def receive_file_with_progress(self, conn, file_info):
+        """Receive a file from conn into a partial file, kept for resume if interrupted; True if complete"""
+        f = None
         try:
             filename = file_info['name']
             file_size = file_info['size']
-            filepath = os.path.join(self.download_dir, filename)
+            offset = file_info.get('offset', 0)
+            received_size = offset
+            filepath = self.local_path(filename)
+            partial = self.partial_download(file_info)
             
             self.gui_callback("log", f"Downloading: {filename}", "info")
             self.gui_callback("download_start", {
@@ -237,49 +729,480 @@ class Client:
                 'size': file_size
             })
             
-            self.socket.send("READY".encode('utf-8'))
+            encoding = file_info.get('encoding')
+            checksum = new_checksum() if file_info.get('checksum') else None
+            if encoding:
+                # The content comes as compressed blocks, ending with an empty frame
+                chunks = read_compressed(conn, encoding)
+            else:
+                frame = conn.read_frame()
+                if frame is None or frame.type != FRAME_DATA:
+                    raise ProtocolError("Expected file data")
+                remaining = frame.length
+                chunks = None
+            if offset and partial.resume_offset() != offset:
+                raise IOError("file changed on the server since the partial download, please retry")
             
-            received_size = 0
             start_time = time.time()
+            buffer = memoryview(bytearray(RECV_SIZE))
+            checkpoint_at = received_size + CHECKPOINT_INTERVAL
+            wire_size = 0
             
-            with open(filepath, 'wb') as f:
-                while received_size < file_size:
-                    remaining = file_size - received_size
-                    chunk_size = min(65536, remaining)
-                    
-                    chunk = self.socket.recv(chunk_size)
-                    if not chunk:
+            f = partial.open(offset)
+            while True:
+                if chunks is not None:
+                    data, n = next(chunks, (None, 0))
+                    if data is None:
                         break
-                    
-                    f.write(chunk)
-                    received_size += len(chunk)
-                    
-                    progress = received_size / file_size
-                    elapsed = time.time() - start_time
-                    speed = received_size / elapsed if elapsed > 0 else 0
-                    
-                    self.gui_callback("download_progress", {
-                        'progress': progress,
-                        'received_size': received_size,
-                        'total_size': file_size,
-                        'speed': speed,
-                        'eta': (file_size - received_size) / speed if speed > 0 else 0
-                    })
+                else:
+                    if not remaining:
+                        break
+                    n = conn.recv_into(buffer, min(RECV_SIZE, remaining))
+                    if not n:
+                        break
+                    data = buffer[:n]
+                    remaining -= n
+                
+                f.write(data)
+                if checksum is not None:
+                    checksum.update(data)
+                received_size += len(data)
+                wire_size += n
+                if received_size >= checkpoint_at:
+                    partial.checkpoint(f, received_size)
+                    checkpoint_at = received_size + CHECKPOINT_INTERVAL
+                
+                progress = received_size / file_size if file_size else 1.0
+                elapsed = time.time() - start_time
+                speed = (received_size - offset) / elapsed if elapsed > 0 else 0
+                
+                self.gui_callback("download_progress", {
+                    'progress': progress,
+                    'received_size': received_size,
+                    'total_size': file_size,
+                    'speed': speed,
+                    'wire_speed': wire_size / elapsed if elapsed > 0 else 0,
+                    'eta': (file_size - received_size) / speed if speed > 0 else 0
+                })
             
             if received_size == file_size:
+                f.close()
+                f = None
+                if checksum is not None:
+                    self.verify_download(partial, conn.read_frame(), checksum)
+                partial.commit(filepath, file_info['modified'])
                 total_time = time.time() - start_time
                 self.gui_callback("download_complete", {
                     'filename': filename,
                     'total_time': total_time
                 })
                 self.gui_callback("log", f"Download complete", "success")
-            else:
-                self.gui_callback("log", f"Download incomplete", "error")
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+                return True
+            self.gui_callback("log", f"Download incomplete", "error")
+            return False
                     
         except Exception as e:
             self.gui_callback("log", f"Download failed: {e}", "error")
+            return False
+        finally:
+            if f is not None:
+                # Keep what arrived so a retry only fetches the missing bytes
+                try:
+                    partial.checkpoint(f, received_size)
+                    self.gui_callback("log", f"Kept {self.format_file_size(received_size)} for resume", "info")
+                except OSError:
+                    pass
+                f.close()
+    
+    def verify_download(self, partial, trailer, checksum):
+        """Check a download's checksum trailer; a corrupt download is deleted rather than kept for resume"""
+        try:
+            verify_trailer(trailer, checksum)
+        except ChecksumError:
+            partial.discard()
+            raise
+    
+    def download_batch(self, file_ids=(), names=(), dirs=()):
+        """Download many files in one GET_BATCH stream over a dedicated connection.
+
+        The server sends the files back to back with no round trip per file,
+        and each is written out as it arrives. dirs are server directories
+        whose whole content is fetched. Returns the number received.
+        """
+        # The number of files in the directories is only known at the end
+        total = None if dirs else len(file_ids) + len(names)
+        label = f"{total} files" if total is not None else ", ".join(f"{path}/" for path in dirs)
+        received = 0
+        received_size = 0
+        conn = None
+        complete = False
+        self.gui_callback("log", f"Downloading {label} (batch)", "info")
+        self.gui_callback("download_start", {
+            'filename': label,
+            'size': None
+        })
+        try:
+            conn = self.open_data_connection()
+            conn.send_command("GET_BATCH", ids=list(file_ids), names=list(names), dirs=list(dirs),
+                              **self.checksum_args())
+            start_time = time.time()
+            last_report = start_time
+            buffer = memoryview(bytearray(RECV_SIZE))
+            while True:
+                frame = conn.read_frame()
+                if frame is None:
+                    raise ConnectionError("connection closed during the batch")
+                if frame.type == FRAME_TEXT:
+                    raise IOError(frame.payload)
+                message = frame.payload
+                if message.get('type') == 'batch_complete':
+                    break
+                
+                data = conn.read_frame()
+                if message.get('type') != 'batch_file' or data is None or data.type != FRAME_DATA:
+                    raise ProtocolError("Expected a batch file")
+                self.receive_batch_file(conn, message, data.length, buffer)
+                received += 1
+                received_size += data.length
+                
+                now = time.time()
+                if now - last_report >= BATCH_PROGRESS_INTERVAL:
+                    last_report = now
+                    elapsed = now - start_time
+                    self.gui_callback("download_progress", {
+                        'progress': None if total is None else received / total if total else 1.0,
+                        'files': received,
+                        'total_files': total,
+                        'received_size': received_size,
+                        'speed': received_size / elapsed if elapsed > 0 else 0
+                    })
+            
+            missing = message.get('missing', [])
+            if missing:
+                self.gui_callback("log", f"{len(missing)} files were not found on the server", "error")
+            self.gui_callback("download_complete", {
+                'filename': f"{received} files",
+                'total_time': time.time() - start_time
+            })
+            self.gui_callback("log", f"Download complete ({received} files)", "success")
+            complete = True
+        except Exception as e:
+            self.gui_callback("log", f"Batch download failed after {received} files: {e}", "error")
+        finally:
+            if conn is not None:
+                self.release_data_connection(conn, complete)
+        return received
+    
+    def download_folder(self, path):
+        """Download a server directory and everything below it, see download_batch"""
+        return self.download_batch(dirs=[path])
+    
+    def receive_batch_file(self, conn, message, size, buffer):
+        """Write one file of a batch, whose DATA frame of size bytes is next on conn"""
+        name = normalize_path(message['name'])
+        partial = PartialFile(self.download_dir, name, size, {'modified': message['modified']})
+        checksum = new_checksum() if message.get('checksum') else None
+        remaining = size
+        with partial.open(0) as f:
+            while remaining:
+                n = conn.recv_into(buffer, min(len(buffer), remaining))
+                if not n:
+                    raise ConnectionError("connection closed during the batch")
+                f.write(buffer[:n])
+                if checksum is not None:
+                    checksum.update(buffer[:n])
+                remaining -= n
+        if checksum is not None:
+            self.verify_download(partial, conn.read_frame(), checksum)
+        partial.commit(self.local_path(name), message['modified'])
+    
+    def open_data_connection(self):
+        """A data connection for one transfer, from the pool or newly attached with a token.
+
+        Data connections carry only transfers, so file bytes never queue up
+        behind or ahead of the commands and events of the control connection.
+        """
+        with self.pool_lock:
+            while self.data_pool:
+                conn, idle_since = self.data_pool.pop()
+                # An idle connection has nothing to read unless the server closed it
+                if (time.monotonic() - idle_since < DATA_IDLE_TIMEOUT and
+                        not select.select([conn.sock], [], [], 0)[0]):
+                    return conn
+                conn.close()
+        
+        token = self.request_data_token()
+        sock = socket.create_connection((self.host, self.port), timeout=self.connection_timeout)
+        sock.settimeout(DATA_TIMEOUT)
+        conn = Connection(sock)
+        try:
+            conn.send_command("ATTACH", token=token)
+            frame = conn.read_frame()
+            if frame is None or frame.type != FRAME_RESPONSE or frame.payload.get('type') != 'attached':
+                raise ConnectionError(frame.payload if frame else "data connection refused")
+        except Exception:
+            conn.close()
+            raise
+        return conn
+    
+    def request_data_token(self):
+        """Ask the server, over the control connection, for a token to attach a data connection"""
+        if not self.send_command("DATA_TOKEN"):
+            raise ConnectionError("Not connected to server")
+        try:
+            # Tokens are interchangeable, so it does not matter whose request this reply answers
+            return self.data_tokens.get(timeout=self.connection_timeout)
+        except queue.Empty:
+            raise ConnectionError("no data token from the server") from None
+    
+    def release_data_connection(self, conn, reusable=True):
+        """Keep a data connection for the next transfer, or close it.
+
+        Only connections whose transfer completed are reusable: after a
+        failure, unread frames of it may still be on the way.
+        """
+        if reusable and self.connected:
+            with self.pool_lock:
+                if len(self.data_pool) < DATA_POOL_SIZE:
+                    self.data_pool.append((conn, time.monotonic()))
+                    return
+        conn.close()
+    
+    def close_data_pool(self):
+        with self.pool_lock:
+            pool, self.data_pool = self.data_pool, []
+        for conn, _ in pool:
+            conn.close()
+    
+    def download_file_parallel(self, file_id, max_streams=MAX_DOWNLOAD_STREAMS):
+        """Download a large file as byte ranges fetched over several connections.
+
+        The file is split into SEGMENT_SIZE ranges that a pool of workers, each
+        with its own connection, fetch with GET_RANGE and write in place with
+        os.pwrite into a preallocated file. The pool starts small and grows
+        while each added stream still raises the overall throughput. Completed
+        segments are recorded in the partial file's manifest, so an interrupted
+        download only fetches the missing segments when retried.
+        """
+        file_info = self.get_cached_file(file_id)
+        filename = file_info['name']
+        file_size = file_info['size']
+        filepath = self.local_path(filename)
+        
+        self.gui_callback("log", f"Downloading: {filename} (parallel)", "info")
+        self.gui_callback("download_start", {
+            'filename': filename,
+            'size': file_size
+        })
+        
+        partial = self.partial_download(file_info)
+        manifest = partial.load()
+        if manifest and manifest.get('segment_size') == SEGMENT_SIZE:
+            done = set(manifest.get('segments', []))
+        else:
+            # A sequential partial download still gives us its verified prefix
+            prefix = partial.resume_offset()
+            done = set(range(0, prefix - prefix % SEGMENT_SIZE, SEGMENT_SIZE))
+        
+        all_segments = [(offset, min(SEGMENT_SIZE, file_size - offset))
+                        for offset in range(0, file_size, SEGMENT_SIZE)]
+        segments = [s for s in all_segments if s[0] not in done]
+        total_segments = len(all_segments)
+        lock = threading.Lock()
+        state = {
+            'received': sum(length for offset, length in all_segments if offset in done),
+            'done': total_segments - len(segments),
+            'errors': []
+        }
+        if done:
+            self.gui_callback("log", f"Resuming: {state['done']}/{total_segments} segments already on disk", "info")
+        workers = []
+        worker_exited = threading.Event()
+        
+        def fetch_segments(fd):
+            conn = self.open_data_connection()
+            buffer = memoryview(bytearray(RECV_SIZE))
+            drained = False
+            try:
+                while self.connected:
+                    with lock:
+                        if not segments:
+                            drained = True
+                            return
+                        offset, length = segments.pop(0)
+                    written = 0
+                    try:
+                        conn.send_command("GET_RANGE", id=file_id, offset=offset, length=length,
+                                          **self.checksum_args())
+                        response = conn.read_frame()
+                        if response is None or response.type != FRAME_RESPONSE:
+                            raise ProtocolError(response.payload if response else "Connection closed")
+                        if (response.payload['size'] != file_size or
+                                response.payload['modified'] != file_info['modified']):
+                            raise IOError("file changed on the server")
+                        frame = conn.read_frame()
+                        if frame is None or frame.type != FRAME_DATA or frame.length != length:
+                            raise ProtocolError("Expected file data")
+                        checksum = new_checksum() if response.payload.get('checksum') else None
+                        
+                        while written < length:
+                            n = conn.recv_into(buffer, min(RECV_SIZE, length - written))
+                            if not n:
+                                raise ProtocolError("Connection closed mid-transfer")
+                            write_at(fd, buffer[:n], offset + written)
+                            if checksum is not None:
+                                checksum.update(buffer[:n])
+                            written += n
+                            with lock:
+                                state['received'] += n
+                        if checksum is not None:
+                            # A corrupt segment is fetched again rather than recorded as done
+                            verify_trailer(conn.read_frame(), checksum)
+                    except Exception:
+                        # Hand the segment back so another stream can fetch it
+                        with lock:
+                            segments.append((offset, length))
+                            state['received'] -= written
+                        raise
+                    with lock:
+                        state['done'] += 1
+                        done.add(offset)
+            finally:
+                self.release_data_connection(conn, drained)
+        
+        def contiguous_prefix():
+            offset = 0
+            while offset < file_size and offset in done:
+                offset += SEGMENT_SIZE
+            return min(offset, file_size)
+        
+        def record_segments(fd):
+            """Record the finished segments in the manifest, so a retry skips them"""
+            with lock:
+                finished = sorted(done)
+                prefix = contiguous_prefix()
+            partial.checkpoint(fd, prefix, segments=finished, segment_size=SEGMENT_SIZE)
+        
+        def worker(fd):
+            try:
+                fetch_segments(fd)
+            except Exception as e:
+                with lock:
+                    state['errors'].append(e)
+            finally:
+                worker_exited.set()
+        
+        start_time = time.time()
+        f = partial.open(None if done else 0)
+        fd = f.fileno()
+        try:
+            preallocate(fd, file_size)
+            
+            def add_worker():
+                t = threading.Thread(target=worker, args=(fd,), daemon=True)
+                workers.append(t)
+                t.start()
+            
+            for _ in range(max(1, min(INITIAL_DOWNLOAD_STREAMS, max_streams, total_segments))):
+                add_worker()
+            
+            initial_received = last_received = state['received']
+            last_time = last_record = start_time
+            best_speed, tuning = 0.0, True
+            while state['done'] < total_segments and any(t.is_alive() for t in workers):
+                worker_exited.wait(TUNE_INTERVAL)
+                worker_exited.clear()
+                now = time.time()
+                with lock:
+                    received_size = state['received']
+                    remaining_segments = len(segments)
+                interval_speed = (received_size - last_received) / max(now - last_time, 1e-6)
+                last_received, last_time = received_size, now
+                
+                # Hill-climb: add streams while each one still raises throughput
+                if tuning and remaining_segments and len(workers) < max_streams:
+                    if interval_speed > best_speed * 1.1:
+                        best_speed = interval_speed
+                        add_worker()
+                    else:
+                        tuning = False
+                
+                elapsed = now - start_time
+                speed = (received_size - initial_received) / elapsed if elapsed > 0 else 0
+                self.gui_callback("download_progress", {
+                    'progress': received_size / file_size if file_size else 1.0,
+                    'received_size': received_size,
+                    'total_size': file_size,
+                    'speed': speed,
+                    'eta': (file_size - received_size) / speed if speed > 0 else 0,
+                    'streams': len(workers)
+                })
+                if now - last_record >= SEGMENT_CHECKPOINT_INTERVAL:
+                    last_record = now
+                    record_segments(fd)
+        finally:
+            if state['done'] < total_segments:
+                try:
+                    record_segments(fd)
+                except OSError:
+                    pass  # A retry fetches the segments finished since the last record again
+            f.close()
+        
+        if state['done'] == total_segments:
+            partial.commit(filepath, file_info['modified'])
+            self.gui_callback("download_complete", {
+                'filename': filename,
+                'total_time': time.time() - start_time
+            })
+            self.gui_callback("log", f"Download complete ({len(workers)} streams)", "success")
+            return True
+        
+        error = state['errors'][-1] if state['errors'] else "incomplete"
+        self.gui_callback("log", f"Download failed: {error}; {state['done']}/{total_segments} segments kept for resume", "error")
+        return False
+    
+    def queue_upload(self, filepath, priority=PRIORITY_NORMAL, name=None):
+        """Queue a file upload, return the transfer"""
+        try:
+            size = os.path.getsize(filepath)
+        except OSError:
+            size = None
+        name = name or os.path.basename(filepath)
+        return self.transfers.submit('upload', name, lambda: self.upload_file(filepath, name), size, priority)
+    
+    def queue_download(self, file_id, priority=PRIORITY_NORMAL):
+        """Queue a file download, over parallel connections if the file is large; return the transfer"""
+        file_info = self.get_cached_file(file_id)
+        if file_info['size'] >= PARALLEL_DOWNLOAD_THRESHOLD:
+            run = lambda: self.download_file_parallel(file_id)
+        else:
+            run = lambda: self.download_file(file_id)
+        return self.transfers.submit('download', file_info['name'], run, file_info['size'], priority)
+    
+    def queue_upload_folder(self, folder, priority=PRIORITY_NORMAL):
+        """Queue a folder upload, return the transfer"""
+        name = os.path.basename(os.path.normpath(folder))
+        return self.transfers.submit('upload', f"{name}/", lambda: self.upload_folder(folder), None, priority)
+    
+    def queue_download_folder(self, path, priority=PRIORITY_NORMAL):
+        """Queue a server directory download, return the transfer"""
+        return self.transfers.submit('download', f"{path}/", lambda: self.download_folder(path), None, priority)
+    
+    def queue_download_batch(self, file_ids, priority=PRIORITY_NORMAL):
+        """Queue a batch download of several files, return the transfer"""
+        size = sum(self.get_cached_file(file_id)['size'] for file_id in file_ids)
+        return self.transfers.submit('download', f"{len(file_ids)} files",
+                                     lambda: self.download_batch(file_ids=file_ids), size, priority)
+    
+    def transfer_changed(self, transfer):
+        """Report the queue's state whenever a transfer starts, ends or changes"""
+        if not self.gui_callback:
+            return
+        if transfer.state == FAILED and transfer.error is not None:
+            self.gui_callback("log", f"Transfer of {transfer.name} failed: {transfer.error}", "error")
+        running, queued = self.transfers.counts()
+        self.gui_callback("transfers", {'running': running, 'queued': queued,
+                                        'pending': [t.describe() for t in self.transfers.pending()]})
     
     def format_file_size(self, size_bytes):
         """Format file size in human-readable format"""
@@ -295,6 +1218,9 @@ class Client:
     def disconnect(self):
         """Disconnect from server"""
         self.connected = False
+        # Transfers already running finish on their own connections
+        self.transfers.cancel_all()
+        self.close_data_pool()
         if self.socket:
             try:
                 self.socket.close()
@@ -305,12 +1231,65 @@ class Client:
             self.gui_callback("log", "Disconnected from server", "info")
 
 
+# Serialises seek+write on platforms without os.pwrite
+_write_lock = threading.Lock()
+
+
+def walk_folder(folder, name, max_depth=MAX_DEPTH):
+    """Generate (local path, relative name) for the files below a local folder.
+
+    Directories are scanned one at a time as the generator is consumed, so
+    the first files can be sent before the whole tree has been seen.
+    """
+    pending = [(folder, name, 0)]
+    while pending:
+        directory, prefix, depth = pending.pop()
+        with os.scandir(directory) as it:
+            for entry in it:
+                relative = f"{prefix}/{entry.name}"
+                if entry.is_dir(follow_symlinks=False):
+                    if depth < max_depth:
+                        pending.append((entry.path, relative, depth + 1))
+                elif entry.is_file() and not is_partial_file(entry.name):
+                    yield entry.path, relative
+
+
+def preallocate(fd, size):
+    """Reserve size bytes for a file so parallel writes do not fragment it"""
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass  # e.g. not supported by the filesystem
+    os.ftruncate(fd, size)
+
+
+def write_at(fd, data, offset):
+    """Write all of data at offset without moving a shared file position"""
+    while data:
+        if hasattr(os, 'pwrite'):
+            n = os.pwrite(fd, data, offset)
+        else:
+            with _write_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                n = os.write(fd, data)
+        data = data[n:]
+        offset += n
+
+
 class ClientGUI:
     def __init__(self, root):
         self.set_dpi_awareness()
         self.root = root
-        self.client = Client(gui_callback=self.gui_callback)
+        # The client calls back from its transfer threads; events reach the widgets through the bus
+        self.events = ProgressBus(source=current_transfer_id)
+        self.client = Client(gui_callback=self.events.post)
+        self.upload_title = ""
+        self.download_title = ""
+        self.activity = ActivityLog()
         self.setup_ui()
+        self.drain_events()
     
     def set_dpi_awareness(self):
         """Set DPI awareness for clear rendering"""
@@ -412,6 +1391,11 @@ class ClientGUI:
                  bordercolor=[('focus', self.colors['accent']),
                             ('!focus', self.colors['border'])])
         
+        style.configure('TCheckbutton',
+                       background=self.colors['bg_secondary'],
+                       foreground=self.colors['text_secondary'],
+                       font=('SF Pro Text', 11))
+        
         # LabelFrame styles
         style.configure('TLabelframe',
                        background=self.colors['bg'],
@@ -521,33 +1505,52 @@ class ClientGUI:
                                         style='Action.TButton', width=12, state='disabled')
         self.disconnect_btn.grid(row=5, column=0, sticky=(tk.W, tk.E))
         
+        self.compress_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(form_frame, text="Compress transfers", variable=self.compress_var,
+                        command=self.toggle_compression).grid(row=6, column=0, sticky=tk.W, pady=(15, 0))
+        
+        self.small_first_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(form_frame, text="Small files first", variable=self.small_first_var,
+                        command=self.toggle_small_first).grid(row=7, column=0, sticky=tk.W, pady=(8, 0))
+        
+        self.checksum_var = tk.BooleanVar(value=self.client.verify_checksums)
+        ttk.Checkbutton(form_frame, text="Verify checksums", variable=self.checksum_var,
+                        command=self.toggle_checksums).grid(row=8, column=0, sticky=tk.W, pady=(8, 0))
+        
+        ttk.Label(form_frame, text="Parallel transfers", style='Caption.TLabel').grid(row=9, column=0, sticky=tk.W,
+                                                                                   pady=(15, 5))
+        self.parallel_var = tk.IntVar(value=self.client.transfers.max_parallel)
+        ttk.Spinbox(form_frame, from_=1, to=8, width=4, textvariable=self.parallel_var,
+                    command=self.set_parallelism).grid(row=10, column=0, sticky=tk.W)
+        
         # Right panel - File operations
         files_frame = ttk.LabelFrame(content_frame, text="Server Files", padding=15)
         files_frame.grid(row=0, column=1, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(0, 15))
         files_frame.columnconfigure(0, weight=1)
         files_frame.rowconfigure(1, weight=1)
         
-        # File list with custom styling
-        file_list_container = ttk.Frame(files_frame, relief='flat', borderwidth=1)
-        file_list_container.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(10, 0))
-        file_list_container.columnconfigure(0, weight=1)
-        file_list_container.rowconfigure(0, weight=1)
-        
-        # File treeview
-        columns = ('name', 'size', 'modified')
-        self.file_tree = ttk.Treeview(file_list_container, columns=columns, show='headings', height=8)
-        self.file_tree.heading('name', text='Name')
-        self.file_tree.heading('size', text='Size')
-        self.file_tree.heading('modified', text='Modified')
+        # Filter for the file list
+        filter_frame = ttk.Frame(files_frame)
+        filter_frame.grid(row=0, column=0, sticky=(tk.W, tk.E))
+        filter_frame.columnconfigure(1, weight=1)
+        
+        ttk.Label(filter_frame, text="Filter", style='Caption.TLabel').grid(row=0, column=0, sticky=tk.W, padx=(0, 8))
+        self.filter_entry = ttk.Entry(filter_frame, font=('SF Pro Text', 12))
+        self.filter_entry.grid(row=0, column=1, sticky=(tk.W, tk.E))
+        self.filter_entry.bind('<Return>', lambda e: self.apply_filter())
+        
+        # File list, with Treeview items only for the rows on screen
+        self.file_model = FileColumns()
+        self.file_view = FileListView(files_frame, self.file_model, self.file_row, on_near_end=self.load_more_files)
+        self.file_view.frame.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(10, 0))
+        
+        self.file_tree = self.file_view.tree
+        self.file_tree.heading('name', text='Name', command=lambda: self.sort_files('name'))
+        self.file_tree.heading('size', text='Size', command=lambda: self.sort_files('size'))
+        self.file_tree.heading('modified', text='Modified', command=lambda: self.sort_files('modified'))
         self.file_tree.column('name', width=200, minwidth=150)
         self.file_tree.column('size', width=80, minwidth=60)
         self.file_tree.column('modified', width=120, minwidth=100)
-        self.file_tree.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
-        
-        # Scrollbar for file tree
-        scrollbar = ttk.Scrollbar(file_list_container, orient=tk.VERTICAL, command=self.file_tree.yview)
-        self.file_tree.configure(yscrollcommand=scrollbar.set)
-        scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
         
         # File action buttons
         action_frame = ttk.Frame(files_frame)
@@ -565,6 +1568,14 @@ class ClientGUI:
                                     style='Action.TButton', state='disabled')
         self.upload_btn.grid(row=0, column=2, padx=8)
         
+        self.download_folder_btn = ttk.Button(action_frame, text="Download Folder", command=self.download_folder,
+                                             style='Action.TButton', state='disabled')
+        self.download_folder_btn.grid(row=0, column=3, padx=8)
+        
+        self.upload_folder_btn = ttk.Button(action_frame, text="Upload Folder", command=self.upload_folder,
+                                           style='Action.TButton', state='disabled')
+        self.upload_folder_btn.grid(row=0, column=4, padx=8)
+        
         # Progress area
         progress_frame = ttk.Frame(content_frame)
         progress_frame.grid(row=1, column=1, sticky=(tk.W, tk.E), pady=(0, 15))
@@ -580,14 +1591,27 @@ class ClientGUI:
         self.download_progress = ttk.Progressbar(progress_frame, mode='determinate')
         self.download_progress.grid(row=3, column=0, sticky=(tk.W, tk.E))
         
+        self.queue_label = ttk.Label(progress_frame, text="", style='Caption.TLabel')
+        self.queue_label.grid(row=4, column=0, sticky=tk.W, pady=(5, 0))
+        
         # Activity log
         log_frame = ttk.LabelFrame(content_frame, text="Activity", padding=15)
         log_frame.grid(row=2, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(15, 0))
         log_frame.columnconfigure(0, weight=1)
-        log_frame.rowconfigure(0, weight=1)
+        
+        log_options = ttk.Frame(log_frame)
+        log_options.grid(row=0, column=0, sticky=(tk.W, tk.E), pady=(0, 8))
+        ttk.Label(log_options, text="Show", style='Caption.TLabel').grid(row=0, column=0, sticky=tk.W, padx=(0, 8))
+        self.log_filter = ttk.Combobox(log_options, values=list(LOG_FILTERS), state='readonly', width=18)
+        self.log_filter.current(0)
+        self.log_filter.grid(row=0, column=1, sticky=tk.W)
+        self.log_filter.bind('<<ComboboxSelected>>', lambda e: self.set_log_level())
+        self.log_file_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(log_options, text="Save to file", variable=self.log_file_var,
+                        command=self.toggle_log_file).grid(row=0, column=2, sticky=tk.W, padx=(15, 0))
         
         log_container = ttk.Frame(log_frame, relief='flat', borderwidth=1)
-        log_container.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        log_container.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         log_container.columnconfigure(0, weight=1)
         log_container.rowconfigure(0, weight=1)
         
@@ -599,7 +1623,7 @@ class ClientGUI:
         # Configure weights for expansion
         content_frame.rowconfigure(2, weight=1)
         files_frame.rowconfigure(1, weight=1)
-        log_frame.rowconfigure(0, weight=1)
+        log_frame.rowconfigure(1, weight=1)
         
         # Bind events
         self.file_tree.bind('<Double-1>', lambda e: self.show_file_info())
@@ -616,38 +1640,74 @@ class ClientGUI:
         self.log_text.tag_config("error", foreground=self.colors['error'])
         self.log_text.tag_config("server", foreground=self.colors['accent'])
     
+    def drain_events(self):
+        """Apply the client's queued events to the widgets, PROGRESS_RATE times a second"""
+        self.events.drain(self.gui_callback)
+        self.flush_log()
+        self.root.after(1000 // PROGRESS_RATE, self.drain_events)
+    
     def gui_callback(self, callback_type, data, log_type=None):
-        """Handle callbacks from client"""
+        """Handle callbacks from client, on the Tk thread"""
         if callback_type == "log":
             self.log(data, log_type)
         elif callback_type == "status":
             self.update_status(data)
         elif callback_type == "file_list":
             self.update_file_list(data)
+        elif callback_type == "file_changes":
+            self.apply_file_changes(data)
         elif callback_type == "file_info":
             self.show_file_info_dialog(data)
+        elif callback_type == "dir_list":
+            self.log(f"{data['path'] or '.'}/: {len(data['dirs'])} folders, {len(data['files'])} files")
         elif callback_type in ["upload_start", "upload_progress", "upload_complete", 
                               "download_start", "download_progress", "download_complete"]:
             self.update_progress(callback_type, data)
+        elif callback_type == "transfers":
+            self.update_queue(data)
     
     def log(self, message, log_type="info"):
-        """Add message to log with clean formatting"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        formatted = f"[{timestamp}] {message}\n"
-        
-        # Capture start index before inserting, then tag inserted range
-        start_index = self.log_text.index("end-1c")
-        self.log_text.insert(tk.END, formatted)
-        end_index = self.log_text.index("end-1c")
-        
-        # Add tag for the newly inserted text
-        try:
-            self.log_text.tag_add(log_type, start_index, end_index)
-        except Exception:
-            pass
-        
+        """Add message to the activity log; it is shown with the next batch"""
+        self.activity.add(message, log_type)
+    
+    def flush_log(self):
+        """Show the messages logged since the last flush, in one insert, keeping at most LOG_CAPACITY lines"""
+        entries = self.activity.take_pending()
+        if not entries:
+            return
+        # Follow new messages only if the log is scrolled to the end
+        at_end = self.log_text.yview()[1] >= 1.0
+        self.insert_log(entries)
+        lines = int(self.log_text.index("end-1c").split('.')[0]) - 1
+        if lines > LOG_CAPACITY:
+            self.log_text.delete("1.0", f"{lines - LOG_CAPACITY + 1}.0")
+        if at_end:
+            self.log_text.see(tk.END)
+    
+    def insert_log(self, entries):
+        chunks = []
+        for entry in entries:
+            chunks += [entry.format(), entry.level]
+        self.log_text.insert(tk.END, *chunks)
+    
+    def set_log_level(self):
+        """Show only the messages of the chosen level and above"""
+        entries = self.activity.set_level(LOG_FILTERS[self.log_filter.get()])
+        self.log_text.delete("1.0", tk.END)
+        self.insert_log(entries)
         self.log_text.see(tk.END)
     
+    def toggle_log_file(self):
+        """Start or stop saving the activity log to LOG_FILE"""
+        try:
+            self.activity.spill_to(LOG_FILE if self.log_file_var.get() else None)
+        except OSError as e:
+            self.log_file_var.set(False)
+            self.log(f"Cannot save the log: {e}", "error")
+            return
+        if self.log_file_var.get():
+            self.log(f"Saving the activity log to {os.path.abspath(LOG_FILE)}", "info")
+    
     def update_status(self, status):
         """Update connection status with visual indicator"""
         self.status_label.config(text=status)
@@ -660,6 +1720,8 @@ class ClientGUI:
             self.refresh_btn.config(state='normal')
             self.download_btn.config(state='normal')
             self.upload_btn.config(state='normal')
+            self.download_folder_btn.config(state='normal')
+            self.upload_folder_btn.config(state='normal')
         else:
             color = self.colors['text_secondary']
             self.status_indicator.config(foreground=color)
@@ -668,38 +1730,107 @@ class ClientGUI:
             self.refresh_btn.config(state='disabled')
             self.download_btn.config(state='disabled')
             self.upload_btn.config(state='disabled')
+            self.download_folder_btn.config(state='disabled')
+            self.upload_folder_btn.config(state='disabled')
     
-    def update_file_list(self, file_list):
-        """Update file list in treeview"""
-        for item in self.file_tree.get_children():
-            self.file_tree.delete(item)
-        
-        for i, file_info in enumerate(file_list):
-            name = file_info['name']
-            size = self.client.format_file_size(file_info['size'])
-            modified = datetime.fromtimestamp(file_info['modified']).strftime('%m/%d/%Y %H:%M')
-            self.file_tree.insert('', 'end', values=(name, size, modified), tags=(str(i),))
+    def update_file_list(self, page):
+        """Show a newly loaded page of the file list"""
+        if page['offset'] == 0:
+            self.file_model.load(page['files'])
+            if not self.listing_loaded():
+                # A partial listing comes sorted and filtered by the server
+                self.file_model.arrange(None)
+        else:
+            self.file_model.extend(page['files'])
+        self.file_view.refresh()
+    
+    def apply_file_changes(self, changes):
+        """Show the file list with added, modified and removed files applied"""
+        self.file_model.apply(changes['dropped'], changes['updated'], changes['rows'])
+        self.file_view.refresh()
+    
+    def file_row(self, name, size, modified):
+        """Treeview column values for a file, formatted when its row is first shown"""
+        return (name, self.client.format_file_size(size),
+                datetime.fromtimestamp(modified).strftime('%m/%d/%Y %H:%M'))
+    
+    def load_more_files(self):
+        """Fetch the next page of the file list as the view nears the end of the loaded rows"""
+        if self.client.connected:
+            self.client.fetch_next_page()
     
     def update_progress(self, callback_type, data):
         """Update progress bars with clean labels"""
         if callback_type == "upload_start":
             self.upload_progress['value'] = 0
-            self.upload_label.config(text=f"Uploading {data['filename']}")
+            self.upload_title = f"Uploading {data['filename']}"
+            self.upload_label.config(text=self.upload_title)
         elif callback_type == "upload_progress":
-            self.upload_progress['value'] = data['progress'] * 100
+            if data['progress'] is None:
+                self.upload_label.config(text=f"Uploading ({data['files']} files)")
+            else:
+                self.upload_progress['value'] = data['progress'] * 100
+                self.upload_label.config(text=self.progress_text(self.upload_title, data))
         elif callback_type == "upload_complete":
             self.upload_progress['value'] = 100
             self.upload_label.config(text="Upload complete")
         
         elif callback_type == "download_start":
             self.download_progress['value'] = 0
-            self.download_label.config(text=f"Downloading {data['filename']}")
+            self.download_title = f"Downloading {data['filename']}"
+            self.download_label.config(text=self.download_title)
         elif callback_type == "download_progress":
-            self.download_progress['value'] = data['progress'] * 100
+            if data['progress'] is None:
+                self.download_label.config(text=f"Downloading ({data['files']} files)")
+            else:
+                self.download_progress['value'] = data['progress'] * 100
+                self.download_label.config(text=self.progress_text(self.download_title, data))
         elif callback_type == "download_complete":
             self.download_progress['value'] = 100
             self.download_label.config(text="Download complete")
     
+    def update_queue(self, data):
+        """Show how many transfers are running and waiting"""
+        if not data['running'] and not data['queued']:
+            self.queue_label.config(text="")
+            return
+        text = f"{data['running']} running, {data['queued']} queued"
+        if data['pending']:
+            text += f" · next: {data['pending'][0]['name']}"
+        self.queue_label.config(text=text)
+    
+    def progress_text(self, title, data):
+        """Progress label with the transfer speed, the speed on the wire when compressed,
+        and the total speed when several transfers run"""
+        if 'speed' not in data:
+            return title
+        text = f"{title} · {self.client.format_file_size(data['speed'])}/s"
+        wire_speed = data.get('wire_speed')
+        if wire_speed and data['speed'] > wire_speed * 1.05:
+            text += f" ({self.client.format_file_size(wire_speed)}/s on the wire)"
+        if data.get('active_transfers', 0) > 1:
+            text += f" · {data['active_transfers']} at {self.client.format_file_size(data['total_speed'])}/s"
+        return text
+    
+    def toggle_compression(self):
+        """Offer compressed transfers to the server, or stop doing so"""
+        self.client.compression = list(COMPRESSION_CODECS) if self.compress_var.get() else []
+    
+    def toggle_checksums(self):
+        """End every transfer with a checksum trailer checked before the file is kept, or stop doing so"""
+        self.client.verify_checksums = self.checksum_var.get()
+    
+    def toggle_small_first(self):
+        """Start the smallest waiting transfers first, or start them in the order they were queued"""
+        self.client.transfers.set_small_first(self.small_first_var.get())
+    
+    def set_parallelism(self):
+        """Change how many transfers run at once"""
+        try:
+            self.client.transfers.set_parallelism(self.parallel_var.get())
+        except (tk.TclError, ValueError):
+            pass
+    
     def connect_server(self):
         """Connect to server"""
         host = self.host_entry.get().strip()
@@ -732,27 +1863,61 @@ class ClientGUI:
     def refresh_files(self):
         """Refresh file list"""
         if self.client.connected:
-            self.client.list_files()
+            self.client.refresh_file_list()
         else:
             messagebox.showerror("Error", "Not connected to server")
     
+    def listing_loaded(self):
+        """Whether the whole unfiltered file list is loaded, so it can be sorted and filtered locally"""
+        client = self.client
+        return (client.generation is not None and not client.list_query['pattern'] and
+                len(client.file_list) >= client.list_total)
+    
+    def sort_files(self, key):
+        """Sort the file list by a column, toggling the direction on repeated clicks"""
+        model = self.file_model
+        query = self.client.list_query
+        if model.sort is not None:
+            reverse = not model.reverse if model.sort == key else False
+        else:
+            reverse = not query['reverse'] if query['sort'] == key else False
+        if self.listing_loaded():
+            model.arrange(key, reverse, model.pattern)
+            self.file_view.refresh()
+        elif self.client.connected:
+            model.arrange(None)
+            self.client.set_list_query(sort=key, reverse=reverse)
+        else:
+            query.update(sort=key, reverse=reverse)
+    
+    def apply_filter(self):
+        """Show only the files whose names match the filter (prefix or glob)"""
+        pattern = self.filter_entry.get().strip()
+        model = self.file_model
+        if self.listing_loaded():
+            model.arrange(model.sort, model.reverse, pattern)
+            self.file_view.refresh()
+        elif self.client.connected:
+            model.arrange(None)
+            self.client.set_list_query(pattern=pattern)
+        else:
+            self.client.list_query['pattern'] = pattern
+    
     def show_file_info(self):
         """Show file information on double-click"""
-        selection = self.file_tree.selection()
+        selection = self.file_view.selection()
         if not selection:
             return
         
-        item = self.file_tree.item(selection[0])
-        tags = item['tags']
-        if tags:
-            file_index = int(tags[0])
-            self.client.get_file_info(file_index)
+        file_info = self.client.files_by_name.get(selection[0])
+        if file_info:
+            self.client.get_file_info(file_info['id'])
     
     def show_file_info_dialog(self, file_info):
         """Show file info in a clean dialog"""
         info_window = tk.Toplevel(self.root)
         info_window.title("File Information")
-        info_window.geometry("400x220")
+        info_window.geometry("400x300")
         info_window.configure(bg=self.colors['bg'])
         info_window.transient(self.root)
         info_window.resizable(False, False)
@@ -769,6 +1934,10 @@ class ClientGUI:
         ttk.Label(info_frame, text="File Information", style='Subtitle.TLabel').pack(pady=(0, 20))
         
         info_text = f"Name: {file_info['name']}\n\nSize: {self.client.format_file_size(file_info['size'])}\n\nModified: {datetime.fromtimestamp(file_info['modified']).strftime('%B %d, %Y at %H:%M')}"
+        if file_info.get('blake2b'):
+            info_text += f"\n\nBLAKE2b: {file_info['blake2b'][:32]}\n{file_info['blake2b'][32:]}"
+        elif file_info.get('hash_pending'):
+            info_text += "\n\nBLAKE2b: being computed"
         
         ttk.Label(info_frame, text=info_text, justify=tk.LEFT, style='TLabel').pack(anchor=tk.W)
         
@@ -777,34 +1946,64 @@ class ClientGUI:
     
     def download_file(self):
         """Download selected file"""
-        selection = self.file_tree.selection()
+        selection = self.file_view.selection()
         if not selection:
             messagebox.showwarning("Warning", "Please select a file first")
             return
         
-        item = self.file_tree.item(selection[0])
-        tags = item['tags']
-        if tags:
-            file_index = int(tags[0])
-            self.client.download_file(file_index)
+        if len(selection) > 1:
+            # Several files at once are streamed in a single batch
+            file_ids = [self.client.files_by_name[name]['id'] for name in selection
+                        if name in self.client.files_by_name]
+            self.client.queue_download_batch(file_ids)
+            return
+        
+        file_info = self.client.files_by_name.get(selection[0])
+        if file_info:
+            self.client.queue_download(file_info['id'])
     
     def upload_file(self):
-        """Upload file with clean file dialog"""
+        """Upload files with clean file dialog, each queued as a transfer of its own"""
         if not self.client.connected:
             messagebox.showerror("Error", "Not connected to server")
             return
         
-        filepath = filedialog.askopenfilename(
-            title="Select file to upload",
+        filepaths = filedialog.askopenfilenames(
+            title="Select files to upload",
             filetypes=[("All files", "*.*")]
         )
         
-        if filepath:
-            threading.Thread(target=self.client.upload_file, args=(filepath,), daemon=True).start()
+        for filepath in filepaths:
+            self.client.queue_upload(filepath)
+    
+    def download_folder(self):
+        """Download a server folder, by default the one holding the selected file"""
+        if not self.client.connected:
+            messagebox.showerror("Error", "Not connected to server")
+            return
+        
+        selection = self.file_view.selection()
+        initial = selection[0].rpartition('/')[0] if selection else ''
+        path = simpledialog.askstring("Download Folder", "Folder on the server (empty for everything):",
+                                      initialvalue=initial, parent=self.root)
+        if path is not None:
+            self.client.queue_download_folder(path.strip())
+    
+    def upload_folder(self):
+        """Upload a folder and its subfolders"""
+        if not self.client.connected:
+            messagebox.showerror("Error", "Not connected to server")
+            return
+        
+        folder = filedialog.askdirectory(title="Select folder to upload")
+        if folder:
+            self.client.queue_upload_folder(folder)
 
 
 def main():
     """Main function"""
+    if tk is None:
+        sys.exit("tkinter is not available; use cli.py to transfer files without the GUI")
     root = tk.Tk()
     try:
         if platform.system() == "Windows":
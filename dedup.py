@@ -0,0 +1,45 @@
+"""Deduplication of uploads whose content is already in the shared space.
+
+A client may name the blake2b digest of the file it is about to upload.
+If a file with that content exists, the server creates the upload from
+it without receiving any data: as a copy-on-write clone where the file
+system supports it (Btrfs, XFS), else as a hard link. Either way the
+duplicate takes no extra disk space. The server only ever replaces files
+by renaming a new file into place, never writes into them, so a hard
+link cannot be changed through the other name by an upload.
+"""
+import os
+import sys
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Smaller files are cheaper to send than to hash
+DEDUP_MIN_SIZE = 1024 * 1024
+# Files of the right size whose digest is looked up, and queued for hashing
+# if unknown, when none is known to have the content yet
+DEDUP_CANDIDATES = 4
+# ioctl cloning a whole file on Linux
+FICLONE = 0x40049409
+
+
+def clone_file(source, target, link=True):
+    """Create target with the content of source without copying it, return how.
+
+    Without link only a copy-on-write clone will do, as it can be given a
+    modification time of its own; None if the file system cannot make one.
+    """
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError:
+            if os.path.lexists(target):
+                os.remove(target)
+    if not link:
+        return None
+    os.link(source, target)
+    return 'hardlink'
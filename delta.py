@@ -0,0 +1,251 @@
+"""Delta transfer of a modified file against the copy the receiver already has.
+
+The receiver cuts its copy into blocks and sends a signature for each: a
+weak checksum (adler32) and a strong one (16-byte blake2b). The sender
+slides a window over its own file looking for blocks with a matching
+signature, as rsync does, and streams a delta: a run of DATA frames each
+holding one instruction, either "copy these blocks of your copy" or
+"write these literal bytes", ending with an empty DATA frame. Only the
+changed parts of the file travel over the wire.
+
+The weak checksum of the next window can be rolled forward one byte at a
+time, but in Python that costs far more than hashing a whole block in C.
+Blocks are therefore first tried at the offset where the last match
+ended. After a miss the following offsets are rolled through one byte at
+a time, up to one block further on, and matching resumes at the next
+block boundary of the file. That byte by byte search is bounded per file
+(ROLL_BUDGET); once spent, a miss costs one block digest, and the rest of
+the file is only matched at block boundaries, which still finds every
+block of an in-place edit. Content shifted by an insertion after that
+point goes as literals.
+"""
+import hashlib
+import math
+import struct
+import zlib
+
+from protocol import FRAME_DATA, ProtocolError
+
+# Block sizes are about the square root of the file size, within these bounds
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+# Files smaller than this are always sent whole
+DELTA_MIN_SIZE = 1024 * 1024
+# Weak checksum and strong digest of each block
+SIGNATURE = struct.Struct('!I16s')
+STRONG_DIGEST_SIZE = 16
+# Instructions: copy a run of blocks, or literal bytes
+OP_COPY = b'C'
+OP_DATA = b'D'
+COPY_OP = struct.Struct('!cQQ')
+LITERAL_SIZE = 1024 * 1024
+MAX_OP_SIZE = 1 + LITERAL_SIZE
+# Bytes of the sender's file read at a time
+READ_SIZE = 4 * 1024 * 1024
+# Window positions tried one byte at a time per file
+ROLL_BUDGET = 8 * 1024 * 1024
+ADLER_MOD = 65521
+
+
+def block_size_for(size):
+    """Block size for signing a file of size bytes"""
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, math.isqrt(size) // 1024 * 1024))
+
+
+def strong_digest(data):
+    return hashlib.blake2b(data, digest_size=STRONG_DIGEST_SIZE).digest()
+
+
+def file_signatures(f, block_size):
+    """Signatures of every block of f, packed back to back"""
+    signatures = []
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        signatures.append(SIGNATURE.pack(zlib.adler32(block), strong_digest(block)))
+    return b''.join(signatures)
+
+
+def signature_table(data):
+    """Map weak checksum -> {strong digest: block index} for packed signatures"""
+    if len(data) % SIGNATURE.size:
+        raise ProtocolError("Malformed block signatures")
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(data)):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+
+def roll(buf, position, size, steps, value, table):
+    """Slide the size byte window at position forward up to steps bytes.
+
+    value is the adler32 of the window at position. Returns the first later
+    position whose window has a weak checksum in table, or None.
+    """
+    a = value & 0xffff
+    b = value >> 16
+    for j in range(position, position + steps):
+        out = buf[j]
+        a = (a - out + buf[j + size]) % ADLER_MOD
+        b = (b - size * out + a - 1) % ADLER_MOD
+        if (b << 16 | a) in table:
+            return j + 1
+    return None
+
+
+class DeltaEncoder:
+    """Turns a file into delta instructions against a table of block signatures"""
+
+    def __init__(self, f, block_size, table, checksum=None, roll_budget=ROLL_BUDGET):
+        self.f = f
+        self.block_size = block_size
+        self.table = table
+        self.checksum = checksum
+        self.roll_budget = roll_budget
+        # Bytes of the file matched and sent as literals
+        self.copied = 0
+        self.literal = 0
+
+    def match(self, window):
+        """Index of a block identical to window, or None"""
+        candidates = self.table.get(zlib.adler32(window))
+        return candidates and candidates.get(strong_digest(window))
+
+    def search(self, buf, position, steps):
+        """First position after position, at most steps on, where a block matches"""
+        size = self.block_size
+        end = position + steps
+        while position < end:
+            found = roll(buf, position, size, end - position, zlib.adler32(buf[position:position + size]),
+                         self.table)
+            if found is None:
+                return None
+            if self.match(buf[found:found + size]) is not None:
+                return found
+            position = found
+        return None
+
+    def ops(self):
+        """Yield (instruction payload, bytes of the file covered so far)"""
+        size = self.block_size
+        buf = b''
+        start = 0      # Offset in the file of buf[0]
+        i = 0          # Next byte of buf to match
+        literal = 0    # Start of the literal bytes not yet sent
+        copy = None    # [first block, count] of the matched run not yet sent
+        eof = False
+        while True:
+            # Keep a block to match and a block to roll into buffered
+            if not eof and len(buf) - i < 2 * size:
+                data = self.f.read(max(READ_SIZE, 2 * size))
+                if not data:
+                    eof = True
+                elif self.checksum is not None:
+                    self.checksum.update(data)
+                buf = buf[literal:] + data
+                start += literal
+                i -= literal
+                literal = 0
+            window = buf[i:i + size]
+            if not window:
+                break
+            index = self.match(window)
+            if index is not None:
+                if literal < i:
+                    yield from self.literals(buf, literal, i, start + i)
+                if copy and copy[0] + copy[1] == index:
+                    copy[1] += 1
+                else:
+                    if copy:
+                        yield COPY_OP.pack(OP_COPY, *copy), start + i
+                    copy = [index, 1]
+                self.copied += len(window)
+                i += len(window)
+                literal = i
+                continue
+
+            if copy:
+                yield COPY_OP.pack(OP_COPY, *copy), start + i
+                copy = None
+            # Try every offset up to a block further on, then give up on this block
+            steps = min(size, len(buf) - i - size, self.roll_budget)
+            found = self.search(buf, i, steps) if steps > 0 else None
+            if found is not None:
+                self.roll_budget -= found - i
+                i = found
+            else:
+                self.roll_budget -= max(steps, 0)
+                # Carry on from the first block boundary of the file not tried yet, where
+                # the blocks of an in-place edit line up with the receiver's
+                position = start + i + max(steps, 0) + 1
+                i = -(-position // size) * size - start
+            if i - literal >= LITERAL_SIZE:
+                end = literal + (i - literal) // LITERAL_SIZE * LITERAL_SIZE
+                yield from self.literals(buf, literal, end, start + i)
+                literal = end
+        if copy:
+            yield COPY_OP.pack(OP_COPY, *copy), start + i
+        if literal < len(buf):
+            yield from self.literals(buf, literal, len(buf), start + len(buf))
+
+    def literals(self, buf, begin, end, position):
+        """Yield buf[begin:end] as literal instructions"""
+        self.literal += end - begin
+        for offset in range(begin, end, LITERAL_SIZE):
+            yield OP_DATA + buf[offset:min(offset + LITERAL_SIZE, end)], position
+
+
+def send_delta(conn, encoder, progress=None):
+    """Send a file as delta instructions, return (raw, wire) bytes sent.
+
+    progress, if given, is called with the running raw and wire totals.
+    """
+    raw_size = wire_size = 0
+    with conn.send_lock:
+        for op, raw_size in encoder.ops():
+            conn.send_frame(FRAME_DATA, op)
+            wire_size += len(op)
+            if progress:
+                progress(raw_size, wire_size)
+        conn.send_frame(FRAME_DATA)
+    return raw_size, wire_size
+
+
+def decode_op(payload):
+    """Decode an instruction into (OP_COPY, first block, count) or (OP_DATA, bytes)"""
+    if payload[:1] == OP_DATA:
+        return OP_DATA, payload[1:]
+    if payload[:1] == OP_COPY and len(payload) == COPY_OP.size:
+        return COPY_OP.unpack(payload)
+    raise ProtocolError("Malformed delta instruction")
+
+
+def read_delta(conn):
+    """Yield the decoded instructions of a delta stream until its end frame"""
+    while True:
+        frame = conn.read_frame()
+        if frame is None:
+            raise ConnectionError("connection closed during the transfer")
+        if frame.type != FRAME_DATA or frame.length > MAX_OP_SIZE:
+            raise ProtocolError("Expected a delta instruction")
+        if not frame.length:
+            return
+        yield decode_op(conn.read_exact(frame.length))
+
+
+def copy_blocks(base, f, block_size, first, count, checksum=None):
+    """Append count blocks of base from block first to f, return the bytes copied"""
+    base.seek(first * block_size)
+    remaining = count * block_size
+    copied = 0
+    while remaining:
+        data = base.read(min(READ_SIZE, remaining))
+        if not data:
+            break
+        f.write(data)
+        if checksum is not None:
+            checksum.update(data)
+        remaining -= len(data)
+        copied += len(data)
+    return copied
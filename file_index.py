@@ -0,0 +1,451 @@
+"""In-memory index of the files in the shared space and its subdirectories.
+
+Files are named by their path relative to the shared space, with '/'
+separators. A directory is rescanned only when its mtime changes (entries
+created, deleted or renamed) and the index is otherwise kept current
+incrementally: uploads update their own entry, a background poller checks
+the directories' mtimes every few seconds, and now and then walks the whole
+tree to pick up files modified in place. That walk runs without holding the
+index lock, so requests are not held up by it.
+
+Paginated listings are answered from views sorted by name, size or
+modification time, built once per index generation, so a page costs
+time proportional to its size rather than to the size of the share.
+
+Every change bumps the index generation and is recorded in a bounded change
+log, so a client that knows the generation of its copy of the listing can
+ask for just the entries added, removed or modified since then.
+"""
+import bisect
+import fnmatch
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from resume import is_partial_file
+
+# Seconds between background checks for changed directories
+POLL_INTERVAL = 5.0
+# Seconds between background walks of the whole tree, which catch in-place modifications
+SWEEP_INTERVAL = 60.0
+SORT_KEYS = ('name', 'size', 'modified')
+# Number of filtered/sorted result lists kept for paging through
+QUERY_CACHE_SIZE = 16
+# Changed names remembered for LIST_CHANGES; older generations need a full listing
+CHANGE_LOG_SIZE = 10000
+# How many levels of subdirectories below the shared space are indexed
+MAX_DEPTH = 32
+# A directory modified this recently may change again without its (coarse
+# grained) mtime changing, so it is rescanned on the next refresh regardless
+RACY_MTIME_NS = 2 * 10 ** 9
+
+
+def normalize_path(path):
+    """Check a relative path received from a peer, return it in 'a/b' form.
+
+    '' stands for the shared space itself. Raises ValueError for absolute
+    paths and paths that would leave the shared space.
+    """
+    path = path.replace('\\', '/')
+    if path.startswith('/') or os.path.splitdrive(path)[0]:
+        raise ValueError(f"Invalid path: {path}")
+    parts = [part for part in path.split('/') if part not in ('', '.')]
+    if '..' in parts:
+        raise ValueError(f"Invalid path: {path}")
+    return '/'.join(parts)
+
+
+def scanned_mtime(path):
+    """mtime_ns to record for a directory about to be scanned, None if too recent to rely on"""
+    mtime = os.stat(path).st_mtime_ns
+    return None if time.time_ns() - mtime < RACY_MTIME_NS else mtime
+
+
+def parent_dir(name):
+    """The directory part of a relative path, '' at the top level"""
+    return name.rpartition('/')[0]
+
+
+def file_id(name, stat):
+    """Stable id of a file: the same as long as the file is not replaced or renamed"""
+    key = f"{stat.st_dev}:{stat.st_ino}:{name}".encode('utf-8', 'surrogateescape')
+    return hashlib.blake2b(key, digest_size=8).hexdigest()
+
+
+def matches_pattern(name, pattern):
+    """Check a name against a listing filter: a glob, or a prefix if it has no wildcards"""
+    if not pattern:
+        return True
+    if any(c in pattern for c in '*?['):
+        return fnmatch.fnmatchcase(name, pattern)
+    return name.startswith(pattern)
+
+
+class FileIndex:
+    def __init__(self, root=None, poll_interval=POLL_INTERVAL, max_depth=MAX_DEPTH, sweep_interval=SWEEP_INTERVAL):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.sweep_interval = sweep_interval
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+        self.entries = {}
+        # File id -> name
+        self.ids = {}
+        # Entries sorted by name; replaced, never mutated, so readers can hold on to it
+        self.files = []
+        # Incremented on every change
+        self.generation = 0
+        # Change log: generation of each change, and (name, existed before) for it
+        self.change_generations = []
+        self.change_log = []
+        # Oldest generation LIST_CHANGES can still answer from
+        self.change_floor = 0
+        # Indexed directories ('' is the root) -> mtime_ns when last scanned,
+        # None for a directory to rescan on the next refresh
+        self.dirs = {}
+        self.query_cache = OrderedDict()
+        self.poller = None
+        self.poller_stop = threading.Event()
+        # Called with no arguments after every change
+        self.listeners = []
+
+    def set_root(self, root):
+        self.root = root
+        self.refresh(force=True)
+
+    def path(self, name):
+        """Local path of a file or directory in the index"""
+        return os.path.join(self.root, *name.split('/')) if name else self.root
+
+    def walk(self, top, entries, dirs, known=()):
+        """Scan top and the directories below it into entries and dirs.
+
+        The tree is walked one directory at a time with os.scandir, stating
+        every file once. Directories in known are left out, as they are
+        checked on their own. Returns the subdirectories found directly in top.
+        """
+        found = []
+        pending = [top]
+        while pending:
+            current = pending.pop()
+            prefix = current + '/' if current else ''
+            depth = current.count('/') + 1 if current else 0
+            try:
+                # Take the mtime before scanning so changes during the scan trigger another one
+                dirs[current] = scanned_mtime(self.path(current))
+                with os.scandir(self.path(current)) as it:
+                    for entry in it:
+                        name = prefix + entry.name
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if current == top:
+                                    found.append(name)
+                                if depth < self.max_depth and name not in known:
+                                    pending.append(name)
+                            elif entry.is_file() and not is_partial_file(entry.name):
+                                entries[name] = make_entry(name, entry.stat())
+                        except OSError:
+                            pass  # Removed while scanning
+            except OSError:
+                # Removed while scanning; its parent's mtime changed, so it is seen next time
+                dirs.pop(current, None)
+        return found
+
+    def changed_dirs(self):
+        """Indexed directories whose mtime differs from when they were scanned"""
+        changed = []
+        for name, mtime in list(self.dirs.items()):
+            try:
+                current = os.stat(self.path(name)).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime:
+                changed.append(name)
+        return changed
+
+    def rescan(self, changed):
+        """Rescan the given directories, return the new (entries, dirs)"""
+        entries = dict(self.entries)
+        dirs = dict(self.dirs)
+        # Parents first, so a removed tree is dropped before its subdirectories are visited
+        for name in sorted(changed, key=lambda d: d.count('/') if d else -1):
+            if name not in dirs:
+                continue
+            for entry in self.subtree(name):
+                if parent_dir(entry['name']) == name:
+                    entries.pop(entry['name'], None)
+            children = [d for d in dirs if d and parent_dir(d) == name]
+            found = set(self.walk(name, entries, dirs, known=dirs.keys() - {name}))
+            if name not in dirs:
+                found = ()
+            for child in children:
+                if child not in found:
+                    self.remove_tree(child, entries, dirs)
+            if name not in dirs:
+                self.remove_tree(name, entries, dirs)
+        return entries, dirs
+
+    def remove_tree(self, top, entries, dirs):
+        """Drop a directory and everything below it from entries and dirs"""
+        prefix = top + '/'
+        for name in [name for name in entries if name.startswith(prefix)]:
+            del entries[name]
+        for name in [name for name in dirs if name == top or name.startswith(prefix)]:
+            del dirs[name]
+
+    def refresh(self, force=False):
+        """Bring the index up to date, return True if anything changed.
+
+        Unless forced only directories whose mtime changed are rescanned, so
+        an unchanged tree costs a single stat per directory. A forced refresh
+        sweeps the whole tree, see sweep.
+        """
+        if not self.root or not os.path.isdir(self.root):
+            with self.lock:
+                changed = self.replace({}, {})
+        elif force or not self.dirs:
+            changed = self.sweep()
+        else:
+            if not self.changed_dirs():
+                return False
+            with self.lock:
+                # Re-check under the lock: a concurrent refresh may have done the work
+                stale = self.changed_dirs()
+                if not stale:
+                    return False
+                entries, dirs = self.rescan(stale)
+                changed = self.replace(entries, dirs)
+        if changed:
+            self.notify()
+        return changed
+
+    def sweep(self):
+        """Walk the whole tree and swap the result in, return True if anything changed.
+
+        The walk runs without the lock. Names the index changed meanwhile keep
+        their indexed entries, which may be newer than what the walk saw.
+        """
+        with self.lock:
+            start = self.generation
+        entries, dirs = {}, {}
+        self.walk('', entries, dirs)
+        with self.lock:
+            if start < self.change_floor:
+                return False  # Too many changes meanwhile to tell which; the next sweep retries
+            first = bisect.bisect_right(self.change_generations, start)
+            for name, _ in self.change_log[first:]:
+                entry = self.entries.get(name)
+                if entry is None:
+                    entries.pop(name, None)
+                else:
+                    entries[name] = entry
+            return self.replace(entries, dirs)
+
+    def replace(self, entries, dirs):
+        self.dirs = dirs
+        if entries == self.entries:
+            return False
+        old = self.entries
+        changed = [name for name in old if entries.get(name) != old[name]]
+        changed += [name for name in entries if name not in old]
+        self.entries = entries
+        self.ids = {entry['id']: name for name, entry in entries.items()}
+        self.files = sorted(entries.values(), key=lambda e: e['name'])
+        self.generation += 1
+        self.log_changes((name, name in old) for name in changed)
+        return True
+
+    def log_changes(self, changes):
+        """Record (name, existed before) pairs under the current generation"""
+        for change in changes:
+            self.change_generations.append(self.generation)
+            self.change_log.append(change)
+        if len(self.change_log) > CHANGE_LOG_SIZE:
+            # Drop the oldest half, cutting at a generation boundary
+            cut = len(self.change_log) - CHANGE_LOG_SIZE // 2
+            self.change_floor = self.change_generations[cut - 1]
+            cut = bisect.bisect_right(self.change_generations, self.change_floor)
+            del self.change_generations[:cut]
+            del self.change_log[:cut]
+
+    def update_file(self, name):
+        """Update a single entry after a file was written, without rescanning"""
+        path = self.path(name)
+        with self.lock:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            files = list(self.files)
+            position = bisect.bisect_left(FileNames(files), name)
+            exists = position < len(files) and files[position]['name'] == name
+            if stat is None:
+                if not exists:
+                    return False
+                del files[position]
+                del self.ids[self.entries.pop(name)['id']]
+            else:
+                entry = make_entry(name, stat)
+                if exists:
+                    del self.ids[files[position]['id']]
+                    files[position] = entry
+                else:
+                    files.insert(position, entry)
+                self.entries[name] = entry
+                self.ids[entry['id']] = name
+            self.files = files
+            self.generation += 1
+            self.log_changes([(name, exists)])
+            # The rename also changed the directory's mtime, so the next refresh
+            # rescans it; that finds nothing new unless something else changed too
+        self.notify()
+        return True
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def notify(self):
+        for callback in self.listeners:
+            callback()
+
+    def subtree(self, directory):
+        """Entries of the files in a directory and below it, in name order"""
+        files = self.files
+        if not directory:
+            return files
+        names = FileNames(files)
+        lo = bisect.bisect_left(names, directory + '/')
+        return files[lo:bisect.bisect_left(names, directory + '/\U0010ffff', lo)]
+
+    def list_dir(self, directory):
+        """Return (subdirectories, file entries) directly in a directory, None if it is not indexed"""
+        dirs = self.dirs
+        if directory not in dirs:
+            return None
+        subdirs = sorted(name for name in dirs if name and parent_dir(name) == directory)
+        files = [entry for entry in self.subtree(directory) if parent_dir(entry['name']) == directory]
+        return subdirs, files
+
+    def find(self, file_id):
+        """Name of the file with this id, or None"""
+        return self.ids.get(file_id)
+
+    def query(self, offset=0, limit=None, sort='name', reverse=False, pattern=None):
+        """Return (page, total, generation) for one page of a sorted, optionally filtered listing.
+
+        pattern is a case-sensitive glob (fnmatch) on the file name; a pattern
+        without wildcards matches names starting with it. Each entry in the
+        page carries its 'id' for GET_FILE / FILE_INFO.
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {sort}")
+        with self.lock:
+            generation, files = self.generation, self.files
+            key = (generation, sort, pattern or '')
+            matches = self.query_cache.get(key)
+        if matches is None:
+            matches = self.matching(files, sort, pattern)
+            with self.lock:
+                self.query_cache[key] = matches
+                while len(self.query_cache) > QUERY_CACHE_SIZE:
+                    self.query_cache.popitem(last=False)
+
+        total = len(matches)
+        offset = max(0, offset)
+        end = total if limit is None else min(total, offset + max(0, limit))
+        if reverse:
+            page = matches[max(0, total - end):total - offset][::-1] if offset < total else []
+        else:
+            page = matches[offset:end]
+        return [files[i] for i in page], total, generation
+
+    def matching(self, files, sort, pattern):
+        """Positions in files of the entries matching pattern, ordered by sort key"""
+        # Name order is the order of files itself, so plain ranges need no copy
+        matches = range(len(files))
+        if pattern:
+            # Narrow to the names sharing the pattern's literal prefix, then glob within
+            wildcard = min((i for i, c in enumerate(pattern) if c in '*?['), default=None)
+            prefix = pattern if wildcard is None else pattern[:wildcard]
+            names = FileNames(files)
+            lo = bisect.bisect_left(names, prefix)
+            matches = range(lo, bisect.bisect_left(names, prefix + '\U0010ffff', lo))
+            if wildcard is not None:
+                matches = [i for i in matches if matches_pattern(files[i]['name'], pattern)]
+
+        if sort != 'name':
+            # Ties keep name order, since sorted() is stable
+            matches = sorted(matches, key=lambda i: files[i][sort])
+        return matches
+
+    def changes(self, since):
+        """Return the changes after generation since, or None if they are no longer known.
+
+        The result maps 'added' and 'modified' to entries and 'removed' to names, netting out files that came and went in between.
+        """
+        with self.lock:
+            if since < self.change_floor or since > self.generation:
+                return None
+            start = bisect.bisect_right(self.change_generations, since)
+            existed = {}
+            for name, existed_before in self.change_log[start:]:
+                # The first change after since tells whether the client has the file
+                existed.setdefault(name, existed_before)
+            entries, generation = self.entries, self.generation
+
+        result = {'added': [], 'modified': [], 'removed': [], 'generation': generation}
+        for name, existed_before in sorted(existed.items()):
+            entry = entries.get(name)
+            if entry is None:
+                if existed_before:
+                    result['removed'].append(name)
+            else:
+                result['modified' if existed_before else 'added'].append(entry)
+        return result
+
+    def start_polling(self):
+        """Start the background rescan thread"""
+        if self.poller and self.poller.is_alive():
+            return
+        self.poller_stop.clear()
+        self.poller = threading.Thread(target=self.poll, daemon=True)
+        self.poller.start()
+
+    def stop_polling(self):
+        self.poller_stop.set()
+
+    def poll(self):
+        last_sweep = time.monotonic()
+        while not self.poller_stop.wait(self.poll_interval):
+            try:
+                if time.monotonic() - last_sweep >= self.sweep_interval:
+                    last_sweep = time.monotonic()
+                    self.refresh(force=True)
+                else:
+                    self.refresh()
+            except OSError:
+                pass
+
+
+def make_entry(name, stat):
+    return {
+        'id': file_id(name, stat),
+        'name': name,
+        'size': stat.st_size,
+        'modified': stat.st_mtime
+    }
+
+
+class FileNames:
+    """Sequence view of the names in a sorted entry list, for bisect"""
+
+    def __init__(self, files):
+        self.files = files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, i):
+        return self.files[i]['name']
@@ -0,0 +1,356 @@
+"""Virtual file list for the client GUI.
+
+A Treeview item per file makes loading, sorting and refreshing a listing of
+100,000 files take seconds, as every item is created, formatted and laid
+out by Tk. The files are kept instead in a columnar model (parallel lists of
+names, sizes and modification times) that sorts and filters with list
+operations on row numbers, and the Treeview holds one item per line on
+screen whose values are rewritten as the list scrolls. A row is formatted
+the first time it is shown.
+
+Changes to the listing are applied to the model in place: removed rows are
+dropped from the display order and new or modified ones are placed in it by
+bisection, and only the lines on screen whose row changed are rewritten.
+"""
+import bisect
+import fnmatch
+import re
+import tkinter as tk
+from operator import itemgetter
+from tkinter import ttk
+
+COLUMNS = ('name', 'size', 'modified')
+# Lines scrolled per mouse wheel notch
+WHEEL_LINES = 3
+# Screens of rows below the visible ones that are loaded ahead of scrolling
+PRELOAD_SCREENS = 2
+# Modifier bits of a Tk event's state
+SHIFT_MASK = 0x1
+CONTROL_MASK = 0x4
+# Changed rows beyond which sorting all rows again is faster than placing each one
+MAX_PLACED_CHANGES = 1000
+
+
+def compile_pattern(pattern):
+    """Name matcher for a listing filter: a glob, or a prefix if it has no wildcards"""
+    if any(c in pattern for c in '*?['):
+        return re.compile(fnmatch.translate(pattern)).match
+    return lambda name: name.startswith(pattern)
+
+
+class FileColumns:
+    """Files of a listing as parallel lists, arranged for display as a list of row numbers"""
+
+    def __init__(self):
+        self.names = []
+        self.sizes = []
+        self.mtimes = []
+        # Name -> row number
+        self.index = {}
+        # Row numbers in display order
+        self.order = range(0)
+        # Local arrangement; sort None keeps the order the rows were loaded in
+        self.sort = None
+        self.reverse = False
+        self.pattern = ''
+        # Row number -> column values, filled as rows are shown
+        self.formatted = {}
+        # Rows of removed files still in the columns, dropped when they outnumber the others
+        self.dead = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def load(self, files):
+        """Replace the rows with a listing"""
+        self.names = list(map(itemgetter('name'), files))
+        self.sizes = list(map(itemgetter('size'), files))
+        self.mtimes = list(map(itemgetter('modified'), files))
+        self.index = dict(zip(self.names, range(len(self.names))))
+        self.formatted = {}
+        self.dead = 0
+        self.rearrange()
+
+    def extend(self, files):
+        """Add the next page of a listing"""
+        start = len(self.names)
+        self.names.extend(map(itemgetter('name'), files))
+        self.sizes.extend(map(itemgetter('size'), files))
+        self.mtimes.extend(map(itemgetter('modified'), files))
+        self.index.update(zip(self.names[start:], range(start, len(self.names))))
+        self.rearrange()
+
+    def apply(self, removed, updated, files=None):
+        """Drop the rows of removed names, and add or update the rows of the updated entries.
+
+        With a local sort the rows are placed where they sort; in load order
+        they are shown in the order of files, the listing the changes were
+        applied to.
+        """
+        placed = self.sort is not None and len(removed) + len(updated) <= MAX_PLACED_CHANGES
+        match = compile_pattern(self.pattern) if self.pattern else None
+        for name in removed:
+            row = self.index.pop(name, None)
+            if row is None:
+                continue
+            if placed:
+                self.unplace(row)
+            self.formatted.pop(row, None)
+            self.dead += 1
+        for file_info in updated:
+            row = self.index.get(file_info['name'])
+            if row is None:
+                row = self.index[file_info['name']] = len(self.names)
+                self.names.append(file_info['name'])
+                self.sizes.append(file_info['size'])
+                self.mtimes.append(file_info['modified'])
+            else:
+                if placed:
+                    self.unplace(row)
+                self.sizes[row] = file_info['size']
+                self.mtimes[row] = file_info['modified']
+                self.formatted.pop(row, None)
+            if placed and (match is None or match(self.names[row])):
+                self.place(row)
+
+        if self.dead > len(self.index):
+            self.compact()
+        if self.sort is None and files is not None:
+            rows = map(self.index.__getitem__, map(itemgetter('name'), files))
+            self.order = [row for row in rows if match(self.names[row])] if match else list(rows)
+        elif not placed:
+            self.rearrange()
+
+    def compact(self):
+        """Drop the rows of removed files from the columns, keeping the display order"""
+        live = sorted(self.index.values())
+        renumbered = dict(zip(live, range(len(live))))
+        self.names = list(map(self.names.__getitem__, live))
+        self.sizes = list(map(self.sizes.__getitem__, live))
+        self.mtimes = list(map(self.mtimes.__getitem__, live))
+        self.index = dict(zip(self.names, range(len(self.names))))
+        self.order = [renumbered[row] for row in self.order if row in renumbered]
+        self.formatted = {renumbered[row]: values for row, values in self.formatted.items() if row in renumbered}
+        self.dead = 0
+
+    def sort_key(self, row):
+        if self.sort == 'name':
+            return self.names[row]
+        column = self.sizes if self.sort == 'size' else self.mtimes
+        return column[row], self.names[row]
+
+    def place(self, row):
+        """Insert a row into the sorted display order"""
+        i = bisect.bisect_left(SortKeys(self), self.sort_key(row))
+        self.order.insert(len(self.order) - i if self.reverse else i, row)
+
+    def unplace(self, row):
+        """Take a row out of the sorted display order, if it is shown"""
+        i = bisect.bisect_left(SortKeys(self), self.sort_key(row))
+        position = len(self.order) - 1 - i if self.reverse else i
+        if 0 <= position < len(self.order) and self.order[position] == row:
+            del self.order[position]
+
+    def arrange(self, sort, reverse=False, pattern=''):
+        """Show the rows matching pattern ordered by sort, or in the order they were loaded if sort is None"""
+        self.sort = sort
+        self.reverse = reverse
+        self.pattern = pattern
+        self.rearrange()
+
+    def rearrange(self):
+        # Rows of removed files stay in the columns until compacted
+        rows = sorted(self.index.values()) if self.dead else range(len(self.names))
+        if self.pattern:
+            match = compile_pattern(self.pattern)
+            rows = [row for row in rows if match(self.names[row])]
+        if self.sort is not None:
+            # Stable sorts on C-level keys: by name first, so equal sizes or dates stay in name order
+            rows = sorted(rows, key=self.names.__getitem__)
+            if self.sort == 'size':
+                rows.sort(key=self.sizes.__getitem__)
+            elif self.sort == 'modified':
+                rows.sort(key=self.mtimes.__getitem__)
+        if self.reverse and self.sort is not None:
+            rows = rows[::-1]
+        self.order = rows
+
+    def name(self, position):
+        """Name of the file shown at a position"""
+        return self.names[self.order[position]]
+
+    def values(self, position, format_row):
+        """Column values of the row shown at a position, formatted by format_row(name, size, mtime)"""
+        row = self.order[position]
+        values = self.formatted.get(row)
+        if values is None:
+            values = self.formatted[row] = format_row(self.names[row], self.sizes[row], self.mtimes[row])
+        return values
+
+
+class SortKeys:
+    """Sort keys of a sorted model's rows in ascending order, reversed or not, for bisect"""
+
+    def __init__(self, model):
+        self.model = model
+
+    def __len__(self):
+        return len(self.model.order)
+
+    def __getitem__(self, i):
+        order = self.model.order
+        return self.model.sort_key(order[-1 - i] if self.model.reverse else order[i])
+
+
+class FileListView:
+    """Treeview showing a FileColumns model with only as many items as fit on screen"""
+
+    def __init__(self, parent, model, format_row, on_near_end=None, height=8):
+        self.model = model
+        self.format_row = format_row
+        # Called when the rows on screen come close to the end of the model
+        self.on_near_end = on_near_end
+        # Position in the model of the first line
+        self.top = 0
+        # Selected names, on screen or not
+        self.selected = set()
+        # (item, name) of the lines showing a row
+        self.visible = []
+        # Item -> the values it shows, so lines whose row did not change are left alone
+        self.shown = {}
+
+        self.frame = ttk.Frame(parent, relief='flat', borderwidth=1)
+        self.frame.columnconfigure(0, weight=1)
+        self.frame.rowconfigure(0, weight=1)
+        self.tree = ttk.Treeview(self.frame, columns=COLUMNS, show='headings', height=height)
+        self.tree.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
+
+        self.lines = []
+        self.detached = set()
+        # Whether the number of lines was matched to the widget's height yet
+        self.fitted = False
+        self.set_line_count(height)
+
+        self.tree.bind('<Configure>', lambda e: self.fit_lines())
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.tree.bind(sequence, self.on_wheel)
+        self.tree.bind('<Button-1>', self.on_click)
+        self.tree.bind('<<TreeviewSelect>>', lambda e: self.on_select())
+        self.tree.bind('<Up>', lambda e: self.on_arrow(-1))
+        self.tree.bind('<Down>', lambda e: self.on_arrow(1))
+        self.tree.bind('<Prior>', lambda e: self.scroll(-len(self.lines)))
+        self.tree.bind('<Next>', lambda e: self.scroll(len(self.lines)))
+        self.tree.bind('<Home>', lambda e: self.scroll(-len(self.model)))
+        self.tree.bind('<End>', lambda e: self.scroll(len(self.model)))
+
+    def set_line_count(self, count):
+        """Create or delete Treeview items so there is one per line"""
+        while len(self.lines) < count:
+            self.lines.append(self.tree.insert('', 'end', iid=f"line{len(self.lines)}"))
+        while len(self.lines) > count:
+            item = self.lines.pop()
+            self.detached.discard(item)
+            self.shown.pop(item, None)
+            self.tree.delete(item)
+
+    def fit_lines(self):
+        """Match the number of items to the lines the widget has room for after a resize"""
+        shown = [item for item in self.lines if item not in self.detached]
+        bbox = self.tree.bbox(shown[0]) if shown else ''
+        if not bbox:
+            return
+        _, y, _, row_height = bbox
+        count = max(1, (self.tree.winfo_height() - y) // row_height)
+        self.fitted = True
+        if count != len(self.lines):
+            self.set_line_count(count)
+            self.refresh()
+
+    def refresh(self):
+        """Show the rows of the model from self.top on"""
+        count = len(self.model)
+        lines = len(self.lines)
+        self.top = max(0, min(self.top, count - lines))
+        self.selected = {name for name in self.selected if name in self.model.index}
+        self.visible = []
+        for i, item in enumerate(self.lines):
+            position = self.top + i
+            if position < count:
+                values = self.model.values(position, self.format_row)
+                if self.shown.get(item) is not values:
+                    self.tree.item(item, values=values)
+                    self.shown[item] = values
+                if item in self.detached:
+                    self.tree.reattach(item, '', i)
+                    self.detached.discard(item)
+                self.visible.append((item, self.model.name(position)))
+            elif item not in self.detached:
+                self.tree.detach(item)
+                self.detached.add(item)
+        self.tree.selection_set([item for item, name in self.visible if name in self.selected])
+
+        if count > lines:
+            self.scrollbar.set(self.top / count, (self.top + lines) / count)
+        else:
+            self.scrollbar.set(0, 1)
+        if self.on_near_end and self.top + PRELOAD_SCREENS * lines >= count:
+            self.on_near_end()
+        if not self.fitted:
+            # Line sizes are only known once a row has been laid out
+            self.tree.after_idle(self.fit_lines)
+
+    def scroll(self, lines):
+        self.top += lines
+        self.refresh()
+        return 'break'
+
+    def yview(self, *args):
+        """Scrollbar command"""
+        if args[0] == 'moveto':
+            self.top = int(float(args[1]) * len(self.model))
+            self.refresh()
+        elif args[0] == 'scroll':
+            lines = int(args[1])
+            self.scroll(lines * len(self.lines) if args[2] == 'pages' else lines)
+
+    def on_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            return self.scroll(-WHEEL_LINES)
+        return self.scroll(WHEEL_LINES)
+
+    def on_click(self, event):
+        # A plain click on a row selects only it, so rows selected off screen are dropped
+        if self.tree.identify_region(event.x, event.y) == 'cell' and not event.state & (SHIFT_MASK | CONTROL_MASK):
+            self.selected.intersection_update(name for _, name in self.visible)
+
+    def on_select(self):
+        """Record the Treeview's selection of the rows on screen"""
+        chosen = set(self.tree.selection())
+        for item, name in self.visible:
+            if item in chosen:
+                self.selected.add(name)
+            else:
+                self.selected.discard(name)
+
+    def on_arrow(self, step):
+        """Scroll when the arrow keys move the selection past the first or last line"""
+        if not self.visible:
+            return None
+        edge = self.visible[0][0] if step < 0 else self.visible[-1][0]
+        if self.tree.focus() != edge:
+            return None  # Moving within the lines on screen
+        top = self.top
+        self.top += step
+        self.refresh()
+        if self.top == top:
+            return 'break'
+        self.selected = {self.visible[0 if step < 0 else -1][1]}
+        self.refresh()
+        self.tree.focus(edge)
+        return 'break'
+
+    def selection(self):
+        """Names of the selected files"""
+        return tuple(sorted(self.selected))
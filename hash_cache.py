@@ -0,0 +1,193 @@
+"""Persistent cache of file content hashes.
+
+Hashing a multi-gigabyte file takes seconds, so digests are kept in a small
+SQLite database keyed by the file's (device, inode) and valid for as long as
+its size and mtime_ns are unchanged: writing to a file changes its mtime,
+replacing it changes its inode. A stale row is simply overwritten.
+
+Digests are computed lazily. Looking up a file that has no valid digest
+queues it for a pool of background threads, which read files at a limited
+rate so hashing does not starve transfers of disk bandwidth. Uploads that
+arrive with a checksum store their digest directly, and so do files hashed
+as they are sent with one.
+
+Each row also remembers the path the file was last seen under, so files
+can be found by their content (see find).
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from protocol import new_checksum
+
+# Database shared by all servers and clients of this user; rows are keyed by inode, not path
+HASH_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'local-network-file-transfer', 'hashes.sqlite3')
+HASH_WORKERS = 2
+# Bytes per second the background pool reads, across all its threads
+HASH_RATE = 64 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def cache_key(stat):
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def hash_file(path, stat, limiter=None):
+    """Digest of a file's content, None if it changed while being read"""
+    checksum = new_checksum()
+    buffer = memoryview(bytearray(HASH_CHUNK_SIZE))
+    with open(path, 'rb') as f:
+        if cache_key(os.fstat(f.fileno())) != cache_key(stat):
+            return None
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            if limiter:
+                limiter.consume(n)
+            checksum.update(buffer[:n])
+        if cache_key(os.fstat(f.fileno())) != cache_key(stat):
+            return None
+    return checksum.digest()
+
+
+class RateLimiter:
+    """Token bucket shared by several threads, allowing up to rate bytes per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.allowance = rate
+        self.updated = time.monotonic()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.updated) * self.rate)
+            self.updated = now
+            self.allowance -= n
+            delay = -self.allowance / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class HashCache:
+    def __init__(self, path=HASH_CACHE_PATH, workers=HASH_WORKERS, rate=HASH_RATE):
+        self.path = path
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.lock = threading.Lock()
+        self.db = None
+        self.queue = queue.Queue()
+        # Keys queued or being hashed, so a file is only queued once
+        self.pending = set()
+        self.threads = []
+
+    def open(self):
+        """Open the database on first use, creating it if needed"""
+        if self.db is None:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, ino INTEGER, size INTEGER, "
+                       "mtime_ns INTEGER, digest BLOB, path TEXT, PRIMARY KEY (dev, ino)) WITHOUT ROWID")
+            if 'path' not in [column[1] for column in db.execute("PRAGMA table_info(hashes)")]:
+                # Databases written before paths were recorded
+                db.execute("ALTER TABLE hashes ADD COLUMN path TEXT")
+            db.execute("CREATE INDEX IF NOT EXISTS hashes_digest ON hashes (digest)")
+            self.db = db
+        return self.db
+
+    def get(self, stat):
+        """Cached digest for a file's current stat, None if unknown or stale"""
+        dev, ino, size, mtime_ns = cache_key(stat)
+        with self.lock:
+            row = self.open().execute("SELECT size, mtime_ns, digest FROM hashes WHERE dev = ? AND ino = ?",
+                                      (dev, ino)).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            return None
+        return row[2]
+
+    def cached(self, stat):
+        """Like get, but None rather than an error if the database cannot be read"""
+        try:
+            return self.get(stat)
+        except sqlite3.Error:
+            return None
+
+    def put(self, stat, digest, path):
+        with self.lock:
+            self.open().execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                                cache_key(stat) + (digest, os.path.abspath(path)))
+
+    def store(self, path, digest, stat=None):
+        """Record the digest of a file just written or read, e.g. a verified upload.
+
+        stat, if given, is the file's stat when its content was hashed.
+        """
+        try:
+            self.put(stat or os.stat(path), digest, path)
+        except (OSError, sqlite3.Error):
+            pass
+
+    def find(self, digest, size):
+        """Paths of files of size bytes whose current content has this digest"""
+        with self.lock:
+            rows = self.open().execute("SELECT dev, ino, size, mtime_ns, path FROM hashes "
+                                       "WHERE digest = ? AND size = ?", (digest, size)).fetchall()
+        paths = []
+        for row in rows:
+            try:
+                if cache_key(os.stat(row[4])) == tuple(row[:4]):
+                    paths.append(row[4])
+            except OSError:
+                pass
+        return paths
+
+    def lookup(self, path, stat=None):
+        """Digest of a file if cached, else None after queueing it for hashing"""
+        stat = stat or os.stat(path)
+        digest = self.get(stat)
+        if digest is None:
+            self.schedule(path, stat)
+        return digest
+
+    def compute(self, path, stat=None):
+        """Digest of a file, hashing it now at full speed if it is not cached"""
+        stat = stat or os.stat(path)
+        digest = self.get(stat)
+        if digest is None:
+            digest = hash_file(path, stat)
+            if digest is not None:
+                self.put(stat, digest, path)
+        return digest
+
+    def schedule(self, path, stat):
+        key = cache_key(stat)
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+            self.threads = [t for t in self.threads if t.is_alive()]
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+        self.queue.put((path, stat))
+
+    def work(self):
+        while True:
+            path, stat = self.queue.get()
+            try:
+                digest = hash_file(path, stat, self.limiter)
+                if digest is not None:
+                    self.put(stat, digest, path)
+            except (OSError, sqlite3.Error):
+                pass
+            finally:
+                with self.lock:
+                    self.pending.discard(cache_key(stat))
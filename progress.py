@@ -0,0 +1,119 @@
+"""Hand-off of client events from transfer threads to the GUI thread.
+
+Transfers report progress for every chunk they move, hundreds or thousands
+of times a second, from worker threads that must not touch Tk widgets.
+Workers only append events to a deque, which is thread-safe without a lock.
+The GUI drains it from its own thread a fixed number of times a second:
+events are delivered in order, except that the progress reports of a
+transfer that arrived since the last drain are merged into the latest, so
+the widgets are updated at most PROGRESS_RATE times a second whatever the
+transfer speed. The speed shown is a moving average of the recent rate
+rather than the average since the transfer started, with the ETA worked out
+from it.
+
+Transfers running side by side are told apart by the source function, which
+names the transfer of the thread posting an event. Each has a rate of its
+own, and progress reports also carry the sum of the rates of the transfers
+of their direction, with how many there are.
+"""
+import collections
+import time
+
+# Progress updates delivered per second
+PROGRESS_RATE = 20
+# Weight of the latest interval in the smoothed speed
+SPEED_SMOOTHING = 0.3
+# Events delivered per drain, so a flood of messages cannot stall the GUI;
+# merged progress reports do not count
+MAX_DRAIN_EVENTS = 1000
+# Seconds without a progress report after which a transfer no longer counts
+# towards the total rate, as one that failed never reports completion
+RATE_EXPIRY = 3.0
+
+PROGRESS_EVENTS = ('upload_progress', 'download_progress')
+
+
+class Throughput:
+    """Smoothed transfer rate of one transfer"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.size = None
+        self.time = None
+        self.speed = None
+
+    def update(self, size, now):
+        """Fold in the byte count reached at time now, return the smoothed speed"""
+        if self.size is not None and now > self.time and size >= self.size:
+            rate = (size - self.size) / (now - self.time)
+            self.speed = rate if self.speed is None else SPEED_SMOOTHING * rate + (1 - SPEED_SMOOTHING) * self.speed
+        self.size = size
+        self.time = now
+        return self.speed
+
+
+class ProgressBus:
+    def __init__(self, source=None):
+        self.events = collections.deque()
+        # Called on the posting thread, returns the transfer an event belongs to
+        self.source = source or (lambda: None)
+        # (direction, transfer) -> Throughput
+        self.rates = {}
+
+    def post(self, callback_type, data, log_type=None):
+        """Queue an event; called from any thread with the arguments of a gui_callback"""
+        self.events.append((callback_type, data, log_type, self.source()))
+
+    def drain(self, handler):
+        """Deliver the queued events to handler, on the thread calling this"""
+        batch = []
+        # Position in batch of each transfer's progress events since the last other event
+        latest = {}
+        while len(batch) < MAX_DRAIN_EVENTS:
+            try:
+                event = self.events.popleft()
+            except IndexError:
+                break
+            callback_type, _, _, transfer = event
+            if callback_type in PROGRESS_EVENTS:
+                key = (callback_type, transfer)
+                if key in latest:
+                    batch[latest[key]] = event
+                    continue
+                latest[key] = len(batch)
+            elif callback_type != 'log':
+                latest.clear()
+            batch.append(event)
+
+        now = time.monotonic()
+        for callback_type, data, log_type, transfer in batch:
+            direction, _, stage = callback_type.partition('_')
+            if stage in ('start', 'complete'):
+                self.rates.pop((direction, transfer), None)
+            elif callback_type in PROGRESS_EVENTS:
+                rate = self.rates.setdefault((direction, transfer), Throughput())
+                data = self.smooth(rate, data, now)
+                data = self.add_total(direction, data, now)
+            handler(callback_type, data, log_type)
+
+    def smooth(self, rate, data, now):
+        """The progress report with its speed and ETA replaced by smoothed ones"""
+        size = data.get('received_size', data.get('sent_size'))
+        if size is None:
+            return data
+        speed = rate.update(size, now)
+        if speed is None:
+            return data
+        data = dict(data, speed=speed)
+        if data.get('total_size'):
+            data['eta'] = (data['total_size'] - size) / speed if speed > 0 else 0
+        return data
+
+    def add_total(self, direction, data, now):
+        """The progress report with the summed rate of the transfers of its direction"""
+        for key in [key for key, rate in self.rates.items() if rate.time is None or now - rate.time > RATE_EXPIRY]:
+            del self.rates[key]
+        speeds = [rate.speed for (other, _), rate in self.rates.items() if other == direction]
+        return dict(data, total_speed=sum(speed for speed in speeds if speed), active_transfers=len(speeds))
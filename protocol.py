@@ -0,0 +1,282 @@
+"""Framed wire protocol shared by the server and the client.
+
+Every message is a frame: a fixed 12-byte header followed by a payload.
+
+    version  u8   PROTOCOL_VERSION
+    type     u8   one of the FRAME_* constants
+    flags    u16  FLAG_* bits, meaning depends on the frame type
+    length   u64  payload length in bytes
+
+COMMAND, RESPONSE and EVENT frames carry a JSON object, TEXT frames carry
+UTF-8 text and are read whole. EVENTs are sent by the server unprompted,
+between responses, to clients that asked for them. DATA frames carry raw file bytes which are never
+buffered by the codec: the receiver streams them straight to disk. When the
+receiver asks for it, a file's content is followed by a TRAILER frame with
+a checksum computed while sending, which the receiver checks against its
+own running checksum before keeping the file.
+"""
+import hashlib
+import json
+import os
+import socket
+import struct
+import threading
+from collections import namedtuple
+
+PROTOCOL_VERSION = 1
+
+HEADER = struct.Struct('!BBHQ')
+
+# Frame types
+FRAME_COMMAND = 1   # client request, JSON object with a 'cmd' key
+FRAME_RESPONSE = 2  # server reply, JSON object with a 'type' key
+FRAME_TEXT = 3      # human readable message, e.g. "ERROR: ..."
+FRAME_DATA = 4      # raw file bytes
+FRAME_EVENT = 5     # server notification, JSON object with a 'type' key
+FRAME_TRAILER = 6   # follows a file's content, JSON object with its checksum
+
+# Checksum named in requests and trailers
+CHECKSUM_ALGORITHM = 'blake2b'
+
+# Control payloads larger than this are treated as a protocol error. File
+# listings only come in pages, cut short to fit if their names are long, and
+# too many changes to send become a reset; a peer sending more is broken or
+# hostile, and is not allowed to make the receiver buffer it
+MAX_CONTROL_SIZE = 4 * 1024 * 1024
+# Size of socket reads and of the reusable buffer used for file payloads
+RECV_SIZE = 256 * 1024
+SEND_BUFFER_SIZE = 256 * 1024
+# Upper bound for a single socket read while buffering a large control frame
+MAX_RECV_SIZE = 4 * 1024 * 1024
+# Largest single sendfile call, so progress can be reported between calls
+SENDFILE_CHUNK_SIZE = 4 * 1024 * 1024
+
+Frame = namedtuple('Frame', ['type', 'flags', 'length', 'payload'])
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends something that is not a valid frame"""
+
+
+class ChecksumError(ProtocolError):
+    """Raised when received content does not match the sender's checksum"""
+
+
+def encode_header(frame_type, length, flags=0):
+    """Encode a frame header"""
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, flags, length)
+
+
+def decode_header(header):
+    """Decode a frame header into (type, flags, length)"""
+    version, frame_type, flags, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if frame_type != FRAME_DATA and length > MAX_CONTROL_SIZE:
+        raise ProtocolError(f"Control frame too large: {length} bytes")
+    return frame_type, flags, length
+
+
+def encode_frame(frame_type, payload=b'', flags=0):
+    """Encode a complete frame"""
+    return encode_header(frame_type, len(payload), flags) + payload
+
+
+def encode_message(message):
+    """Encode a dict as a RESPONSE frame and a str as a TEXT frame.
+
+    bytes are taken to be an already encoded frame and returned as is, which
+    lets callers cache responses that are expensive to serialise.
+    """
+    if isinstance(message, bytes):
+        return message
+    if isinstance(message, str):
+        return encode_frame(FRAME_TEXT, message.encode('utf-8'))
+    return encode_frame(FRAME_RESPONSE, json.dumps(message).encode('utf-8'))
+
+
+def encode_event(message):
+    """Encode a dict as an EVENT frame"""
+    return encode_frame(FRAME_EVENT, json.dumps(message).encode('utf-8'))
+
+
+def new_checksum():
+    """Start a running checksum of a file's content"""
+    return hashlib.blake2b(digest_size=32)
+
+
+def encode_trailer(checksum):
+    """Encode the TRAILER frame carrying a finished checksum, or a digest known beforehand"""
+    digest = checksum.hex() if isinstance(checksum, bytes) else checksum.hexdigest()
+    return encode_frame(FRAME_TRAILER, json.dumps({CHECKSUM_ALGORITHM: digest}).encode('utf-8'))
+
+
+def verify_trailer(frame, checksum):
+    """Check a received TRAILER frame against the checksum of what arrived"""
+    if frame is None or frame.type != FRAME_TRAILER:
+        raise ProtocolError("Expected a checksum trailer")
+    if frame.payload.get(CHECKSUM_ALGORITHM) != checksum.hexdigest():
+        raise ChecksumError("Checksum mismatch, the file was corrupted in transfer")
+
+
+def encode_command(command, **args):
+    """Encode a COMMAND frame"""
+    return encode_frame(FRAME_COMMAND, json.dumps(dict(args, cmd=command)).encode('utf-8'))
+
+
+def decode_payload(frame_type, payload):
+    """Decode a control payload into a dict (COMMAND/RESPONSE/EVENT/TRAILER) or str (TEXT)"""
+    try:
+        if frame_type == FRAME_TEXT:
+            return payload.decode('utf-8')
+        message = json.loads(payload)
+    except ValueError as e:
+        raise ProtocolError(f"Malformed payload: {e}")
+    if not isinstance(message, dict):
+        raise ProtocolError("Control payload is not a JSON object")
+    return message
+
+
+class Connection:
+    """A socket speaking the framed protocol.
+
+    Reads go through an internal buffer so coalesced and partial TCP reads
+    are handled, and several pipelined frames can arrive in one read.
+    Writes are serialised by send_lock; hold it across several sends to
+    keep a multi-frame exchange (command + data) contiguous on the wire.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        # A reply is often a control frame followed by a small DATA header; with
+        # Nagle's algorithm the second write waits for the peer's delayed ACK
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.RLock()
+        self._buffer = bytearray()
+
+    def _fill(self, size):
+        """Buffer at least size bytes, return False on EOF"""
+        while len(self._buffer) < size:
+            data = self.sock.recv(max(RECV_SIZE, min(size - len(self._buffer), MAX_RECV_SIZE)))
+            if not data:
+                return False
+            self._buffer += data
+        return True
+
+    def read_frame(self):
+        """Read the next frame, or return None if the peer closed the connection.
+
+        Control payloads are decoded. For DATA frames only the header is
+        consumed; the caller must then read exactly frame.length bytes with
+        recv_into(), read_exact() or discard().
+        """
+        if not self._fill(HEADER.size):
+            if self._buffer:
+                raise ProtocolError("Connection closed mid-frame")
+            return None
+        frame_type, flags, length = decode_header(bytes(self._buffer[:HEADER.size]))
+        if frame_type == FRAME_DATA:
+            del self._buffer[:HEADER.size]
+            return Frame(frame_type, flags, length, None)
+        if not self._fill(HEADER.size + length):
+            raise ProtocolError("Connection closed mid-frame")
+        payload = bytes(self._buffer[HEADER.size:HEADER.size + length])
+        del self._buffer[:HEADER.size + length]
+        return Frame(frame_type, flags, length, decode_payload(frame_type, payload))
+
+    def recv_into(self, view, nbytes):
+        """Read up to nbytes of a DATA payload into view, 0 on EOF"""
+        if self._buffer:
+            n = min(nbytes, len(self._buffer))
+            view[:n] = self._buffer[:n]
+            del self._buffer[:n]
+            return n
+        return self.sock.recv_into(view, nbytes)
+
+    def read_exact(self, size):
+        """Read exactly size bytes of a DATA payload into memory"""
+        if not self._fill(size):
+            raise ProtocolError("Connection closed mid-frame")
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def discard(self, size):
+        """Skip size bytes of a DATA payload, return the number skipped"""
+        buffer = memoryview(bytearray(min(size, RECV_SIZE) or 1))
+        skipped = 0
+        while skipped < size:
+            n = self.recv_into(buffer, min(len(buffer), size - skipped))
+            if not n:
+                break
+            skipped += n
+        return skipped
+
+    def send_frame(self, frame_type, payload=b'', flags=0):
+        with self.send_lock:
+            self.sock.sendall(encode_frame(frame_type, payload, flags))
+
+    def send_message(self, message):
+        """Send a dict as a RESPONSE frame or a str as a TEXT frame"""
+        with self.send_lock:
+            self.sock.sendall(encode_message(message))
+
+    def send_command(self, command, **args):
+        with self.send_lock:
+            self.sock.sendall(encode_command(command, **args))
+
+    def send_file_data(self, f, offset, count, progress=None, checksum=None):
+        """Send count bytes of an open file as one DATA frame, return bytes sent.
+
+        The payload goes out with socket.sendfile (kernel to socket, no copy
+        into Python) where available, else through a single reused buffer.
+        progress, if given, is called with the running total of bytes sent.
+        A checksum, if given, is updated with the content as it is sent,
+        which takes the buffered path. The caller must make sure the file
+        really holds count bytes.
+        """
+        with self.send_lock:
+            self.sock.sendall(encode_header(FRAME_DATA, count))
+            sent_size = 0
+            if hasattr(os, 'sendfile') and checksum is None:
+                try:
+                    while sent_size < count:
+                        n = self.sock.sendfile(f, offset + sent_size,
+                                               min(SENDFILE_CHUNK_SIZE, count - sent_size))
+                        if not n:
+                            break
+                        sent_size += n
+                        if progress:
+                            progress(sent_size)
+                    return sent_size
+                except OSError:
+                    # Fall back only if nothing was sent yet (e.g. unsupported file type)
+                    if sent_size:
+                        raise
+
+            # Chunked fallback over a single reused buffer
+            buffer = memoryview(bytearray(SEND_BUFFER_SIZE))
+            f.seek(offset)
+            while sent_size < count:
+                n = f.readinto(buffer[:min(SEND_BUFFER_SIZE, count - sent_size)])
+                if not n:
+                    break
+                if checksum is not None:
+                    checksum.update(buffer[:n])
+                self.sock.sendall(buffer[:n])
+                sent_size += n
+                if progress:
+                    progress(sent_size)
+            return sent_size
+
+    def send_trailer(self, checksum):
+        with self.send_lock:
+            self.sock.sendall(encode_trailer(checksum))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
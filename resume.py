@@ -0,0 +1,106 @@
+"""Partial transfers kept on disk so an interrupted transfer can be resumed.
+
+While a file is being received it lives under a hidden sidecar name next to
+its destination (".name.part"), together with a small JSON manifest
+(".name.part.json") recording the expected size, the version of the source
+it came from and how many bytes are safely on disk. After a connection loss
+the receiver reads the manifest and asks the sender to continue from there.
+"""
+import json
+import os
+
+PARTIAL_SUFFIX = '.part'
+MANIFEST_SUFFIX = '.part.json'
+# How much data may be written between two checkpoints of the manifest
+CHECKPOINT_INTERVAL = 64 * 1024 * 1024
+
+
+def is_partial_file(name):
+    """Check whether a directory entry belongs to an in-progress transfer"""
+    return name.startswith('.') and (name.endswith(PARTIAL_SUFFIX) or name.endswith(MANIFEST_SUFFIX))
+
+
+class PartialFile:
+    """The on-disk state of one in-progress transfer"""
+
+    def __init__(self, directory, name, size, source=None):
+        self.name = name
+        self.size = size
+        # Identifies the version of the file being transferred (e.g. its mtime);
+        # a partial copy of a different version must not be resumed
+        self.source = source
+        # name may be a relative path; the sidecars sit in its own directory
+        head, tail = os.path.split(name)
+        self.directory = os.path.join(directory, head)
+        self.path = os.path.join(self.directory, f".{tail}{PARTIAL_SUFFIX}")
+        self.manifest_path = os.path.join(self.directory, f".{tail}{MANIFEST_SUFFIX}")
+
+    def load(self):
+        """Return the manifest if it describes this same transfer, else None"""
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('size') != self.size or manifest.get('source') != self.source:
+            return None
+        if not os.path.exists(self.path):
+            return None
+        return manifest
+
+    def resume_offset(self):
+        """Number of verified bytes already on disk that need not be sent again"""
+        manifest = self.load()
+        if not manifest or os.stat(self.path).st_nlink > 1:
+            # Writing into a partial file that has another name would change that file too
+            return 0
+        return max(0, min(int(manifest.get('received', 0)), os.path.getsize(self.path), self.size))
+
+    def open(self, offset=0):
+        """Open the partial file for writing at offset, discarding anything after it.
+
+        With offset=None the existing content is kept as is, for writers that
+        fill the file out of order. With offset=0 any existing partial file is
+        replaced by a new one rather than truncated, in case its inode is shared.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if offset == 0 and os.path.lexists(self.path):
+            os.remove(self.path)
+        f = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+        if offset is not None:
+            f.truncate(offset)
+            f.seek(offset)
+        return f
+
+    def checkpoint(self, f, received, **extra):
+        """Flush data to disk, then record that received bytes are safe"""
+        if hasattr(f, 'flush'):
+            f.flush()
+            f = f.fileno()
+        os.fsync(f)
+        manifest = dict(extra, name=self.name, size=self.size, source=self.source, received=received)
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as mf:
+            json.dump(manifest, mf)
+        os.replace(temp_path, self.manifest_path)
+
+    def commit(self, final_path, modified=None):
+        """Move the completed file into place and drop the manifest.
+
+        modified, if a timestamp, becomes the file's modification time, so a
+        copy keeps the time of its original.
+        """
+        if isinstance(modified, (int, float)) and not isinstance(modified, bool):
+            os.utime(self.path, (os.stat(self.path).st_atime, modified))
+        os.replace(self.path, final_path)
+        self.remove_manifest()
+
+    def discard(self):
+        """Delete the partial file and its manifest"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.remove_manifest()
+
+    def remove_manifest(self):
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
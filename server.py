@@ -1,9 +1,28 @@
 import sys
 import os
+import secrets
+import select
 import socket
 import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from protocol import (Connection, ProtocolError, ChecksumError, Frame, FRAME_COMMAND, FRAME_DATA, FRAME_TRAILER,
+                      HEADER, MAX_CONTROL_SIZE, RECV_SIZE, SEND_BUFFER_SIZE, CHECKSUM_ALGORITHM, encode_event, decode_header,
+                      decode_payload, encode_frame, encode_header, encode_message, encode_trailer, new_checksum,
+                      verify_trailer)
+from resume import PartialFile, CHECKPOINT_INTERVAL, PARTIAL_SUFFIX
+from file_index import FileIndex, file_id, normalize_path, MAX_DEPTH
+from hash_cache import HashCache, cache_key
+from dedup import DEDUP_CANDIDATES, DEDUP_MIN_SIZE, clone_file
+from delta import OP_COPY, MAX_OP_SIZE, block_size_for, copy_blocks, decode_op, file_signatures, read_delta
+from compression import (CODECS, MAX_BLOCK_FRAME, choose_encoding, compressed_blocks, decompress_block,
+                         read_compressed, send_compressed)
+from metrics import (MetricsEndpoint, MetricsRegistry, COMMAND_BUCKETS, TRANSFER_BUCKETS, METRICS_HOST,
+                     METRICS_PORT)
 
 class Colors:
     BLACK = '\033[30m'
@@ -16,6 +35,40 @@ class Colors:
     WHITE = '\033[37m'
     RESET = '\033[0m'
 
+# Size of the reusable buffer used when streaming uploads to disk
+RECV_BUFFER_SIZE = 256 * 1024
+# Pending connection queue size, large enough for bursts of clients
+LISTEN_BACKLOG = 128
+# Worker threads the asyncio server uses for disk I/O
+ASYNC_IO_WORKERS = 8
+# Largest sendfile the asyncio server runs in one go: each runs on the event
+# loop, so a larger one delays the commands of every other connection
+ASYNC_SENDFILE_SIZE = 1024 * 1024
+# Most files in one LIST_FILES page
+MAX_PAGE_SIZE = 10000
+# Changes are collected for this many seconds before watching clients are notified
+NOTIFY_DELAY = 0.5
+# Seconds a watcher's connection may take to accept an event before the
+# watcher is taken to have stopped reading and is disconnected
+WATCHER_SEND_TIMEOUT = 0.5
+# Flag for sends that never block; where there is none, select tells when a send can start
+SEND_NONBLOCKING = getattr(socket, 'MSG_DONTWAIT', 0)
+# In batch transfers, files up to this size are read whole and their frames
+# coalesced with their neighbours' into writes of about BATCH_BUFFER_SIZE
+BATCH_INLINE_SIZE = 64 * 1024
+BATCH_BUFFER_SIZE = 1024 * 1024
+# Files opened per step of a batch (one executor call in the asyncio server)
+BATCH_READ_FILES = 256
+# Seconds a data connection token stays valid once issued
+DATA_TOKEN_LIFETIME = 30
+# Commands whose latency is recorded by name; others are recorded as 'other',
+# so clients cannot make up label values. Transfers have metrics of their own.
+COMMANDS = ('LIST_FILES', 'LIST_CHANGES', 'LIST_DIR', 'FILE_INFO', 'SIGNATURES', 'WATCH', 'DATA_TOKEN', 'ATTACH',
+            'STATS')
+TRANSFER_COMMANDS = ('UPLOAD', 'GET_FILE', 'GET_RANGE', 'GET_BATCH', 'DELTA')
+# Commands sending file data, refused on a control connection once it has data connections
+BULK_COMMANDS = TRANSFER_COMMANDS + ('SIGNATURES',)
+
 class Server:
     def __init__(self, host='0.0.0.0', port=8888):
         self.host = host
@@ -24,33 +77,120 @@ class Server:
         self.running = False
         self.clients = []
         self.shared_space = None
-        self.file_list = []
+        self.index = FileIndex()
+        # Content digests for FILE_INFO, computed in the background
+        self.hashes = HashCache()
+        self.active_uploads = set()
+        self.uploads_lock = threading.Lock()
+        # Downloads being sent: whole files, byte ranges and batches
+        self.active_downloads = 0
+        self.downloads_lock = threading.Lock()
+        # Sessions that get change events, with the generation they were last told about
+        self.watchers = {}
+        self.watchers_lock = threading.Lock()
+        self.notify_lock = threading.Lock()
+        self.notify_timer = None
+        self.index.add_listener(self.schedule_notify)
+        # Data connection tokens not yet presented: token -> (control session, client IP, expiry)
+        self.data_tokens = {}
+        # Control sessions that have attached a data connection
+        self.data_sessions = set()
+        self.tokens_lock = threading.Lock()
+        self.started_at = None
+        self.metrics_endpoint = None
+        self.setup_metrics()
+    
+    def setup_metrics(self):
+        """Register the server's metrics, see metrics.py"""
+        self.metrics = MetricsRegistry()
+        self.command_seconds = self.metrics.histogram('command_seconds', "Time taken to handle a command",
+                                                      COMMAND_BUCKETS, ('command',))
+        self.transfer_seconds = self.metrics.histogram('transfer_seconds', "Duration of file transfers",
+                                                       TRANSFER_BUCKETS, ('command',))
+        transfer_bytes = self.metrics.counter('transfer_bytes_total', "File data sent and received, "
+                                              "compressed transfers at their compressed size", ('direction',))
+        self.bytes_sent = transfer_bytes.labels('sent')
+        self.bytes_received = transfer_bytes.labels('received')
+        self.connections_accepted = self.metrics.counter('connections_total', "Connections accepted").labels()
+        self.connection_errors = self.metrics.counter('connection_errors_total',
+                                                      "Connections closed by an error").labels()
+        self.metrics.gauge('connections', "Open connections", lambda: len(self.clients))
+        self.metrics.gauge('watchers', "Connections watching the file list", lambda: len(self.watchers))
+        self.watchers_dropped = self.metrics.counter('watchers_dropped_total',
+                                                     "Watchers disconnected for not reading their events").labels()
+        self.metrics.gauge('uploads_active', "Uploads in progress", lambda: len(self.active_uploads))
+        self.metrics.gauge('downloads_active', "Downloads in progress, byte ranges and batches included",
+                           lambda: self.active_downloads)
+        self.metrics.gauge('data_tokens', "Data connection tokens not yet presented", lambda: len(self.data_tokens))
+        self.metrics.gauge('hash_queue', "Files waiting to be hashed", lambda: len(self.hashes.pending))
+        self.metrics.gauge('files', "Files in the shared space", lambda: len(self.file_list))
+        self.metrics.gauge('uptime_seconds', "Seconds since the server started",
+                           lambda: round(time.time() - self.started_at, 1) if self.started_at else 0)
+    
+    def record_command(self, command, started):
+        """Add a handled command, started at perf_counter() time started, to the latency metrics"""
+        elapsed = time.perf_counter() - started
+        if command in TRANSFER_COMMANDS:
+            self.transfer_seconds.labels(command).observe(elapsed)
+        else:
+            self.command_seconds.labels(command if command in COMMANDS else 'other').observe(elapsed)
+    
+    def stats(self):
+        """STATS reply: the current value of every metric"""
+        return {'type': 'stats', **self.metrics.snapshot()}
+    
+    def print_stats(self):
+        """Print the metrics to the console"""
+        stats = self.metrics.snapshot()
+        transferred = stats['transfer_bytes_total']
+        print(f"{Colors.CYAN}Uptime: {stats['uptime_seconds']:.0f} s, {stats['connections_total']} connections "
+              f"accepted, {stats['connection_errors_total']} closed by errors{Colors.RESET}")
+        print(f"{Colors.CYAN}Sent: {transferred['sent']} bytes, received: {transferred['received']} bytes{Colors.RESET}")
+        queues = f", I/O queue: {stats['io_queue']}" if 'io_queue' in stats else ""
+        print(f"{Colors.CYAN}Uploads in progress: {stats['uploads_active']}, downloads in progress: "
+              f"{stats['downloads_active']}, watchers: {stats['watchers']}, "
+              f"hash queue: {stats['hash_queue']}{queues}{Colors.RESET}")
+        for name in ('transfer_seconds', 'command_seconds'):
+            for command, latency in sorted(stats[name].items()):
+                if not latency['count']:
+                    continue  # Registered but not observed yet
+                print(f"{Colors.CYAN}  {command:<13} {latency['count']:>8} x  p50 {latency['p50'] * 1000:>9.1f} ms  "
+                      f"p99 {latency['p99'] * 1000:>9.1f} ms{Colors.RESET}")
+    
+    def start_metrics_endpoint(self, port=METRICS_PORT, host=METRICS_HOST):
+        """Serve the metrics in the Prometheus text format at http://host:port/metrics"""
+        if self.metrics_endpoint is None:
+            try:
+                self.metrics_endpoint = MetricsEndpoint(self.metrics, host, port)
+            except OSError as e:
+                print(f"{Colors.RED}Failed to start the metrics endpoint: {e}{Colors.RESET}")
+                return False
+            self.metrics_endpoint.start()
+        host, port = self.metrics_endpoint.address[:2]
+        print(f"{Colors.CYAN}Metrics served at http://{host}:{port}/metrics{Colors.RESET}")
+        return True
+    
+    def stop_metrics_endpoint(self):
+        if self.metrics_endpoint is not None:
+            self.metrics_endpoint.stop()
+            self.metrics_endpoint = None
+    
+    @property
+    def file_list(self):
+        """Files in the shared space, sorted by name"""
+        return self.index.files
     
     def set_shared_space(self, shared_space):
         """Set the shared directory path"""
         self.shared_space = shared_space
-        self.refresh_file_list()
+        self.index.set_root(shared_space)
     
-    def refresh_file_list(self):
+    def refresh_file_list(self, force=True):
         """Refresh the list of files in shared directory"""
-        if not self.shared_space or not os.path.exists(self.shared_space):
-            self.file_list = []
-            return
-        
         try:
-            self.file_list = []
-            with os.scandir(self.shared_space) as entries:
-                for entry in entries:
-                    if entry.is_file():
-                        file_info = {
-                            'name': entry.name,
-                            'size': entry.stat().st_size,
-                            'modified': entry.stat().st_mtime
-                        }
-                        self.file_list.append(file_info)
+            self.index.refresh(force)
         except Exception as e:
             print(f"{Colors.RED}Error refreshing file list: {e}{Colors.RESET}")
-            self.file_list = []
     
     def start_server(self):
         """Start the server in a separate thread"""
@@ -58,19 +198,12 @@ class Server:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.socket.bind((self.host, self.port))
-            self.socket.listen(5)
+            self.socket.listen(LISTEN_BACKLOG)
             self.running = True
+            self.started_at = time.time()
+            self.index.start_polling()
             
-            # Get local IP address for display
-            local_ip = self.get_local_ip()
-            
-            print(f"{Colors.GREEN}Server started successfully!{Colors.RESET}")
-            print(f"{Colors.CYAN}Server listening on:{Colors.RESET}")
-            print(f"{Colors.CYAN}  Local:  http://localhost:{self.port}{Colors.RESET}")
-            print(f"{Colors.CYAN}  Network: http://{local_ip}:{self.port}{Colors.RESET}")
-            print(f"{Colors.YELLOW}Shared space: {self.shared_space}{Colors.RESET}")
-            print(f"{Colors.YELLOW}Files available: {len(self.file_list)}{Colors.RESET}")
-            print(f"{Colors.YELLOW}Waiting for client connections...{Colors.RESET}")
+            self.print_banner()
             
             # Start accepting connections in a separate thread
             server_thread = threading.Thread(target=self.accept_connections)
@@ -83,6 +216,19 @@ class Server:
             print(f"{Colors.RED}Failed to start server: {e}{Colors.RESET}")
             return False
     
+    def print_banner(self):
+        """Print where the server is listening"""
+        # Get local IP address for display
+        local_ip = self.get_local_ip()
+        
+        print(f"{Colors.GREEN}Server started successfully!{Colors.RESET}")
+        print(f"{Colors.CYAN}Server listening on:{Colors.RESET}")
+        print(f"{Colors.CYAN}  Local:  http://localhost:{self.port}{Colors.RESET}")
+        print(f"{Colors.CYAN}  Network: http://{local_ip}:{self.port}{Colors.RESET}")
+        print(f"{Colors.YELLOW}Shared space: {self.shared_space}{Colors.RESET}")
+        print(f"{Colors.YELLOW}Files available: {len(self.file_list)}{Colors.RESET}")
+        print(f"{Colors.YELLOW}Waiting for client connections...{Colors.RESET}")
+    
     def get_local_ip(self):
         """Get the local IP address of the machine"""
         try:
@@ -103,12 +249,14 @@ class Server:
                 print(f"{Colors.GREEN}New connection from {client_address[0]}:{client_address[1]}{Colors.RESET}")
                 
                 # Add client to list
-                self.clients.append((client_socket, client_address))
+                conn = Connection(client_socket)
+                self.connections_accepted.inc()
+                self.clients.append((conn, client_address))
                 
                 # Handle client in a separate thread
                 client_thread = threading.Thread(
                     target=self.handle_client, 
-                    args=(client_socket, client_address)
+                    args=(conn, client_address)
                 )
                 client_thread.daemon = True
                 client_thread.start()
@@ -117,185 +265,1650 @@ class Server:
                 if self.running:
                     print(f"{Colors.RED}Error accepting connection: {e}{Colors.RESET}")
     
-    def handle_client(self, client_socket, client_address):
+    def handle_client(self, conn, client_address):
         """Handle communication with a connected client"""
         client_ip = client_address[0]
         try:
             while self.running:
-                # Receive data from client
-                data = client_socket.recv(1024).decode('utf-8')
-                if not data:
+                # Receive the next frame; commands may be pipelined
+                frame = conn.read_frame()
+                if frame is None:
                     break
                 
+                if frame.type == FRAME_DATA:
+                    # The payload of an upload that was refused; its error was already sent
+                    conn.discard(frame.length)
+                    continue
+                if frame.type == FRAME_TRAILER:
+                    # The checksum of an upload that was refused or failed; a
+                    # reply to it would be taken for the reply to the next command
+                    continue
+                if frame.type != FRAME_COMMAND:
+                    conn.send_message("ERROR: Expected a command")
+                    continue
+                
+                request = frame.payload
+                command = request.get('cmd')
                 timestamp = datetime.now().strftime("%H:%M:%S")
-                print(f"{Colors.CYAN}[{timestamp}] Command from {client_ip}: {Colors.WHITE}{data}{Colors.RESET}")
+                print(f"{Colors.CYAN}[{timestamp}] Command from {client_ip}: {Colors.WHITE}{command}{Colors.RESET}")
+                started = time.perf_counter()
                 
-                # Parse command
-                if data.startswith("UPLOAD:"):
-                    # Format: UPLOAD:filename:filesize
-                    parts = data.split(":")
-                    if len(parts) == 3:
-                        filename = parts[1]
-                        file_size = int(parts[2])
-                        self.receive_file_simple(client_socket, filename, file_size)
-                        continue
-                elif data.startswith("GET_FILE "):
-                    file_index = int(data[9:])
-                    self.send_file(file_index, client_socket)
-                    continue
+                # Commands carrying file data are streamed; the rest get one reply
+                error = self.misrouted(conn, command)
+                if error:
+                    conn.send_message(error)
+                elif command == "UPLOAD":
+                    self.receive_file(conn, request['name'], int(request['size']), request.get('resume', False),
+                                      request.get('modified'), request.get('encoding'), request.get('checksum'),
+                                      request.get(CHECKSUM_ALGORITHM))
+                elif command == "GET_FILE":
+                    with self.download_running():
+                        self.send_file(request, conn)
+                elif command == "GET_RANGE":
+                    with self.download_running():
+                        self.send_file(request, conn, int(request['offset']), request.get('length'))
+                elif command == "GET_BATCH":
+                    with self.download_running():
+                        self.send_batch(request, conn)
+                elif command == "SIGNATURES":
+                    self.send_signatures(request, conn)
+                elif command == "DELTA":
+                    self.receive_delta(conn, request)
+                elif command == "WATCH":
+                    conn.send_message(self.watch(conn))
+                elif command == "DATA_TOKEN":
+                    conn.send_message(self.issue_data_token(conn, client_ip))
+                elif command == "ATTACH":
+                    try:
+                        conn.send_message(self.attach_data_connection(request.get('token'), client_ip))
+                    except ProtocolError as e:
+                        conn.send_message(f"ERROR: {e}")
+                        raise
                 else:
-                    response = self.process_command(data)
+                    response = self.process_command(request)
                     if response:
-                        client_socket.send(response.encode('utf-8'))
+                        conn.send_message(response)
+                self.record_command(command, started)
                 
         except Exception as e:
+            self.connection_errors.inc()
             print(f"{Colors.RED}Error with client {client_ip}: {e}{Colors.RESET}")
         finally:
             # Clean up
-            client_socket.close()
+            self.unwatch(conn)
+            self.revoke_data_tokens(conn)
+            conn.close()
             self.clients = [c for c in self.clients if c[1] != client_address]
             print(f"{Colors.YELLOW}Client {client_ip} disconnected{Colors.RESET}")
     
-    def process_command(self, command):
-        """Process client commands"""
+    def process_command(self, request):
+        """Process client commands, returning an encoded JSON response or a text message"""
         try:
+            command = request.get('cmd')
             if command == "LIST_FILES":
-                return self.list_files()
-            elif command.startswith("FILE_INFO "):
-                file_index = int(command[10:])
-                return self.get_file_info(file_index)
+                return self.fit_reply(self.list_files(request))
+            elif command == "LIST_CHANGES":
+                return self.fit_reply(self.list_changes(int(request['since'])))
+            elif command == "LIST_DIR":
+                return self.fit_reply(self.list_dir(request.get('path', '')))
+            elif command == "FILE_INFO":
+                return self.fit_reply(self.get_file_info(request))
+            elif command == "STATS":
+                return self.fit_reply(self.stats())
             else:
                 # Regular message
-                return f"Server received: {command}"
+                return f"Server received: {request.get('text', command)}"
         except Exception as e:
             return f"ERROR: {str(e)}"
     
-    def list_files(self):
-        """List all files in the shared directory"""
-        self.refresh_file_list()
-        return json.dumps({'type': 'file_list', 'files': self.file_list})
+    def fit_reply(self, response):
+        """Encode a reply, replacing one too large for a control frame by one the client can act on"""
+        data = encode_message(response)
+        if len(data) - HEADER.size <= MAX_CONTROL_SIZE:
+            return data
+        if isinstance(response, dict) and response.get('type') == 'file_list' and len(response['files']) > 1:
+            # A page of very long names: send fewer files, the client asks for the rest from where it ends
+            files = response['files']
+            while len(data) - HEADER.size > MAX_CONTROL_SIZE and len(files) > 1:
+                files = files[:max(1, len(files) * MAX_CONTROL_SIZE // (len(data) - HEADER.size) * 9 // 10)]
+                data = encode_message(dict(response, files=files))
+            if len(data) - HEADER.size <= MAX_CONTROL_SIZE:
+                return data
+        if isinstance(response, dict) and response.get('type') == 'file_changes':
+            # Too many changes to send: the client lists the files again
+            return encode_message({'type': 'file_changes', 'since': response['since'], 'reset': True,
+                                   'generation': response['generation']})
+        return f"ERROR: Reply too large ({len(data)} bytes); ask for it in pages"
+    
+    def list_files(self, request=None):
+        """List one page of the files in the shared directory.
+        
+        offset/limit/sort/reverse/pattern select the page, of at most
+        MAX_PAGE_SIZE files; it comes with the total number of matching
+        files. There is no unpaginated listing: a large share would not fit
+        in a control frame.
+        """
+        self.refresh_file_list(force=False)
+        request = request or {}
+        offset = int(request.get('offset', 0))
+        limit = request.get('limit')
+        limit = MAX_PAGE_SIZE if limit is None else min(int(limit), MAX_PAGE_SIZE)
+        files, total, generation = self.index.query(offset, limit, request.get('sort', 'name'),
+                                                    bool(request.get('reverse', False)), request.get('pattern'))
+        return {'type': 'file_list', 'files': files, 'offset': offset, 'total': total,
+                'generation': generation}
+    
+    def list_changes(self, since):
+        """Files added, removed or modified since a listing generation.
+        
+        If the changes are too old to be known, the reply has 'reset' set and
+        the client must list the files again.
+        """
+        self.refresh_file_list(force=False)
+        changes = self.index.changes(since)
+        if changes is None:
+            return {'type': 'file_changes', 'since': since, 'reset': True,
+                    'generation': self.index.generation}
+        return dict(changes, type='file_changes', since=since)
+    
+    def list_dir(self, path):
+        """Subdirectories and files directly inside one directory of the shared space"""
+        self.refresh_file_list(force=False)
+        path = normalize_path(str(path))
+        listing = self.index.list_dir(path)
+        if listing is None:
+            raise LookupError(f"Unknown directory: {path}")
+        dirs, files = listing
+        return {'type': 'dir_list', 'path': path, 'dirs': dirs, 'files': files,
+                'generation': self.index.generation}
+    
+    def watch(self, session):
+        """Send change events to a session from now on"""
+        with self.watchers_lock:
+            generation = self.index.generation
+            self.watchers[session] = generation
+        return {'type': 'watching', 'generation': generation}
+    
+    def unwatch(self, session):
+        with self.watchers_lock:
+            self.watchers.pop(session, None)
+    
+    def issue_data_token(self, session, client_ip):
+        """A single-use token with which the client of a control session attaches a data connection"""
+        token = secrets.token_hex(16)
+        now = time.monotonic()
+        with self.tokens_lock:
+            self.data_tokens = {t: entry for t, entry in self.data_tokens.items() if entry[2] > now}
+            self.data_tokens[token] = (session, client_ip, now + DATA_TOKEN_LIFETIME)
+        return {'type': 'data_token', 'token': token}
+    
+    def attach_data_connection(self, token, client_ip):
+        """Accept a connection presenting a token, from the client it was issued to.
+        
+        From then on the control session's transfers go over its data
+        connections: bulk commands on the control connection are refused.
+        """
+        with self.tokens_lock:
+            entry = self.data_tokens.pop(token, None)
+            if entry is None or entry[1] != client_ip or entry[2] < time.monotonic():
+                raise ProtocolError("Invalid or expired data token")
+            self.data_sessions.add(entry[0])
+        return {'type': 'attached'}
+    
+    def revoke_data_tokens(self, session):
+        """Forget the unused tokens of a control session that ended"""
+        with self.tokens_lock:
+            self.data_tokens = {t: entry for t, entry in self.data_tokens.items() if entry[0] is not session}
+            self.data_sessions.discard(session)
+    
+    def misrouted(self, session, command):
+        """Error for a bulk command sent on a control connection that has data connections, else None"""
+        if command in BULK_COMMANDS and session in self.data_sessions:
+            return f"ERROR: {command} must be sent on a data connection"
+        return None
+    
+    def schedule_notify(self):
+        """Notify watchers shortly, so a burst of changes goes out as one event"""
+        with self.watchers_lock:
+            if self.notify_timer is None and self.watchers:
+                self.notify_timer = threading.Timer(NOTIFY_DELAY, self.notify_watchers)
+                self.notify_timer.daemon = True
+                self.notify_timer.start()
     
-    def get_file_info(self, file_index):
-        """Get information about a specific file by index"""
-        if not self.file_list or file_index < 0 or file_index >= len(self.file_list):
-            return "ERROR: Invalid file index"
+    def notify_watchers(self):
+        """Send every watcher a file_changes event covering what it has not seen yet"""
+        with self.notify_lock:
+            with self.watchers_lock:
+                self.notify_timer = None
+                watchers = list(self.watchers.items())
+            busy = self.send_events(watchers)
         
+        if busy:
+            # Try again for sessions that were in the middle of a transfer
+            self.schedule_notify()
+    
+    def send_events(self, watchers):
+        """Push pending changes to (session, generation) pairs, return True if any was busy"""
+        # Watchers are normally all at the same generation, so one event serves them all
+        events = {}
+        busy = False
+        for session, since in watchers:
+            if since not in events:
+                changes = self.index.changes(since)
+                if changes is None:
+                    changes = {'reset': True, 'generation': self.index.generation}
+                if changes['generation'] == since:
+                    events[since] = None
+                else:
+                    event = encode_event(dict(changes, type='file_changes', since=since))
+                    if len(event) - HEADER.size > MAX_CONTROL_SIZE:
+                        # Too many changes to send: the watcher lists the files again
+                        event = encode_event({'type': 'file_changes', 'since': since, 'reset': True,
+                                              'generation': changes['generation']})
+                    events[since] = (changes['generation'], event)
+            if events[since] is None:
+                continue
+            generation, event = events[since]
+            if not self.push_event(session, event):
+                busy = True
+                continue
+            with self.watchers_lock:
+                if session in self.watchers:
+                    self.watchers[session] = generation
+        return busy
+    
+    def push_event(self, conn, event):
+        """Send an encoded event unless the connection is busy sending, return False if busy.
+        
+        The event is sent without blocking for more than WATCHER_SEND_TIMEOUT,
+        so a watcher that stopped reading cannot hold up the others; it is
+        disconnected instead.
+        """
+        if not conn.send_lock.acquire(blocking=False):
+            return False
         try:
-            file_info = self.file_list[file_index]
-            filename = file_info['name']
-            filepath = os.path.join(self.shared_space, filename)
-            
-            if not os.path.exists(filepath):
-                return "ERROR: File not found on disk"
-            
+            if not send_event(conn.sock, event, WATCHER_SEND_TIMEOUT):
+                self.drop_watcher(conn)
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        except OSError:
+            pass  # The client's handler notices the broken connection
+        finally:
+            conn.send_lock.release()
+        return True
+    
+    def drop_watcher(self, session):
+        """Stop sending events to a watcher that does not read them; its connection is closed by the caller"""
+        self.unwatch(session)
+        self.watchers_dropped.inc()
+        print(f"{Colors.YELLOW}Disconnecting a watcher that stopped reading its events{Colors.RESET}")
+    
+    def resolve_file(self, request):
+        """Map a request's file 'id', 'name' or list 'index' to (name, path).
+        
+        Raises LookupError if the file is not available. Ids and names stay
+        valid as other files come and go; an index is a position in the
+        current name-sorted listing.
+        """
+        if 'id' in request:
+            filename = self.index.find(str(request['id']))
+            if filename is None:
+                raise LookupError("Unknown file id")
+        elif 'name' in request:
+            filename = str(request['name'])
+            if filename not in self.index.entries:
+                raise LookupError("Unknown file name")
+        elif 'index' in request:
+            file_index = int(request['index'])
+            file_list = self.file_list
+            if not file_list or file_index < 0 or file_index >= len(file_list):
+                raise LookupError("Invalid file index")
+            filename = file_list[file_index]['name']
+        else:
+            raise LookupError("No file id, name or index given")
+        
+        filepath = os.path.join(self.shared_space, filename)
+        if not os.path.exists(filepath):
+            raise LookupError("File not found on disk")
+        return filename, filepath
+    
+    def get_file_info(self, request):
+        """Get information about a specific file by id, name or index"""
+        try:
+            filename, filepath = self.resolve_file(request)
             stat = os.stat(filepath)
-            file_info = {
+            digest = self.file_hash(filepath, stat)
+            return {
                 'type': 'file_info',
-                'index': file_index,
+                'id': file_id(filename, stat),
                 'name': filename,
                 'size': stat.st_size,
                 'modified': stat.st_mtime,
-                'readable': os.access(filepath, os.R_OK)
+                'readable': os.access(filepath, os.R_OK),
+                CHECKSUM_ALGORITHM: digest and digest.hex(),
+                'hash_pending': digest is None
             }
-            return json.dumps(file_info)
         except Exception as e:
             return f"ERROR: {str(e)}"
     
-    def send_file(self, file_index, client_socket):
-        """Send a file to the client by index"""
-        if not self.file_list or file_index < 0 or file_index >= len(self.file_list):
-            client_socket.send("ERROR: Invalid file index".encode('utf-8'))
-            return
-        
+    def file_hash(self, filepath, stat):
+        """Cached content digest of a file, None while it is being hashed"""
         try:
-            file_info = self.file_list[file_index]
-            filename = file_info['name']
-            filepath = os.path.join(self.shared_space, filename)
-            
-            if not os.path.exists(filepath):
-                client_socket.send("ERROR: File not found on disk".encode('utf-8'))
-                return
-            
-            file_size = os.path.getsize(filepath)
-            
-            # Send file info first
-            file_info_response = json.dumps({
+            return self.hashes.lookup(filepath, stat)
+        except Exception as e:
+            print(f"{Colors.RED}Hash cache unavailable: {e}{Colors.RESET}")
+            return None
+    
+    def describe_transfer(self, filename, stat, offset=0, length=None):
+        """Build the header message for a whole-file or ranged transfer, return (message, count)"""
+        file_size = stat.st_size
+        if offset == 0 and length is None:
+            return {
                 'type': 'file_transfer',
                 'name': filename,
-                'size': file_size
-            })
-            client_socket.send(file_info_response.encode('utf-8'))
-            
-            # Wait for client acknowledgment
-            ack = client_socket.recv(1024).decode('utf-8')
-            if ack != "READY":
-                return
-            
-            # Send file content
-            print(f"{Colors.YELLOW}Sending file: {filename} ({file_size} bytes){Colors.RESET}")
+                'size': file_size,
+                'modified': stat.st_mtime
+            }, file_size
+        
+        if offset < 0 or offset > file_size or (length is not None and int(length) < 0):
+            raise LookupError("Invalid byte range")
+        count = file_size - offset if length is None else min(int(length), file_size - offset)
+        return {
+            'type': 'file_range',
+            'name': filename,
+            'size': file_size,
+            'modified': stat.st_mtime,
+            'offset': offset,
+            'length': count
+        }, count
+    
+    def requested_checksum(self, request):
+        """A running checksum if the request asks for a trailer after the content, else None"""
+        return new_checksum() if request.get('checksum') == CHECKSUM_ALGORITHM else None
+    
+    def cached_digest(self, checksum, stat, offset, count):
+        """The cached digest of a whole file for its checksum trailer, else None.
+        
+        With it the content can go out with sendfile instead of being read
+        through a buffer to hash it on the way.
+        """
+        if checksum is None or offset or count != stat.st_size:
+            return None
+        return self.hashes.cached(stat)
+    
+    def remember_digest(self, filepath, f, stat, offset, count, checksum):
+        """Cache the digest of a whole file hashed as it was sent, unless the file changed meanwhile"""
+        if not offset and count == stat.st_size and cache_key(os.fstat(f.fileno())) == cache_key(stat):
+            self.hashes.store(filepath, checksum.digest(), stat)
+    
+    def describe_sent(self, filename, encoding, wire_size, size):
+        """Log line for a completed transfer, with the compression achieved if any"""
+        if not encoding:
+            return f"File sent successfully: {filename}"
+        ratio = size / wire_size if wire_size else 1.0
+        return f"File sent successfully: {filename} ({encoding}, {wire_size} bytes on the wire, {ratio:.1f}x)"
+    
+    def send_file(self, request, conn, offset=0, length=None):
+        """Send the requested file, or length bytes of it starting at offset.
+        
+        If the request lists accepted codecs in 'compress' and the content is
+        worth compressing, it is sent as compressed blocks instead of a
+        single DATA frame and the reply names the codec in 'encoding'. With
+        'checksum' the content is followed by a checksum trailer, from the
+        hash cache for a whole file hashed before, else computed as it is sent.
+        """
+        try:
+            filename, filepath = self.resolve_file(request)
+        except LookupError as e:
+            conn.send_message(f"ERROR: {e}")
+            return
+        
+        try:
             with open(filepath, 'rb') as f:
-                file_data = f.read()
-                client_socket.send(file_data)
+                stat = os.fstat(f.fileno())
+                file_size = stat.st_size
+                try:
+                    message, count = self.describe_transfer(filename, stat, offset, length)
+                except LookupError as e:
+                    conn.send_message(f"ERROR: {e}")
+                    return
+                encoding = choose_encoding(f, filename, offset, count, request.get('compress'))
+                if encoding:
+                    message['encoding'] = encoding
+                checksum = self.requested_checksum(request)
+                if checksum is not None:
+                    message['checksum'] = CHECKSUM_ALGORITHM
+                digest = self.cached_digest(checksum, stat, offset, count)
+                running = checksum if digest is None else None
+                
+                # File info first, then the content as a single DATA frame or compressed blocks
+                if message['type'] == 'file_transfer':
+                    print(f"{Colors.YELLOW}Sending file: {filename} ({file_size} bytes){Colors.RESET}")
+                with conn.send_lock:
+                    conn.send_message(message)
+                    if encoding:
+                        sent_size, wire_size = send_compressed(conn, f, offset, count, encoding, checksum=running)
+                    else:
+                        sent_size = wire_size = conn.send_file_data(f, offset, count, checksum=running)
+                    if checksum is not None and sent_size == count:
+                        conn.send_trailer(digest or checksum)
+                if running is not None and sent_size == count:
+                    self.remember_digest(filepath, f, stat, offset, count, checksum)
             
-            print(f"{Colors.GREEN}File sent successfully: {filename}{Colors.RESET}")
+            self.bytes_sent.inc(wire_size)
+            if sent_size != count:
+                # The frame promised more bytes than we sent, so the stream is unusable
+                print(f"{Colors.RED}File send incomplete: {sent_size}/{count} bytes{Colors.RESET}")
+                conn.close()
+            elif message['type'] == 'file_transfer':
+                print(f"{Colors.GREEN}{self.describe_sent(filename, encoding, wire_size, sent_size)}{Colors.RESET}")
             
         except Exception as e:
             print(f"{Colors.RED}Error sending file: {e}{Colors.RESET}")
     
-    def receive_file_simple(self, client_socket, filename, file_size):
-        """ULTRA SIMPLE: Receive a file from a client"""
-        try:
-            filepath = os.path.join(self.shared_space, filename)
+    def batch_refs(self, request):
+        """Generate the files of a GET_BATCH request as id / name references.
+        
+        Each directory in 'dirs' stands for every file below it, taken from
+        the index as the batch proceeds. An unknown directory is passed on as
+        a name, so it is reported missing like any other unknown file.
+        """
+        for file_id in request.get('ids', []):
+            yield {'id': file_id}
+        for name in request.get('names', []):
+            yield {'name': name}
+        for directory in request.get('dirs', []):
+            try:
+                path = normalize_path(str(directory))
+            except ValueError:
+                path = None
+            if path is None or path not in self.index.dirs:
+                yield {'name': directory}
+                continue
+            for entry in self.index.subtree(path):
+                yield {'name': entry['name']}
+    
+    def read_batch(self, refs, missing, checksums=False):
+        """Open the files of one step of a batch and read the small ones.
+        
+        Returns a list of pieces to send in order: a bytearray holding the
+        encoded frames of consecutive small files, or (message, f) for a large file
+        and its path, whose DATA frame is still to be sent from the open file. Files that
+        cannot be found or opened are added to missing. With checksums every
+        file is followed by its checksum trailer.
+        """
+        pieces = []
+        buffer = bytearray()
+        for ref in refs:
+            try:
+                filename, filepath = self.resolve_file(ref)
+                f = open(filepath, 'rb')
+            except (LookupError, OSError):
+                missing.append(ref.get('id', ref.get('name')))
+                continue
             
-            print(f"{Colors.YELLOW}Receiving file: {filename} ({file_size} bytes){Colors.RESET}")
+            try:
+                stat = os.fstat(f.fileno())
+                if stat.st_size > BATCH_INLINE_SIZE:
+                    if buffer:
+                        pieces.append(buffer)
+                        buffer = bytearray()
+                    message = {'type': 'batch_file', 'name': filename, 'size': stat.st_size,
+                               'modified': stat.st_mtime}
+                    if checksums:
+                        message['checksum'] = CHECKSUM_ALGORITHM
+                    pieces.append((message, f, filepath))
+                    f = None
+                    continue
+                
+                # Read straight into the buffer, behind room left for the two headers
+                message_at = len(buffer)
+                data_at = message_at + HEADER.size
+                buffer.extend(bytes(HEADER.size + stat.st_size))
+                with memoryview(buffer) as view:
+                    size = f.readinto(view[data_at:])
+            except OSError:
+                missing.append(ref.get('id', ref.get('name')))
+                continue
+            finally:
+                if f is not None:
+                    f.close()
             
-            # Just receive all data at once
-            received_data = b""
-            while len(received_data) < file_size:
-                chunk = client_socket.recv(file_size - len(received_data))
-                if not chunk:
+            del buffer[data_at + size:]
+            message = {'type': 'batch_file', 'name': filename, 'size': size, 'modified': stat.st_mtime}
+            if checksums:
+                message['checksum'] = CHECKSUM_ALGORITHM
+                checksum = new_checksum()
+                with memoryview(buffer) as view:
+                    checksum.update(view[data_at:])
+                buffer += encode_trailer(checksum)
+            buffer[message_at:data_at] = encode_header(FRAME_DATA, size)
+            buffer[message_at:message_at] = encode_message(message)
+            if len(buffer) >= BATCH_BUFFER_SIZE:
+                pieces.append(buffer)
+                buffer = bytearray()
+        if buffer:
+            pieces.append(buffer)
+        return pieces
+    
+    def send_batch(self, request, conn):
+        """Stream many files back to back, each as a batch_file message and a DATA frame.
+        
+        There is no per-file acknowledgement; a final batch_complete message
+        reports how many files were sent and which could not be found.
+        """
+        if request.get('dirs'):
+            self.refresh_file_list(force=False)
+        refs = self.batch_refs(request)
+        checksums = request.get('checksum') == CHECKSUM_ALGORITHM
+        missing = []
+        total = 0
+        print(f"{Colors.YELLOW}Sending batch{Colors.RESET}")
+        with conn.send_lock:
+            while True:
+                step = list(islice(refs, BATCH_READ_FILES))
+                if not step:
                     break
-                received_data += chunk
+                total += len(step)
+                pieces = self.read_batch(step, missing, checksums)
+                for i, piece in enumerate(pieces):
+                    if not isinstance(piece, tuple):
+                        conn.sock.sendall(piece)
+                        self.bytes_sent.inc(len(piece))
+                        continue
+                    message, f, filepath = piece
+                    checksum = new_checksum() if checksums else None
+                    try:
+                        with f:
+                            stat = os.fstat(f.fileno())
+                            digest = self.cached_digest(checksum, stat, 0, message['size'])
+                            running = checksum if digest is None else None
+                            conn.send_message(message)
+                            sent_size = conn.send_file_data(f, 0, message['size'], checksum=running)
+                            if running is not None and sent_size == message['size']:
+                                self.remember_digest(filepath, f, stat, 0, message['size'], checksum)
+                        self.bytes_sent.inc(sent_size)
+                        if checksum is not None and sent_size == message['size']:
+                            conn.send_trailer(digest or checksum)
+                    except BaseException:
+                        self.close_batch_files(pieces[i + 1:])
+                        raise
+                    if sent_size != message['size']:
+                        # The frame promised more bytes than we sent, so the stream is unusable
+                        print(f"{Colors.RED}File send incomplete: {message['name']}{Colors.RESET}")
+                        self.close_batch_files(pieces[i + 1:])
+                        conn.close()
+                        return
             
-            # Write to file
-            with open(filepath, 'wb') as f:
-                f.write(received_data)
+            sent = total - len(missing)
+            conn.send_message({'type': 'batch_complete', 'count': sent, 'missing': missing})
+        print(f"{Colors.GREEN}Batch sent: {sent} files{Colors.RESET}")
+    
+    def close_batch_files(self, pieces):
+        """Close the open files of batch pieces that will not be sent"""
+        for piece in pieces:
+            if isinstance(piece, tuple):
+                piece[1].close()
+    
+    def claim_upload(self, filename):
+        """Mark filename as being uploaded, False if another upload already has it"""
+        with self.uploads_lock:
+            if filename in self.active_uploads:
+                return False
+            self.active_uploads.add(filename)
+            return True
+    
+    def release_upload(self, filename):
+        with self.uploads_lock:
+            self.active_uploads.discard(filename)
+    
+    @contextmanager
+    def download_running(self):
+        """Count a download as in progress while the block runs"""
+        with self.downloads_lock:
+            self.active_downloads += 1
+        try:
+            yield
+        finally:
+            with self.downloads_lock:
+                self.active_downloads -= 1
+    
+    def save_partial(self, partial, f, received_size):
+        """Keep an interrupted upload on disk so the client can resume it"""
+        try:
+            partial.checkpoint(f, received_size)
+            print(f"{Colors.YELLOW}Kept {received_size} bytes of {partial.name} for resume{Colors.RESET}")
+        except OSError as e:
+            print(f"{Colors.RED}Could not save partial upload: {e}{Colors.RESET}")
+        finally:
+            f.close()
+    
+    def upload_path(self, filename):
+        """Check the name of an upload, return (name, path); raises ValueError if invalid"""
+        filename = normalize_path(str(filename))
+        if not filename:
+            raise ValueError("No file name given")
+        if filename.count('/') > MAX_DEPTH:
+            raise ValueError(f"Path too deep: {filename}")
+        return filename, self.index.path(filename)
+    
+    def receive_file(self, conn, filename, file_size, resume=False, source=None, encoding=None, checksum=None,
+                     digest=None):
+        """Stream a file from a client into the shared space, continuing a partial upload if asked.
+        
+        The name may be a relative path; missing directories are created. Once
+        upload_ready has been sent the client gets either upload_complete or
+        an error, so several uploads can be pipelined on one connection; the
+        content and trailer a client sent ahead for a refused upload are
+        skipped without a reply.
+        A client may offer to send compressed blocks with 'encoding'; the
+        upload_ready reply confirms the codec, or None for raw data. With
+        'checksum' the content must be followed by a matching checksum
+        trailer, or the file is discarded. A client that names the content's
+        digest gets upload_complete straight away, instead of upload_ready,
+        if a file with that content is already in the shared space.
+        """
+        try:
+            filename, filepath = self.upload_path(filename)
+        except ValueError as e:
+            conn.send_message(f"ERROR: {e}")
+            return
+        if not self.claim_upload(filename):
+            conn.send_message(f"ERROR: {filename} is already being uploaded")
+            return
+        
+        method = self.deduplicate(filename, filepath, file_size, digest, source) if digest else None
+        if method:
+            conn.send_message({'type': 'upload_complete', 'name': filename, 'size': file_size,
+                               'deduplicated': method})
+            print(f"{Colors.GREEN}File uploaded from an identical copy: {filename} ({method}){Colors.RESET}")
+            self.release_upload(filename)
+            return
+        
+        partial = PartialFile(self.shared_space, filename, file_size, source)
+        f = None
+        received_size = 0
+        wire_size = 0
+        remaining = 0
+        try:
+            # Tell the client how much of the file we already hold
+            offset = partial.resume_offset() if resume else 0
+            f = partial.open(offset)
+            received_size = offset
+            encoding = encoding if encoding in CODECS else None
+            checksum = self.requested_checksum({'checksum': checksum})
+            conn.send_message({'type': 'upload_ready', 'name': filename, 'offset': offset,
+                               'encoding': encoding, 'checksum': checksum and CHECKSUM_ALGORITHM})
+            
+            if encoding:
+                print(f"{Colors.YELLOW}Receiving file: {filename} ({file_size} bytes from {offset}, "
+                      f"{encoding}){Colors.RESET}")
+                checkpoint_at = received_size + CHECKPOINT_INTERVAL
+                for data, length in read_compressed(conn, encoding):
+                    wire_size += length
+                    if received_size + len(data) > file_size:
+                        raise ProtocolError("Upload larger than announced")
+                    f.write(data)
+                    if checksum is not None:
+                        checksum.update(data)
+                    received_size += len(data)
+                    if received_size >= checkpoint_at:
+                        partial.checkpoint(f, received_size)
+                        checkpoint_at = received_size + CHECKPOINT_INTERVAL
+                if received_size != file_size:
+                    raise ProtocolError(f"Upload smaller than announced: {received_size}/{file_size} bytes")
+            else:
+                frame = conn.read_frame()
+                if frame is None or frame.type != FRAME_DATA:
+                    raise ProtocolError("Expected file data after UPLOAD")
+                remaining = frame.length
+                if frame.length != file_size - offset:
+                    raise ProtocolError(f"Upload size mismatch: {frame.length} != {file_size - offset}")
+                
+                if offset:
+                    print(f"{Colors.YELLOW}Resuming upload: {filename} at {offset}/{file_size} bytes{Colors.RESET}")
+                else:
+                    print(f"{Colors.YELLOW}Receiving file: {filename} ({file_size} bytes){Colors.RESET}")
+                
+                # Receive into one reusable buffer and write to the partial file,
+                # renamed into place only once the whole file has arrived
+                buffer = memoryview(bytearray(RECV_BUFFER_SIZE))
+                checkpoint_at = received_size + CHECKPOINT_INTERVAL
+                while remaining:
+                    n = conn.recv_into(buffer, min(RECV_BUFFER_SIZE, remaining))
+                    if not n:
+                        break
+                    f.write(buffer[:n])
+                    if checksum is not None:
+                        checksum.update(buffer[:n])
+                    remaining -= n
+                    received_size += n
+                    wire_size += n
+                    if received_size >= checkpoint_at:
+                        partial.checkpoint(f, received_size)
+                        checkpoint_at = received_size + CHECKPOINT_INTERVAL
             
-            if len(received_data) == file_size:
+            if received_size == file_size:
+                f.close()
+                f = None
+                if checksum is not None:
+                    self.verify_upload(partial, conn.read_frame(), checksum)
+                partial.commit(filepath, source)
+                if checksum is not None and not offset:
+                    self.hashes.store(filepath, checksum.digest())
+                conn.send_message({'type': 'upload_complete', 'name': filename, 'size': file_size})
                 print(f"{Colors.GREEN}File uploaded successfully: {filename}{Colors.RESET}")
-                self.refresh_file_list()
+                self.index.update_file(filename)
             else:
-                print(f"{Colors.RED}File upload incomplete: {len(received_data)}/{file_size} bytes{Colors.RESET}")
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+                print(f"{Colors.RED}File upload incomplete: {received_size}/{file_size} bytes{Colors.RESET}")
         
         except Exception as e:
             print(f"{Colors.RED}Error receiving file: {e}{Colors.RESET}")
+            # Skip the rest of the payload so the next frame can be read
+            if remaining:
+                conn.discard(remaining)
+            try:
+                conn.send_message(f"ERROR: Upload of {filename} failed: {e}")
+            except OSError:
+                pass
+        finally:
+            self.bytes_received.inc(wire_size)
+            if f is not None:
+                self.save_partial(partial, f, received_size)
+            self.release_upload(filename)
 
+    def verify_upload(self, partial, trailer, checksum):
+        """Check an upload's checksum trailer; a corrupt upload is deleted rather than kept for resume"""
+        try:
+            verify_trailer(trailer, checksum)
+        except ChecksumError:
+            partial.discard()
+            raise
+    
+    def find_duplicate(self, digest, size):
+        """Path of a file in the shared space with this content, or None.
+        
+        Only digests already in the hash cache are compared, so an upload
+        never waits for a file to be hashed. Files of the same size that
+        were never hashed are queued for the background hashers instead,
+        and can stand in for the uploads after this one.
+        """
+        for path in self.hashes.find(digest, size):
+            try:
+                name = os.path.relpath(path, self.shared_space).replace(os.sep, '/')
+            except ValueError:
+                continue  # On another drive
+            if name in self.index.entries:
+                return path
+        candidates = [entry['name'] for entry in self.file_list if entry['size'] == size]
+        for name in candidates[:DEDUP_CANDIDATES]:
+            path = self.index.path(name)
+            try:
+                if self.hashes.lookup(path) == digest:
+                    return path
+            except OSError:
+                pass
+        return None
+    
+    def deduplicate(self, filename, filepath, file_size, digest, modified=None):
+        """Create an upload from an identical file already shared, return how, or None to receive it.
+        
+        modified is the upload's modification time. A hard link shares the
+        time of its source, so a source with another time is only cloned
+        copy-on-write, or else the upload is received.
+        """
+        if file_size < DEDUP_MIN_SIZE:
+            return None
+        try:
+            digest = bytes.fromhex(str(digest))
+            source = self.find_duplicate(digest, file_size)
+            if source is None:
+                return None
+            source_stat = os.stat(source)
+            retime = (isinstance(modified, (int, float)) and not isinstance(modified, bool)
+                      and modified != source_stat.st_mtime)
+            partial = PartialFile(self.shared_space, filename, file_size)
+            if os.path.exists(filepath) and os.path.samefile(source, filepath):
+                # A re-upload of the file as it is: linking it onto itself would leave the link behind
+                if retime and source_stat.st_nlink == 1:
+                    os.utime(filepath, (source_stat.st_atime, modified))
+                if not retime or source_stat.st_nlink == 1:
+                    partial.discard()
+                    return 'unchanged'
+                # Other names share its time, so it gets a clone of its own
+            # A name of its own, so the clone never shares an inode with a partial upload
+            temp_path = os.path.join(partial.directory, f".{secrets.token_hex(8)}{PARTIAL_SUFFIX}")
+            os.makedirs(partial.directory, exist_ok=True)
+            try:
+                method = clone_file(source, temp_path, link=not retime)
+                if method is None:
+                    return None
+                if retime:
+                    os.utime(temp_path, (source_stat.st_atime, modified))
+                os.replace(temp_path, filepath)
+            finally:
+                if os.path.lexists(temp_path):
+                    os.remove(temp_path)
+            partial.discard()
+        except Exception as e:
+            print(f"{Colors.RED}Could not deduplicate {filename}: {e}{Colors.RESET}")
+            return None
+        self.hashes.store(filepath, digest)
+        self.index.update_file(filename)
+        return method
+    
+    def sign_file(self, request):
+        """Block signatures of a file for a delta upload, return (message, signatures).
+        
+        If the request names the 'size' and 'modified' time of the new version
+        and an interrupted upload of it can be resumed, the message is a
+        resumable one with the offset to resume from, and there are no
+        signatures: a delta would start the upload over.
+        """
+        filename, filepath = self.resolve_file(request)
+        if 'size' in request:
+            offset = PartialFile(self.shared_space, filename, int(request['size']),
+                                 request.get('modified')).resume_offset()
+            if offset:
+                return {'type': 'resumable', 'name': filename, 'offset': offset}, None
+        with open(filepath, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            block_size = block_size_for(stat.st_size)
+            signatures = file_signatures(f, block_size)
+        message = {
+            'type': 'signatures',
+            'name': filename,
+            'size': stat.st_size,
+            'block_size': block_size,
+            'version': delta_version(stat)
+        }
+        return message, signatures
+    
+    def send_signatures(self, request, conn):
+        """Send the block signatures of a file, followed by them packed in a DATA frame"""
+        try:
+            message, signatures = self.sign_file(request)
+        except (LookupError, OSError) as e:
+            conn.send_message(f"ERROR: {e}")
+            return
+        with conn.send_lock:
+            conn.send_message(message)
+            if signatures is not None:
+                conn.send_frame(FRAME_DATA, signatures)
+    
+    def open_delta_base(self, filename, filepath, version):
+        """Open the copy a delta applies to, return (file, size); LookupError if it has changed"""
+        try:
+            base = open(filepath, 'rb')
+        except OSError:
+            raise LookupError(f"{filename} is not on the server")
+        stat = os.fstat(base.fileno())
+        if delta_version(stat) != version:
+            base.close()
+            raise LookupError(f"{filename} changed since its signatures were sent")
+        return base, stat.st_size
+    
+    def delta_length(self, op, base_size, received_size, file_size):
+        """Number of bytes a delta instruction writes, raising ProtocolError if it is invalid"""
+        if op[0] == OP_COPY:
+            block_size = block_size_for(base_size)
+            first, count = op[1], op[2]
+            if not count or first + count > -(-base_size // block_size):
+                raise ProtocolError("Delta copies blocks out of range")
+            length = min(count * block_size, base_size - first * block_size)
+        else:
+            length = len(op[1])
+        if received_size + length > file_size:
+            raise ProtocolError("Upload larger than announced")
+        return length
+    
+    def receive_delta(self, conn, request):
+        """Rebuild an uploaded file from delta instructions against the server's copy.
+        
+        The client first fetches the copy's signatures with SIGNATURES and
+        passes back their 'version'; the delta is refused if the copy has
+        changed since. The new file is written as a partial upload, so an
+        interrupted delta upload can be resumed by a plain UPLOAD.
+        """
+        try:
+            filename, filepath = self.upload_path(request['name'])
+        except ValueError as e:
+            conn.send_message(f"ERROR: {e}")
+            return
+        if not self.claim_upload(filename):
+            conn.send_message(f"ERROR: {filename} is already being uploaded")
+            return
+        
+        partial = None
+        base = f = None
+        received_size = copied = 0
+        try:
+            file_size = int(request['size'])
+            partial = PartialFile(self.shared_space, filename, file_size, request.get('modified'))
+            try:
+                base, base_size = self.open_delta_base(filename, filepath, request.get('version'))
+            except LookupError as e:
+                conn.send_message(f"ERROR: {e}")
+                return
+            block_size = block_size_for(base_size)
+            f = partial.open(0)
+            checksum = self.requested_checksum(request)
+            conn.send_message({'type': 'delta_ready', 'name': filename,
+                               'checksum': checksum and CHECKSUM_ALGORITHM})
+            print(f"{Colors.YELLOW}Receiving delta: {filename} ({file_size} bytes){Colors.RESET}")
+            
+            for op in read_delta(conn):
+                length = self.delta_length(op, base_size, received_size, file_size)
+                if op[0] == OP_COPY:
+                    if copy_blocks(base, f, block_size, op[1], op[2], checksum) != length:
+                        raise ProtocolError(f"{filename} changed during the transfer")
+                    copied += length
+                else:
+                    write_checksummed(f, op[1], checksum)
+                received_size += length
+            if received_size != file_size:
+                raise ProtocolError(f"Upload smaller than announced: {received_size}/{file_size} bytes")
+            
+            f.close()
+            f = None
+            base.close()
+            if checksum is not None:
+                self.verify_upload(partial, conn.read_frame(), checksum)
+            partial.commit(filepath, request.get('modified'))
+            if checksum is not None:
+                self.hashes.store(filepath, checksum.digest())
+            conn.send_message({'type': 'upload_complete', 'name': filename, 'size': file_size, 'copied': copied})
+            print(f"{Colors.GREEN}File updated from delta: {filename} ({file_size - copied} new bytes, "
+                  f"{copied} reused){Colors.RESET}")
+            self.index.update_file(filename)
+        
+        except Exception as e:
+            print(f"{Colors.RED}Error receiving delta: {e}{Colors.RESET}")
+            try:
+                conn.send_message(f"ERROR: Upload of {filename} failed: {e}")
+            except OSError:
+                pass
+        finally:
+            self.bytes_received.inc(received_size - copied)
+            if base is not None:
+                base.close()
+            if f is not None:
+                self.save_partial(partial, f, received_size)
+            self.release_upload(filename)
+    
     def stop_server(self):
         """Stop the server and close all connections"""
         self.running = False
+        self.stop_metrics_endpoint()
+        self.index.stop_polling()
+        with self.watchers_lock:
+            self.watchers.clear()
         if self.socket:
             self.socket.close()
-        for client_socket, _ in self.clients:
-            client_socket.close()
+        for conn, _ in self.clients:
+            conn.close()
+        self.clients.clear()
+        print(f"{Colors.YELLOW}Server stopped{Colors.RESET}")
+
+class AsyncServer(Server):
+    """Server running every client on one asyncio event loop instead of a thread each.
+
+    Blocking disk work (directory scans, file opens and writes) is offloaded
+    to a bounded thread pool so it never stalls the loop.
+    """
+    
+    def __init__(self, host='0.0.0.0', port=8888, io_workers=ASYNC_IO_WORKERS):
+        super().__init__(host, port)
+        self.io_workers = io_workers
+        self.loop = None
+        self.executor = None
+        self.async_server = None
+        # Held while a request is handled, so events never interleave with a reply
+        self.send_locks = {}
+        # Disk operations submitted to the executor that no worker has started yet
+        self.io_waiting = 0
+        self.io_lock = threading.Lock()
+        self.metrics.gauge('io_queue', "Disk operations waiting for an I/O worker", lambda: self.io_waiting)
+    
+    def start_server(self):
+        """Start the event loop in a separate thread"""
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.io_workers)
+        started = threading.Event()
+        errors = []
+        
+        def run_loop():
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.async_server = self.loop.run_until_complete(asyncio.start_server(
+                    self.handle_client_async, self.host, self.port,
+                    backlog=LISTEN_BACKLOG, limit=RECV_SIZE, reuse_address=True))
+            except Exception as e:
+                errors.append(e)
+                return
+            finally:
+                started.set()
+            self.loop.run_forever()
+        
+        server_thread = threading.Thread(target=run_loop)
+        server_thread.daemon = True
+        server_thread.start()
+        started.wait()
+        
+        if errors:
+            print(f"{Colors.RED}Failed to start server: {errors[0]}{Colors.RESET}")
+            self.executor.shutdown(wait=False)
+            return False
+        
+        self.running = True
+        self.started_at = time.time()
+        self.index.start_polling()
+        self.print_banner()
+        print(f"{Colors.YELLOW}Mode: asyncio ({self.io_workers} I/O workers){Colors.RESET}")
+        return True
+    
+    async def run_io(self, func, *args):
+        """Run blocking disk I/O on the bounded executor"""
+        with self.io_lock:
+            self.io_waiting += 1
+        try:
+            future = self.executor.submit(self.start_io, func, args)
+        except BaseException:
+            self.io_dequeued()
+            raise
+        # An operation cancelled before a worker took it never starts
+        future.add_done_callback(lambda future: future.cancelled() and self.io_dequeued())
+        return await asyncio.wrap_future(future)
+    
+    def start_io(self, func, args):
+        self.io_dequeued()
+        return func(*args)
+    
+    def io_dequeued(self):
+        with self.io_lock:
+            self.io_waiting -= 1
+    
+    async def read_frame_async(self, reader):
+        """Read the next frame; the payload of DATA frames is left unread"""
+        try:
+            header = await reader.readexactly(HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise ProtocolError("Connection closed mid-frame")
+            return None
+        frame_type, flags, length = decode_header(header)
+        if frame_type == FRAME_DATA:
+            return frame_type, length, None
+        return frame_type, length, decode_payload(frame_type, await reader.readexactly(length))
+    
+    async def handle_client_async(self, reader, writer):
+        """Handle communication with a connected client"""
+        client_address = writer.get_extra_info('peername')
+        client_ip = client_address[0]
+        print(f"{Colors.GREEN}New connection from {client_ip}:{client_address[1]}{Colors.RESET}")
+        self.clients.append((writer, client_address))
+        self.connections_accepted.inc()
+        send_lock = self.send_locks[writer] = asyncio.Lock()
+        try:
+            while self.running:
+                frame = await self.read_frame_async(reader)
+                if frame is None:
+                    break
+                
+                async with send_lock:
+                    await self.dispatch_async(reader, writer, client_ip, frame)
+        
+        except Exception as e:
+            self.connection_errors.inc()
+            print(f"{Colors.RED}Error with client {client_ip}: {e}{Colors.RESET}")
+        finally:
+            self.unwatch(writer)
+            self.revoke_data_tokens(writer)
+            del self.send_locks[writer]
+            writer.close()
+            self.clients = [c for c in self.clients if c[1] != client_address]
+            print(f"{Colors.YELLOW}Client {client_ip} disconnected{Colors.RESET}")
+    
+    async def dispatch_async(self, reader, writer, client_ip, frame):
+        """Handle one request frame"""
+        frame_type, length, request = frame
+        if frame_type == FRAME_DATA:
+            # The payload of an upload that was refused; its error was already sent
+            await self.discard_async(reader, length)
+            return
+        if frame_type == FRAME_TRAILER:
+            # The checksum of an upload that was refused or failed; a reply
+            # to it would be taken for the reply to the next command
+            return
+        if frame_type != FRAME_COMMAND:
+            writer.write(encode_message("ERROR: Expected a command"))
+            await writer.drain()
+            return
+        
+        command = request.get('cmd')
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        print(f"{Colors.CYAN}[{timestamp}] Command from {client_ip}: {Colors.WHITE}{command}{Colors.RESET}")
+        started = time.perf_counter()
+        
+        error = self.misrouted(writer, command)
+        if error:
+            writer.write(encode_message(error))
+            await writer.drain()
+        elif command == "UPLOAD":
+            await self.receive_file_async(reader, writer, request['name'], int(request['size']),
+                                          request.get('resume', False), request.get('modified'),
+                                          request.get('encoding'), request.get('checksum'),
+                                          request.get(CHECKSUM_ALGORITHM))
+        elif command == "GET_FILE":
+            with self.download_running():
+                await self.send_file_async(writer, request)
+        elif command == "GET_RANGE":
+            with self.download_running():
+                await self.send_file_async(writer, request, int(request['offset']), request.get('length'))
+        elif command == "GET_BATCH":
+            with self.download_running():
+                await self.send_batch_async(writer, request)
+        elif command == "SIGNATURES":
+            await self.send_signatures_async(writer, request)
+        elif command == "DELTA":
+            await self.receive_delta_async(reader, writer, request)
+        elif command == "WATCH":
+            writer.write(encode_message(self.watch(writer)))
+            await writer.drain()
+        elif command == "DATA_TOKEN":
+            writer.write(encode_message(self.issue_data_token(writer, client_ip)))
+            await writer.drain()
+        elif command == "ATTACH":
+            try:
+                writer.write(encode_message(self.attach_data_connection(request.get('token'), client_ip)))
+            except ProtocolError as e:
+                writer.write(encode_message(f"ERROR: {e}"))
+                await writer.drain()
+                raise
+            await writer.drain()
+        else:
+            response = await self.run_io(self.process_command, request)
+            if response:
+                writer.write(encode_message(response))
+                await writer.drain()
+        self.record_command(command, started)
+    
+    def push_event(self, writer, event):
+        """Queue an encoded event for a client on the event loop, return False if it is busy sending"""
+        send_lock = self.send_locks.get(writer)
+        if send_lock is not None and send_lock.locked():
+            return False  # Retried later, so events do not pile up behind a transfer
+        if send_lock is not None and self.running:
+            asyncio.run_coroutine_threadsafe(self.push_event_async(writer, send_lock, event), self.loop)
+        return True
+    
+    async def push_event_async(self, writer, send_lock, event):
+        async with send_lock:
+            if writer.is_closing():
+                return
+            try:
+                writer.write(event)
+                await asyncio.wait_for(writer.drain(), WATCHER_SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.drop_watcher(writer)
+                writer.transport.abort()
+            except ConnectionError:
+                pass  # The client's handler notices the broken connection
+    
+    async def discard_async(self, reader, size):
+        while size:
+            data = await reader.read(min(RECV_SIZE, size))
+            if not data:
+                break
+            size -= len(data)
+    
+    async def send_file_async(self, writer, request, offset=0, length=None):
+        """Send the requested file, or length bytes of it starting at offset"""
+        try:
+            filename, filepath = self.resolve_file(request)
+            f = await self.run_io(open, filepath, 'rb')
+        except (LookupError, OSError) as e:
+            writer.write(encode_message(f"ERROR: {e}"))
+            await writer.drain()
+            return
+        
+        try:
+            stat = os.fstat(f.fileno())
+            file_size = stat.st_size
+            try:
+                message, count = self.describe_transfer(filename, stat, offset, length)
+            except LookupError as e:
+                writer.write(encode_message(f"ERROR: {e}"))
+                await writer.drain()
+                return
+            encoding = await self.run_io(choose_encoding, f, filename, offset, count, request.get('compress'))
+            if encoding:
+                message['encoding'] = encoding
+            checksum = self.requested_checksum(request)
+            if checksum is not None:
+                message['checksum'] = CHECKSUM_ALGORITHM
+            digest = await self.run_io(self.cached_digest, checksum, stat, offset, count)
+            running = checksum if digest is None else None
+            
+            if message['type'] == 'file_transfer':
+                print(f"{Colors.YELLOW}Sending file: {filename} ({file_size} bytes){Colors.RESET}")
+            writer.write(encode_message(message))
+            if encoding:
+                sent_size, wire_size = await self.send_compressed_async(writer, f, offset, count, encoding, running)
+            else:
+                sent_size = wire_size = await self.send_data_async(writer, f, offset, count, running)
+            self.bytes_sent.inc(wire_size)
+            if checksum is not None and sent_size == count:
+                writer.write(encode_trailer(digest or checksum))
+                await writer.drain()
+            if running is not None and sent_size == count:
+                await self.run_io(self.remember_digest, filepath, f, stat, offset, count, checksum)
+        finally:
+            await self.run_io(f.close)
+        
+        if sent_size != count:
+            raise ProtocolError(f"File send incomplete: {sent_size}/{count} bytes")
+        if message['type'] == 'file_transfer':
+            print(f"{Colors.GREEN}{self.describe_sent(filename, encoding, wire_size, sent_size)}{Colors.RESET}")
+    
+    async def send_data_async(self, writer, f, offset, count, checksum=None):
+        """Send part of a file as one DATA frame, return the bytes sent.
+        
+        Without a checksum the loop's sendfile does the copying, in steps of
+        ASYNC_SENDFILE_SIZE; with one the content is read and checksummed in
+        chunks on the I/O executor.
+        """
+        writer.write(encode_header(FRAME_DATA, count))
+        await writer.drain()
+        if checksum is None:
+            sent_size = 0
+            while sent_size < count:
+                n = await self.loop.sendfile(writer.transport, f, offset + sent_size,
+                                             min(ASYNC_SENDFILE_SIZE, count - sent_size))
+                if not n:
+                    break
+                sent_size += n
+            return sent_size
+        await self.run_io(f.seek, offset)
+        sent_size = 0
+        while sent_size < count:
+            data = await self.run_io(read_checksummed, f, min(SEND_BUFFER_SIZE, count - sent_size), checksum)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+            sent_size += len(data)
+        return sent_size
+    
+    async def send_compressed_async(self, writer, f, offset, count, encoding, checksum=None):
+        """Send part of a file as compressed blocks, see compression.send_compressed"""
+        blocks = compressed_blocks(f, offset, count, encoding, checksum)
+        raw_size = wire_size = 0
+        while True:
+            # Reading and waiting for the compressor pool both happen off the loop
+            item = await self.run_io(next, blocks, None)
+            if item is None:
+                break
+            block, size = item
+            writer.write(encode_header(FRAME_DATA, len(block)))
+            writer.write(block)
+            await writer.drain()
+            raw_size += size
+            wire_size += len(block)
+        writer.write(encode_header(FRAME_DATA, 0))
+        await writer.drain()
+        return raw_size, wire_size
+    
+    async def read_compressed_async(self, reader, encoding):
+        """Yield (data, wire length) for each block of a compressed stream, see compression.read_compressed"""
+        while True:
+            frame = await self.read_frame_async(reader)
+            if frame is None:
+                raise ConnectionError("connection closed during the transfer")
+            if frame[0] != FRAME_DATA or frame[1] > MAX_BLOCK_FRAME:
+                raise ProtocolError("Expected a compressed block")
+            if not frame[1]:
+                return
+            yield await self.run_io(decompress_block, encoding, await reader.readexactly(frame[1])), frame[1]
+    
+    async def send_batch_async(self, writer, request):
+        """Stream many files back to back, see Server.send_batch"""
+        if request.get('dirs'):
+            await self.run_io(self.refresh_file_list, False)
+        refs = self.batch_refs(request)
+        checksums = request.get('checksum') == CHECKSUM_ALGORITHM
+        missing = []
+        total = 0
+        print(f"{Colors.YELLOW}Sending batch{Colors.RESET}")
+        while True:
+            step = list(islice(refs, BATCH_READ_FILES))
+            if not step:
+                break
+            total += len(step)
+            pieces = await self.run_io(self.read_batch, step, missing, checksums)
+            for i, piece in enumerate(pieces):
+                if not isinstance(piece, tuple):
+                    writer.write(piece)
+                    await writer.drain()
+                    self.bytes_sent.inc(len(piece))
+                    continue
+                message, f, filepath = piece
+                checksum = new_checksum() if checksums else None
+                try:
+                    stat = os.fstat(f.fileno())
+                    digest = await self.run_io(self.cached_digest, checksum, stat, 0, message['size'])
+                    running = checksum if digest is None else None
+                    writer.write(encode_message(message))
+                    sent_size = await self.send_data_async(writer, f, 0, message['size'], running)
+                    self.bytes_sent.inc(sent_size)
+                    if checksum is not None and sent_size == message['size']:
+                        writer.write(encode_trailer(digest or checksum))
+                    if running is not None and sent_size == message['size']:
+                        await self.run_io(self.remember_digest, filepath, f, stat, 0, message['size'], checksum)
+                except BaseException:
+                    self.close_batch_files(pieces[i + 1:])
+                    raise
+                finally:
+                    await self.run_io(f.close)
+                if sent_size != message['size']:
+                    self.close_batch_files(pieces[i + 1:])
+                    raise ProtocolError(f"File send incomplete: {sent_size}/{message['size']} bytes")
+        
+        sent = total - len(missing)
+        writer.write(encode_message({'type': 'batch_complete', 'count': sent, 'missing': missing}))
+        await writer.drain()
+        print(f"{Colors.GREEN}Batch sent: {sent} files{Colors.RESET}")
+    
+    async def receive_file_async(self, reader, writer, filename, file_size, resume=False, source=None,
+                                 encoding=None, checksum=None, digest=None):
+        """Stream a file from a client into the shared space, see Server.receive_file"""
+        try:
+            filename, filepath = self.upload_path(filename)
+        except ValueError as e:
+            writer.write(encode_message(f"ERROR: {e}"))
+            await writer.drain()
+            return
+        if not self.claim_upload(filename):
+            writer.write(encode_message(f"ERROR: {filename} is already being uploaded"))
+            await writer.drain()
+            return
+        
+        method = (await self.run_io(self.deduplicate, filename, filepath, file_size, digest, source)
+                  if digest else None)
+        if method:
+            writer.write(encode_message({'type': 'upload_complete', 'name': filename, 'size': file_size,
+                                         'deduplicated': method}))
+            await writer.drain()
+            print(f"{Colors.GREEN}File uploaded from an identical copy: {filename} ({method}){Colors.RESET}")
+            self.release_upload(filename)
+            return
+        
+        partial = PartialFile(self.shared_space, filename, file_size, source)
+        f = None
+        received_size = 0
+        wire_size = 0
+        remaining = 0
+        try:
+            offset = await self.run_io(partial.resume_offset) if resume else 0
+            f = await self.run_io(partial.open, offset)
+            received_size = offset
+            encoding = encoding if encoding in CODECS else None
+            checksum = self.requested_checksum({'checksum': checksum})
+            writer.write(encode_message({'type': 'upload_ready', 'name': filename, 'offset': offset,
+                                         'encoding': encoding, 'checksum': checksum and CHECKSUM_ALGORITHM}))
+            await writer.drain()
+            
+            if encoding:
+                print(f"{Colors.YELLOW}Receiving file: {filename} ({file_size} bytes from {offset}, "
+                      f"{encoding}){Colors.RESET}")
+                checkpoint_at = received_size + CHECKPOINT_INTERVAL
+                async for data, length in self.read_compressed_async(reader, encoding):
+                    wire_size += length
+                    if received_size + len(data) > file_size:
+                        raise ProtocolError("Upload larger than announced")
+                    await self.run_io(write_checksummed, f, data, checksum)
+                    received_size += len(data)
+                    if received_size >= checkpoint_at:
+                        await self.run_io(partial.checkpoint, f, received_size)
+                        checkpoint_at = received_size + CHECKPOINT_INTERVAL
+                if received_size != file_size:
+                    raise ProtocolError(f"Upload smaller than announced: {received_size}/{file_size} bytes")
+            else:
+                frame = await self.read_frame_async(reader)
+                if frame is None or frame[0] != FRAME_DATA:
+                    raise ProtocolError("Expected file data after UPLOAD")
+                remaining = frame[1]
+                if frame[1] != file_size - offset:
+                    raise ProtocolError(f"Upload size mismatch: {frame[1]} != {file_size - offset}")
+                print(f"{Colors.YELLOW}Receiving file: {filename} ({file_size} bytes from {offset}){Colors.RESET}")
+                
+                checkpoint_at = received_size + CHECKPOINT_INTERVAL
+                while remaining:
+                    data = await reader.read(min(RECV_SIZE, remaining))
+                    if not data:
+                        break
+                    await self.run_io(write_checksummed, f, data, checksum)
+                    remaining -= len(data)
+                    received_size += len(data)
+                    wire_size += len(data)
+                    if received_size >= checkpoint_at:
+                        await self.run_io(partial.checkpoint, f, received_size)
+                        checkpoint_at = received_size + CHECKPOINT_INTERVAL
+            
+            if received_size == file_size:
+                await self.run_io(f.close)
+                f = None
+                if checksum is not None:
+                    trailer = await self.read_frame_async(reader)
+                    trailer = trailer and Frame(trailer[0], 0, trailer[1], trailer[2])
+                    await self.run_io(self.verify_upload, partial, trailer, checksum)
+                await self.run_io(partial.commit, filepath, source)
+                if checksum is not None and not offset:
+                    await self.run_io(self.hashes.store, filepath, checksum.digest())
+                writer.write(encode_message({'type': 'upload_complete', 'name': filename, 'size': file_size}))
+                await writer.drain()
+                print(f"{Colors.GREEN}File uploaded successfully: {filename}{Colors.RESET}")
+                await self.run_io(self.index.update_file, filename)
+            else:
+                print(f"{Colors.RED}File upload incomplete: {received_size}/{file_size} bytes{Colors.RESET}")
+        except Exception as e:
+            print(f"{Colors.RED}Error receiving file: {e}{Colors.RESET}")
+            # Skip the rest of the payload so the next frame can be read
+            if remaining:
+                await self.discard_async(reader, remaining)
+            try:
+                writer.write(encode_message(f"ERROR: Upload of {filename} failed: {e}"))
+                await writer.drain()
+            except OSError:
+                pass
+        finally:
+            self.bytes_received.inc(wire_size)
+            if f is not None:
+                await self.run_io(self.save_partial, partial, f, received_size)
+            self.release_upload(filename)
+    
+    async def send_signatures_async(self, writer, request):
+        """Send the block signatures of a file, see Server.send_signatures"""
+        try:
+            message, signatures = await self.run_io(self.sign_file, request)
+        except (LookupError, OSError) as e:
+            writer.write(encode_message(f"ERROR: {e}"))
+            await writer.drain()
+            return
+        writer.write(encode_message(message))
+        if signatures is not None:
+            writer.write(encode_frame(FRAME_DATA, signatures))
+        await writer.drain()
+    
+    async def read_delta_async(self, reader):
+        """Yield the decoded instructions of a delta stream, see delta.read_delta"""
+        while True:
+            frame = await self.read_frame_async(reader)
+            if frame is None:
+                raise ConnectionError("connection closed during the transfer")
+            if frame[0] != FRAME_DATA or frame[1] > MAX_OP_SIZE:
+                raise ProtocolError("Expected a delta instruction")
+            if not frame[1]:
+                return
+            yield decode_op(await reader.readexactly(frame[1]))
+    
+    async def receive_delta_async(self, reader, writer, request):
+        """Rebuild an uploaded file from delta instructions, see Server.receive_delta"""
+        try:
+            filename, filepath = self.upload_path(request['name'])
+        except ValueError as e:
+            writer.write(encode_message(f"ERROR: {e}"))
+            await writer.drain()
+            return
+        if not self.claim_upload(filename):
+            writer.write(encode_message(f"ERROR: {filename} is already being uploaded"))
+            await writer.drain()
+            return
+        
+        partial = None
+        base = f = None
+        received_size = copied = 0
+        try:
+            file_size = int(request['size'])
+            partial = PartialFile(self.shared_space, filename, file_size, request.get('modified'))
+            try:
+                base, base_size = await self.run_io(self.open_delta_base, filename, filepath, request.get('version'))
+            except LookupError as e:
+                writer.write(encode_message(f"ERROR: {e}"))
+                await writer.drain()
+                return
+            block_size = block_size_for(base_size)
+            f = await self.run_io(partial.open, 0)
+            checksum = self.requested_checksum(request)
+            writer.write(encode_message({'type': 'delta_ready', 'name': filename,
+                                         'checksum': checksum and CHECKSUM_ALGORITHM}))
+            await writer.drain()
+            print(f"{Colors.YELLOW}Receiving delta: {filename} ({file_size} bytes){Colors.RESET}")
+            
+            async for op in self.read_delta_async(reader):
+                length = self.delta_length(op, base_size, received_size, file_size)
+                if op[0] == OP_COPY:
+                    if await self.run_io(copy_blocks, base, f, block_size, op[1], op[2], checksum) != length:
+                        raise ProtocolError(f"{filename} changed during the transfer")
+                    copied += length
+                else:
+                    await self.run_io(write_checksummed, f, op[1], checksum)
+                received_size += length
+            if received_size != file_size:
+                raise ProtocolError(f"Upload smaller than announced: {received_size}/{file_size} bytes")
+            
+            await self.run_io(f.close)
+            f = None
+            await self.run_io(base.close)
+            if checksum is not None:
+                trailer = await self.read_frame_async(reader)
+                trailer = trailer and Frame(trailer[0], 0, trailer[1], trailer[2])
+                await self.run_io(self.verify_upload, partial, trailer, checksum)
+            await self.run_io(partial.commit, filepath, request.get('modified'))
+            if checksum is not None:
+                await self.run_io(self.hashes.store, filepath, checksum.digest())
+            writer.write(encode_message({'type': 'upload_complete', 'name': filename, 'size': file_size,
+                                         'copied': copied}))
+            await writer.drain()
+            print(f"{Colors.GREEN}File updated from delta: {filename} ({file_size - copied} new bytes, "
+                  f"{copied} reused){Colors.RESET}")
+            await self.run_io(self.index.update_file, filename)
+        except Exception as e:
+            print(f"{Colors.RED}Error receiving delta: {e}{Colors.RESET}")
+            try:
+                writer.write(encode_message(f"ERROR: Upload of {filename} failed: {e}"))
+                await writer.drain()
+            except OSError:
+                pass
+        finally:
+            self.bytes_received.inc(received_size - copied)
+            if base is not None:
+                await self.run_io(base.close)
+            if f is not None:
+                await self.run_io(self.save_partial, partial, f, received_size)
+            self.release_upload(filename)
+    
+    async def close_all(self):
+        self.async_server.close()
+        for writer, _ in self.clients:
+            writer.close()
+    
+    def stop_server(self):
+        """Stop the event loop and close all connections"""
+        self.running = False
+        self.stop_metrics_endpoint()
+        self.index.stop_polling()
+        with self.watchers_lock:
+            self.watchers.clear()
+        if self.loop and self.async_server:
+            asyncio.run_coroutine_threadsafe(self.close_all(), self.loop).result(timeout=5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.executor:
+            self.executor.shutdown(wait=False)
         self.clients.clear()
         print(f"{Colors.YELLOW}Server stopped{Colors.RESET}")
 
 # Global server instance
 server = None
 
-def print_directory_contents(path):
-    try:
-        with os.scandir(path) as entries:
-            for i, entry in enumerate(entries):
-                if entry.is_file():
+def read_checksummed(f, size, checksum):
+    """Read up to size bytes of f, adding them to a running checksum"""
+    data = f.read(size)
+    checksum.update(data)
+    return data
+
+def write_checksummed(f, data, checksum=None):
+    """Write data to f, adding it to a running checksum if there is one"""
+    f.write(data)
+    if checksum is not None:
+        checksum.update(data)
+
+def send_event(sock, event, timeout):
+    """Send all of event on a blocking socket without waiting more than timeout, False if it was not taken in time"""
+    view = memoryview(event)
+    deadline = time.monotonic() + timeout
+    while view:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([], [sock], [], remaining)[1]:
+            return False
+        try:
+            view = view[sock.send(view, SEND_NONBLOCKING):]
+        except BlockingIOError:
+            pass
+    return True
+
+def delta_version(stat):
+    """Identifies the version of a file that block signatures were computed from"""
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def print_directory_contents(path, max_depth=MAX_DEPTH):
+    """Print the tree below path, each directory as soon as it is scanned"""
+    pending = [(path, 0)]
+    while pending:
+        directory, depth = pending.pop()
+        indent = "  " * depth
+        if depth:
+            print(f"{Colors.BLUE}{indent[2:]}Directory: {os.path.basename(directory)}/{Colors.RESET}")
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except Exception as e:
+            print(f"{Colors.RED}{indent}Error accessing directory: {e}{Colors.RESET}")
+            continue
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
                     size = entry.stat().st_size
-                    print(f"{Colors.GREEN}{i:2d}. {entry.name} ({size} bytes){Colors.RESET}")
-                elif entry.is_dir():
-                    print(f"{Colors.BLUE}Directory: {entry.name}{Colors.RESET}")
-    except Exception as e:
-        print(f"{Colors.RED}Error accessing directory: {e}{Colors.RESET}")
+                    print(f"{Colors.GREEN}{indent}{entry.name} ({size} bytes){Colors.RESET}")
+            except OSError:
+                pass
+        if depth < max_depth:
+            pending.extend((subdir, depth + 1) for subdir in reversed(subdirs))
 
 def wait_for_commands():
     global server
@@ -308,12 +1921,15 @@ def wait_for_commands():
                 server.stop_server()
             print("Exiting program.")
             sys.exit(0)
-        elif command == "launch":
+        elif command.split()[:1] == ["launch"]:
+            mode = command.split()[1] if len(command.split()) > 1 else "threaded"
             if server and server.running:
                 print(f"{Colors.YELLOW}Server is already running!{Colors.RESET}")
+            elif mode not in ("threaded", "async"):
+                print(f"{Colors.RED}Unknown server mode: {mode} (use threaded or async){Colors.RESET}")
             else:
-                print("Launching server...")
-                server = Server()
+                print(f"Launching {mode} server...")
+                server = AsyncServer() if mode == "async" else Server()
                 server.set_shared_space(shared_space)
                 if not server.start_server():
                     server = None
@@ -329,8 +1945,17 @@ def wait_for_commands():
                 print(f"{Colors.CYAN}Connected clients: {len(server.clients)}{Colors.RESET}")
                 print(f"{Colors.CYAN}Shared space: {shared_space}{Colors.RESET}")
                 print(f"{Colors.CYAN}Files available: {len(server.file_list)}{Colors.RESET}")
+                server.print_stats()
             else:
                 print(f"{Colors.YELLOW}Server is not running.{Colors.RESET}")
+        elif command.split()[:1] == ["metrics"]:
+            port = command.split()[1] if len(command.split()) > 1 else str(METRICS_PORT)
+            if not (server and server.running):
+                print(f"{Colors.YELLOW}Server is not running.{Colors.RESET}")
+            elif not port.isdigit():
+                print(f"{Colors.RED}Not a port number: {port}{Colors.RESET}")
+            else:
+                server.start_metrics_endpoint(int(port))
         elif command == "refresh":
             if server:
                 server.refresh_file_list()
@@ -341,19 +1966,21 @@ def wait_for_commands():
             print(f"{Colors.RED}Unknown command: {command}{Colors.RESET}")
 
 # Main program
-shared_space = input("Shared space directory: ").strip()
-if not shared_space:
-    print("No directory entered.")
-else:
-    print(f"Shared space directory set to: {Colors.MAGENTA}{shared_space}{Colors.RESET}")
-    print(f"Exists on disk: {Colors.MAGENTA}{os.path.exists(shared_space)}{Colors.RESET}")
+if __name__ == "__main__":
+    shared_space = input("Shared space directory: ").strip()
+    if not shared_space:
+        print("No directory entered.")
+    else:
+        print(f"Shared space directory set to: {Colors.MAGENTA}{shared_space}{Colors.RESET}")
+        print(f"Exists on disk: {Colors.MAGENTA}{os.path.exists(shared_space)}{Colors.RESET}")
 
-    print("Available commands:")
-    print(" show - Show directory contents")
-    print(" launch - Start the server")
-    print(" stop - Stop the server")
-    print(" status - Check server status")
-    print(" refresh - Refresh file list")
-    print(" exit - Exit the program")
+        print("Available commands:")
+        print(" show - Show directory contents")
+        print(" launch [async] - Start the server (thread per client, or asyncio event loop)")
+        print(" stop - Stop the server")
+        print(" status - Check server status and metrics")
+        print(" metrics [port] - Serve metrics for Prometheus on localhost (port 9464 by default)")
+        print(" refresh - Refresh file list")
+        print(" exit - Exit the program")
 
-    wait_for_commands()
\ No newline at end of file
+        wait_for_commands()
@@ -0,0 +1,72 @@
+"""Fixtures shared by the tests: servers of both engines on a temporary shared space, and clients of them"""
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server as server_module  # noqa: E402
+from benchmark import free_port  # noqa: E402
+from client import Client  # noqa: E402
+from hash_cache import HashCache  # noqa: E402
+
+ENGINES = {'threaded': server_module.Server, 'async': server_module.AsyncServer}
+
+
+class Events:
+    """gui_callback recording every event of a client, usable as the sink of cli.load_listing"""
+
+    def __init__(self):
+        self.events = []
+        self.changed = threading.Condition()
+
+    def __call__(self, callback_type, data, log_type=None):
+        with self.changed:
+            self.events.append((callback_type, data, log_type))
+            self.changed.notify_all()
+
+    def wait_for(self, predicate, timeout):
+        """Wait until predicate() is true, re-checking after every event; False on timeout"""
+        with self.changed:
+            return self.changed.wait_for(predicate, timeout)
+
+    def logs(self, log_type):
+        with self.changed:
+            return [data for callback_type, data, level in self.events
+                    if callback_type == 'log' and level == log_type]
+
+    def errors(self):
+        return self.logs('error')
+
+
+@pytest.fixture
+def shared(tmp_path):
+    path = tmp_path / 'shared'
+    path.mkdir()
+    return path
+
+
+@pytest.fixture(params=sorted(ENGINES))
+def server(request, shared, tmp_path):
+    srv = ENGINES[request.param](host='127.0.0.1', port=free_port())
+    srv.hashes = HashCache(str(tmp_path / 'server-hashes.sqlite3'))
+    srv.set_shared_space(str(shared))
+    assert srv.start_server()
+    yield srv
+    srv.stop_server()
+
+
+@pytest.fixture
+def events():
+    return Events()
+
+
+@pytest.fixture
+def client(server, events, tmp_path):
+    c = Client(gui_callback=events, download_dir=str(tmp_path / 'downloads'))
+    c.hashes = HashCache(str(tmp_path / 'client-hashes.sqlite3'))
+    assert c.connect('127.0.0.1', server.port)
+    yield c
+    c.disconnect()
@@ -0,0 +1,49 @@
+"""The bounded activity log of the client"""
+import activity_log
+from activity_log import ActivityLog
+
+
+def messages(entries):
+    return [entry.message for entry in entries]
+
+
+def test_only_the_latest_entries_are_kept():
+    log = ActivityLog(capacity=3)
+    for i in range(5):
+        log.add(str(i))
+    assert messages(log.entries) == ['2', '3', '4']
+    assert messages(log.take_pending()) == ['2', '3', '4']
+    assert log.take_pending() == []
+    log.add('5')
+    assert messages(log.take_pending()) == ['5']
+
+
+def test_levels_filter_what_is_shown():
+    log = ActivityLog()
+    log.add("connected", 'server')
+    log.add("copied", 'success')
+    log.add("failed", 'error')
+    log.add("unknown level", 'debug')
+    assert messages(log.set_level('success')) == ["copied", "failed"]
+    log.add("more", 'info')
+    log.add("broken", 'error')
+    assert messages(log.take_pending()) == ["broken"]
+    assert messages(log.set_level('info')) == ["connected", "copied", "failed", "unknown level", "more", "broken"]
+    assert log.entries[3].level == 'info'
+    assert log.entries[0].format().endswith("] connected\n")
+
+
+def test_messages_spill_to_a_rotating_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(activity_log, 'LOG_FILE_SIZE', 200)
+    path = tmp_path / 'logs' / 'activity.log'
+    log = ActivityLog(capacity=2)
+    log.spill_to(str(path))
+    for i in range(20):
+        log.add(f"message {i}", 'error' if i == 19 else 'info')
+    log.spill_to(None)
+    log.add("not written")
+
+    files = sorted(p.name for p in path.parent.iterdir())
+    assert files == ['activity.log', 'activity.log.1', 'activity.log.2', 'activity.log.3']
+    assert path.read_text(encoding='utf-8').rstrip().endswith("ERROR message 19")
+    assert "not written" not in path.read_text(encoding='utf-8')
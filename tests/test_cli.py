@@ -0,0 +1,92 @@
+"""The command-line client, run as a script against a server"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+CLI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cli.py')
+MTIME = 1500000000
+
+
+@pytest.fixture
+def workdir(tmp_path):
+    path = tmp_path / 'work'
+    path.mkdir()
+    return path
+
+
+def run_cli(server, cwd, *args):
+    """Run cli.py with --json, return (exit status, events, stdout)"""
+    result = subprocess.run([sys.executable, CLI, '--host', '127.0.0.1', '--port', str(server.port), '--json', *args],
+                            cwd=cwd, capture_output=True, text=True, timeout=60)
+    events = [json.loads(line) for line in result.stderr.splitlines() if line.startswith('{')]
+    return result.returncode, events, result.stdout
+
+
+def completed(events, direction):
+    return [event for event in events if event['event'] == f'{direction}_complete']
+
+
+def populate(root, names):
+    for name in names:
+        path = root.joinpath(*name.split('/'))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(name.encode() * 100)
+        os.utime(path, (MTIME, MTIME))
+
+
+def test_sync_pull_is_idempotent(server, shared, workdir, tmp_path):
+    populate(shared, ['a.txt', 'reports/b.csv', 'reports/2024/c.csv'])
+    server.refresh_file_list()
+    mirror = tmp_path / 'mirror'
+
+    status, events, _ = run_cli(server, workdir, '-o', str(mirror), 'sync', 'pull', 'reports')
+    assert status == 0
+    assert completed(events, 'download')
+    for name in ('reports/b.csv', 'reports/2024/c.csv'):
+        path = mirror.joinpath(*name.split('/'))
+        assert path.read_bytes() == name.encode() * 100
+        assert os.path.getmtime(path) == MTIME
+    assert not (mirror / 'a.txt').exists()
+
+    status, events, _ = run_cli(server, workdir, '-o', str(mirror), 'sync', 'pull', 'reports')
+    assert status == 0
+    assert not completed(events, 'download')
+    assert os.listdir(workdir) == []
+
+
+def test_sync_push_is_idempotent(server, shared, workdir):
+    populate(workdir / 'exports', ['one.txt', 'deep/two.txt'])
+
+    status, events, _ = run_cli(server, workdir, 'sync', 'push', 'exports')
+    assert status == 0
+    assert len(completed(events, 'upload')) == 2
+    for name in ('exports/one.txt', 'exports/deep/two.txt'):
+        assert os.path.getmtime(shared.joinpath(*name.split('/'))) == MTIME
+
+    status, events, _ = run_cli(server, workdir, 'sync', 'push', 'exports')
+    assert status == 0
+    assert not completed(events, 'upload')
+    assert sorted(os.listdir(workdir)) == ['exports']
+
+
+def test_ls_and_get(server, shared, workdir):
+    populate(shared, ['a.txt', 'b.csv', 'dir/c.csv'])
+    server.refresh_file_list()
+
+    status, _, stdout = run_cli(server, workdir, 'ls', '*.csv')
+    assert status == 0
+    assert [json.loads(line)['name'] for line in stdout.splitlines()] == ['b.csv', 'dir/c.csv']
+
+    status, _, _ = run_cli(server, workdir, '-o', 'out', 'get', 'a.txt', 'dir')
+    assert status == 0
+    assert (workdir / 'out' / 'a.txt').read_bytes() == b'a.txt' * 100
+    assert (workdir / 'out' / 'dir' / 'c.csv').read_bytes() == b'dir/c.csv' * 100
+
+
+def test_failures_set_the_exit_status(server, workdir):
+    status, events, _ = run_cli(server, workdir, 'get', 'missing.txt')
+    assert status == 1
+    assert any(event.get('level') == 'error' and 'missing.txt' in event['data'] for event in events)
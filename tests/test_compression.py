@@ -0,0 +1,56 @@
+"""Compressed transfers"""
+import io
+import os
+import socket
+
+import pytest
+
+from compression import (BLOCK_SIZE, CODECS, MIN_COMPRESS_SIZE, choose_encoding, compressed_blocks,
+                         decompress_block, read_compressed, send_compressed)
+from protocol import Connection, ProtocolError, new_checksum
+
+TEXT = b''.join(b'line %d of a compressible file\n' % i for i in range(200000))
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_blocks_round_trip(codec):
+    checksum = new_checksum()
+    blocks = list(compressed_blocks(io.BytesIO(TEXT), 10, len(TEXT) - 10, codec, checksum))
+    assert [size for _, size in blocks[:-1]] == [BLOCK_SIZE] * (len(blocks) - 1)
+    assert sum(len(block) for block, _ in blocks) < len(TEXT) // 2
+    assert b''.join(decompress_block(codec, block) for block, _ in blocks) == TEXT[10:]
+    expected = new_checksum()
+    expected.update(TEXT[10:])
+    assert checksum.hexdigest() == expected.hexdigest()
+
+
+def test_stream_round_trip():
+    a, b = socket.socketpair()
+    try:
+        sender, receiver = Connection(a), Connection(b)
+        # Small enough for the socket buffers, so one thread can send then read
+        data = TEXT[:200000]
+        assert send_compressed(sender, io.BytesIO(data), 0, len(data), 'zlib')[0] == len(data)
+        assert b''.join(block for block, _ in read_compressed(receiver, 'zlib')) == data
+    finally:
+        a.close()
+        b.close()
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_malformed_blocks_are_refused(codec):
+    with pytest.raises(ProtocolError):
+        decompress_block(codec, b'not compressed at all')
+    block = CODECS[codec][0](TEXT[:BLOCK_SIZE + 1])
+    with pytest.raises(ProtocolError):
+        decompress_block(codec, block)
+
+
+def test_encoding_is_chosen_only_when_worth_it():
+    assert choose_encoding(io.BytesIO(TEXT), 'a.txt', 0, len(TEXT), ['lzma', 'zlib']) == 'lzma'
+    assert choose_encoding(io.BytesIO(TEXT), 'a.txt', 0, len(TEXT), ['brotli', 'zlib']) == 'zlib'
+    assert choose_encoding(io.BytesIO(TEXT), 'a.txt', 0, len(TEXT), []) is None
+    assert choose_encoding(io.BytesIO(TEXT), 'a.zip', 0, len(TEXT), ['zlib']) is None
+    assert choose_encoding(io.BytesIO(TEXT), 'a.txt', 0, MIN_COMPRESS_SIZE - 1, ['zlib']) is None
+    noise = os.urandom(256 * 1024)
+    assert choose_encoding(io.BytesIO(noise), 'a.bin', 0, len(noise), ['zlib']) is None
@@ -0,0 +1,92 @@
+"""Delta transfers: a file rebuilt from instructions against an older copy"""
+import io
+import os
+
+import pytest
+
+from delta import (COPY_OP, OP_COPY, OP_DATA, DeltaEncoder, block_size_for, copy_blocks, decode_op,
+                   file_signatures, signature_table)
+from protocol import ProtocolError
+
+
+def rebuild(base, new, block_size=None, roll_budget=None):
+    """Return (the file rebuilt from the delta of new against base, the encoder)"""
+    block_size = block_size or block_size_for(len(base))
+    table = signature_table(file_signatures(io.BytesIO(base), block_size))
+    encoder = DeltaEncoder(io.BytesIO(new), block_size, table)
+    if roll_budget is not None:
+        encoder.roll_budget = roll_budget
+    out = io.BytesIO()
+    for payload, _ in encoder.ops():
+        op = decode_op(payload)
+        if op[0] == OP_DATA:
+            out.write(op[1])
+        else:
+            copy_blocks(io.BytesIO(base), out, block_size, op[1], op[2])
+    return out.getvalue(), encoder
+
+
+@pytest.fixture
+def base():
+    return os.urandom(3 * 1024 * 1024 + 123)
+
+
+def test_unchanged_file_is_all_copies(base):
+    rebuilt, encoder = rebuild(base, base)
+    assert rebuilt == base
+    assert encoder.literal == 0
+
+
+def test_edit_in_place(base):
+    new = bytearray(base)
+    new[1000000:1000010] = b'0123456789'
+    rebuilt, encoder = rebuild(base, bytes(new))
+    assert rebuilt == new
+    assert encoder.literal <= 2 * block_size_for(len(base))
+
+
+def test_insertion_shifts_are_found(base):
+    new = base[:500000] + b'inserted' + base[500000:]
+    rebuilt, encoder = rebuild(base, new)
+    assert rebuilt == new
+    assert encoder.literal < len(new) // 10
+
+
+@pytest.mark.parametrize('roll_budget', [0, 1000, 5000, None])
+def test_scattered_edits_cost_a_block_each(roll_budget):
+    # A budget running out partway through a search used to leave the rest
+    # of the file off the block grid, and all of it went as literals
+    base = os.urandom(8 * 1024 * 1024)
+    new = bytearray(base)
+    for position in range(100000, len(new), len(new) // 20):
+        new[position] ^= 0xff
+    rebuilt, encoder = rebuild(base, bytes(new), roll_budget=roll_budget)
+    assert rebuilt == new
+    assert encoder.literal <= 20 * block_size_for(len(base))
+
+
+def test_without_roll_budget_only_block_boundaries_match(base):
+    new = b'shifted' + base
+    rebuilt, encoder = rebuild(base, new, roll_budget=0)
+    assert rebuilt == new
+
+
+@pytest.mark.parametrize('new', [b'', b'short', None])
+def test_unrelated_content(base, new):
+    new = os.urandom(2 * 1024 * 1024) if new is None else new
+    assert rebuild(base, new)[0] == new
+
+
+def test_block_sizes_are_bounded():
+    assert block_size_for(0) == 4 * 1024
+    assert block_size_for(1024 ** 4) == 1024 * 1024
+    assert block_size_for(10 ** 9) % 1024 == 0
+
+
+def test_malformed_input_is_refused():
+    with pytest.raises(ProtocolError):
+        decode_op(b'X')
+    with pytest.raises(ProtocolError):
+        decode_op(COPY_OP.pack(OP_COPY, 1, 2) + b'!')
+    with pytest.raises(ProtocolError):
+        signature_table(b'\0' * 7)
@@ -0,0 +1,110 @@
+"""The index of the shared space and its change log"""
+import os
+
+import pytest
+
+import file_index
+from file_index import FileIndex
+
+
+def write(root, name, data=b'data', mtime=None):
+    path = root.joinpath(*name.split('/'))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def root(tmp_path):
+    write(tmp_path, 'a.txt')
+    write(tmp_path, 'sub/b.txt', b'bb')
+    write(tmp_path, 'sub/.c.txt.part', b'partial')
+    return tmp_path
+
+
+@pytest.fixture
+def index(root):
+    index = FileIndex()
+    index.set_root(str(root))
+    return index
+
+
+def names(index):
+    return [entry['name'] for entry in index.files]
+
+
+def test_walk_indexes_subdirectories_without_partials(index):
+    assert names(index) == ['a.txt', 'sub/b.txt']
+    assert index.find(index.files[1]['id']) == 'sub/b.txt'
+
+
+def test_changes_since_a_generation(index, root):
+    since = index.generation
+    write(root, 'a.txt', b'modified', mtime=1000000000)
+    write(root, 'new.txt')
+    os.remove(root / 'sub' / 'b.txt')
+    assert index.refresh(force=True)
+
+    changes = index.changes(since)
+    assert [entry['name'] for entry in changes['added']] == ['new.txt']
+    assert [(entry['name'], entry['size']) for entry in changes['modified']] == [('a.txt', 8)]
+    assert changes['removed'] == ['sub/b.txt']
+    assert changes['generation'] == index.generation
+    assert index.changes(index.generation) == {'added': [], 'modified': [], 'removed': [],
+                                               'generation': index.generation}
+
+
+def test_changes_net_out_files_that_came_and_went(index, root):
+    since = index.generation
+    write(root, 'tmp.txt')
+    index.update_file('tmp.txt')
+    os.remove(root / 'tmp.txt')
+    index.update_file('tmp.txt')
+    changes = index.changes(since)
+    assert changes['added'] == changes['removed'] == []
+
+
+def test_changes_beyond_the_log_are_unknown(index, root, monkeypatch):
+    monkeypatch.setattr(file_index, 'CHANGE_LOG_SIZE', 4)
+    since = index.generation
+    for i in range(10):
+        write(root, f'f{i}.txt')
+        index.update_file(f'f{i}.txt')
+    assert index.change_floor > since
+    assert index.changes(since) is None
+    assert index.changes(index.change_floor) is not None
+    assert index.changes(index.generation + 1) is None
+
+
+def test_sweep_keeps_changes_made_during_the_walk(index, root, monkeypatch):
+    walk = index.walk
+
+    def slow_walk(*args):
+        found = walk(*args)
+        # An upload lands after the walk read the tree, before the result is swapped in
+        write(root, 'a.txt', b'uploaded meanwhile')
+        index.update_file('a.txt')
+        write(root, 'late.txt')
+        index.update_file('late.txt')
+        os.remove(root / 'sub' / 'b.txt')
+        index.update_file('sub/b.txt')
+        return found
+
+    monkeypatch.setattr(index, 'walk', slow_walk)
+    index.sweep()
+    assert names(index) == ['a.txt', 'late.txt']
+    assert index.entries['a.txt']['size'] == len(b'uploaded meanwhile')
+
+
+def test_queries_page_sort_and_filter(index, root):
+    write(root, 'big.txt', b'x' * 100)
+    index.refresh(force=True)
+    page, total, generation = index.query(0, 2, sort='size', reverse=True)
+    assert ([entry['name'] for entry in page], total, generation) == (['big.txt', 'a.txt'], 3, index.generation)
+    page, total, _ = index.query(pattern='sub/')
+    assert ([entry['name'] for entry in page], total) == (['sub/b.txt'], 1)
+    page, total, _ = index.query(pattern='*.txt', offset=2)
+    assert ([entry['name'] for entry in page], total) == (['sub/b.txt'], 3)
+    with pytest.raises(ValueError):
+        index.query(sort='colour')
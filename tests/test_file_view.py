@@ -0,0 +1,92 @@
+"""The columnar model behind the virtual file list"""
+import random
+
+import pytest
+
+import file_view
+from file_view import FileColumns
+
+
+def entry(name, size, modified=1000000000):
+    return {'name': name, 'size': size, 'modified': modified}
+
+
+def shown(model):
+    return [model.name(position) for position in range(len(model))]
+
+
+@pytest.fixture
+def model():
+    model = FileColumns()
+    model.load([entry('b.txt', 30, 3), entry('a.txt', 10, 2), entry('dir/c.log', 20, 1)])
+    model.extend([entry('d.txt', 10, 4)])
+    return model
+
+
+def test_rows_are_arranged_without_reloading(model):
+    assert shown(model) == ['b.txt', 'a.txt', 'dir/c.log', 'd.txt']
+    model.arrange('size')
+    assert shown(model) == ['a.txt', 'd.txt', 'dir/c.log', 'b.txt']
+    model.arrange('modified', reverse=True)
+    assert shown(model) == ['d.txt', 'b.txt', 'a.txt', 'dir/c.log']
+    model.arrange('name', pattern='*.txt')
+    assert shown(model) == ['a.txt', 'b.txt', 'd.txt']
+    model.arrange(None, pattern='dir/')
+    assert shown(model) == ['dir/c.log']
+
+
+def test_rows_are_formatted_once_until_they_change(model):
+    calls = []
+
+    def format_row(name, size, mtime):
+        calls.append(name)
+        return name.upper(), size, mtime
+
+    model.arrange('name')
+    assert model.values(0, format_row) == ('A.TXT', 10, 2)
+    assert model.values(0, format_row) == ('A.TXT', 10, 2)
+    model.apply([], [entry('a.txt', 11, 5)])
+    assert model.values(0, format_row) == ('A.TXT', 11, 5)
+    assert calls == ['a.txt', 'a.txt']
+
+
+def test_changes_in_load_order_follow_the_listing(model):
+    listing = [entry('new.txt', 1), entry('b.txt', 30, 3), entry('dir/c.log', 99, 1), entry('d.txt', 10, 4)]
+    model.apply(['a.txt'], [listing[0], listing[2]], listing)
+    assert shown(model) == ['new.txt', 'b.txt', 'dir/c.log', 'd.txt']
+    assert model.sizes[model.index['dir/c.log']] == 99
+
+
+@pytest.mark.parametrize('sort, reverse, pattern', [('name', False, ''), ('size', True, '*.txt'),
+                                                    ('modified', False, 'f1')])
+@pytest.mark.parametrize('bulk', [False, True])
+def test_changes_are_placed_where_a_full_sort_puts_them(sort, reverse, pattern, bulk, monkeypatch):
+    if bulk:
+        monkeypatch.setattr(file_view, 'MAX_PLACED_CHANGES', 0)
+    rng = random.Random(42)
+    names = [f'f{i}.txt' if i % 3 else f'f{i}.log' for i in range(300)]
+    files = {name: entry(name, rng.randrange(50), rng.randrange(20)) for name in names}
+    model = FileColumns()
+    model.load(list(files.values()))
+    model.arrange(sort, reverse, pattern)
+    for _ in range(10):
+        removed = rng.sample(sorted(files), 20)
+        for name in removed:
+            del files[name]
+        updated = [entry(name, rng.randrange(50), rng.randrange(20)) for name in rng.sample(sorted(files), 10)]
+        updated += [entry(f'n{rng.randrange(10 ** 6)}.txt', rng.randrange(50), rng.randrange(20)) for _ in range(5)]
+        files.update((file_info['name'], file_info) for file_info in updated)
+        model.apply(removed, updated)
+
+        fresh = FileColumns()
+        fresh.load(list(files.values()))
+        fresh.arrange(sort, reverse, pattern)
+        assert shown(model) == shown(fresh)
+
+
+def test_compaction_drops_removed_rows_and_keeps_the_order(model):
+    model.arrange('size', reverse=True)
+    model.values(0, lambda *row: row)
+    model.apply(['a.txt', 'd.txt', 'dir/c.log'], [])
+    assert model.dead == 0 and model.names == ['b.txt']
+    assert shown(model) == ['b.txt'] and model.formatted == {0: ('b.txt', 30, 3)}
@@ -0,0 +1,86 @@
+"""The persistent cache of file digests"""
+import os
+import time
+
+import pytest
+
+from hash_cache import HashCache, cache_key, hash_file
+from protocol import new_checksum
+
+
+def digest_of(data):
+    checksum = new_checksum()
+    checksum.update(data)
+    return checksum.digest()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return HashCache(str(tmp_path / 'hashes.sqlite3'))
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / 'file.bin'
+    path.write_bytes(b'content')
+    os.utime(path, (1000000000, 1000000000))
+    return str(path)
+
+
+def test_digests_are_kept_across_instances(cache, path, tmp_path):
+    assert cache.compute(path) == digest_of(b'content')
+    reopened = HashCache(str(tmp_path / 'hashes.sqlite3'))
+    assert reopened.get(os.stat(path)) == digest_of(b'content')
+
+
+def test_a_changed_mtime_or_size_invalidates_the_digest(cache, path):
+    cache.compute(path)
+    os.utime(path, ns=(1000000000, 1000000000 * 10 ** 9 + 1))
+    assert cache.get(os.stat(path)) is None
+
+    cache.compute(path)
+    with open(path, 'ab') as f:
+        f.write(b'!')
+    os.utime(path, (1000000000, 1000000000))
+    assert cache.get(os.stat(path)) is None
+    assert cache.compute(path) == digest_of(b'content!')
+
+
+def test_a_replaced_file_is_not_found_by_its_old_digest(cache, path, tmp_path):
+    cache.compute(path)
+    assert cache.find(digest_of(b'content'), 7) == [path]
+    assert cache.find(digest_of(b'content'), 8) == []
+
+    replacement = tmp_path / 'new.bin'
+    replacement.write_bytes(b'CONTENT')
+    os.utime(replacement, (1000000000, 1000000000))
+    os.replace(replacement, path)
+    # Same path, size and mtime, but another inode
+    assert cache.get(os.stat(path)) is None
+    assert cache.find(digest_of(b'content'), 7) == []
+
+
+def test_store_keys_the_digest_to_the_stat_it_was_hashed_at(cache, path):
+    before = os.stat(path)
+    with open(path, 'ab') as f:
+        f.write(b'!')
+    cache.store(path, digest_of(b'content'), before)
+    assert cache.get(os.stat(path)) is None
+    cache.store(path, digest_of(b'content!'))
+    assert cache.get(os.stat(path)) == digest_of(b'content!')
+
+
+def test_lookup_hashes_in_the_background(cache, path):
+    assert cache.lookup(path) is None
+    deadline = time.monotonic() + 5
+    while cache.get(os.stat(path)) is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cache.lookup(path) == digest_of(b'content')
+    assert cache_key(os.stat(path)) not in cache.pending
+
+
+def test_a_file_changed_before_it_is_hashed_gets_no_digest(path):
+    stat = os.stat(path)
+    with open(path, 'ab') as f:
+        f.write(b'!')
+    assert hash_file(path, stat) is None
@@ -0,0 +1,75 @@
+"""Metrics of the server and their reports"""
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metrics import MetricsEndpoint, MetricsRegistry
+
+
+@pytest.fixture
+def registry():
+    registry = MetricsRegistry()
+    commands = registry.counter('commands_total', "Commands handled", labels=('command',))
+    commands.labels('LIST').inc()
+    commands.labels('GET_FILE').inc(2)
+    registry.counter('bytes_sent_total', "Bytes sent").labels().inc(1024)
+    latency = registry.histogram('command_seconds', "Command latency", (1, 2, 4), labels=('command',))
+    for value in (0.5, 1.5, 1.5, 3):
+        latency.labels('LIST').observe(value)
+    registry.gauge('connections', "Open connections", lambda: 7)
+    return registry
+
+
+def test_snapshot_reports_every_metric(registry):
+    snapshot = registry.snapshot()
+    assert snapshot['commands_total'] == {'LIST': 1, 'GET_FILE': 2}
+    assert snapshot['bytes_sent_total'] == 1024
+    assert snapshot['connections'] == 7
+    latency = snapshot['command_seconds']['LIST']
+    assert (latency['count'], latency['sum']) == (4, 6.5)
+    assert latency['p50'] == pytest.approx(1.5)
+    assert latency['p99'] == pytest.approx(3.92)
+
+
+def test_quantiles_beyond_the_last_bucket_are_its_bound():
+    histogram = MetricsRegistry().histogram('seconds', "Latency", (1, 2)).labels()
+    assert histogram.quantile(0.5) is None
+    histogram.observe(100)
+    assert histogram.quantile(0.5) == 2
+
+
+def test_prometheus_text_has_cumulative_buckets_and_escaped_labels(registry):
+    registry.counter('errors_total', "Errors", labels=('reason',)).labels('say "hi"\n').inc()
+    text = registry.prometheus()
+    assert text.endswith('\n')
+    lines = text.splitlines()
+    assert lines[:4] == ['# HELP filetransfer_commands_total Commands handled',
+                         '# TYPE filetransfer_commands_total counter',
+                         'filetransfer_commands_total{command="GET_FILE"} 2',
+                         'filetransfer_commands_total{command="LIST"} 1']
+    assert 'filetransfer_bytes_sent_total 1024' in lines
+    assert 'filetransfer_connections 7' in lines
+    assert [line for line in lines if line.startswith('filetransfer_command_seconds')] == [
+        'filetransfer_command_seconds_bucket{command="LIST",le="1"} 1',
+        'filetransfer_command_seconds_bucket{command="LIST",le="2"} 3',
+        'filetransfer_command_seconds_bucket{command="LIST",le="4"} 4',
+        'filetransfer_command_seconds_bucket{command="LIST",le="+Inf"} 4',
+        'filetransfer_command_seconds_sum{command="LIST"} 6.5',
+        'filetransfer_command_seconds_count{command="LIST"} 4']
+    assert 'filetransfer_errors_total{reason="say \\"hi\\"\\n"} 1' in lines
+
+
+def test_endpoint_serves_the_registry(registry):
+    endpoint = MetricsEndpoint(registry, port=0)
+    endpoint.start()
+    try:
+        url = f"http://{endpoint.address[0]}:{endpoint.address[1]}"
+        with urllib.request.urlopen(url + '/metrics', timeout=5) as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert response.read().decode() == registry.prometheus()
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + '/other', timeout=5)
+        assert error.value.code == 404
+    finally:
+        endpoint.stop()
@@ -0,0 +1,96 @@
+"""The throttled hand-off of client events to the GUI"""
+import threading
+
+import pytest
+
+import progress
+from progress import MAX_DRAIN_EVENTS, PROGRESS_RATE, ProgressBus
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def tick(self):
+        """Move on to the next drain"""
+        self.now += 1 / PROGRESS_RATE
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(progress.time, 'monotonic', clock)
+    return clock
+
+
+def drained(bus):
+    delivered = []
+    bus.drain(lambda callback_type, data, log_type: delivered.append((callback_type, data, log_type)))
+    return delivered
+
+
+def download_progress(size):
+    return {'received_size': size, 'total_size': 1000, 'speed': 1}
+
+
+def test_progress_between_drains_is_merged_into_the_latest(clock):
+    bus = ProgressBus()
+    posters = [threading.Thread(target=lambda: [bus.post('download_progress', download_progress(i))
+                                                 for i in range(1000)]) for _ in range(4)]
+    for poster in posters:
+        poster.start()
+    for poster in posters:
+        poster.join()
+    bus.post('download_progress', download_progress(999))
+    assert [(callback_type, data['received_size']) for callback_type, data, _ in drained(bus)] == \
+        [('download_progress', 999)]
+    assert drained(bus) == []
+
+
+def test_other_events_keep_their_place(clock):
+    bus = ProgressBus()
+    bus.post('download_start', {'name': 'a'})
+    bus.post('download_progress', download_progress(10))
+    bus.post('log', "still going", 'info')
+    bus.post('download_progress', download_progress(20))
+    bus.post('download_complete', {'name': 'a'})
+    bus.post('download_progress', download_progress(30))
+    assert [(callback_type, data.get('received_size') if isinstance(data, dict) else data)
+            for callback_type, data, _ in drained(bus)] == [
+        ('download_start', None), ('download_progress', 20), ('log', "still going"),
+        ('download_complete', None), ('download_progress', 30)]
+
+
+def test_transfers_are_merged_and_timed_apart(clock):
+    transfer = threading.local()
+    bus = ProgressBus(source=lambda: getattr(transfer, 'id', None))
+
+    def post(transfer_id, size):
+        transfer.id = transfer_id
+        bus.post('download_progress', download_progress(size))
+
+    for size in (0, 100):
+        for transfer_id in (1, 2):
+            post(transfer_id, size)
+        assert [data['received_size'] for _, data, _ in drained(bus)] == [size, size]
+        clock.tick()
+    post(1, 150)
+    post(2, 200)
+    first, second = [data for _, data, _ in drained(bus)]
+    # Each rate is smoothed on its own, and both add up to the total
+    assert first['speed'] == pytest.approx(0.3 * 1000 + 0.7 * 2000)
+    assert second['speed'] == pytest.approx(2000)
+    assert second['total_speed'] == pytest.approx(first['speed'] + second['speed'])
+    assert second['active_transfers'] == 2
+    assert first['eta'] == pytest.approx(850 / first['speed'])
+
+
+def test_a_drain_delivers_a_bounded_number_of_events(clock):
+    bus = ProgressBus()
+    for i in range(MAX_DRAIN_EVENTS + 5):
+        bus.post('log', str(i), 'info')
+    assert len(drained(bus)) == MAX_DRAIN_EVENTS
+    assert [data for _, data, _ in drained(bus)] == [str(i) for i in range(MAX_DRAIN_EVENTS, MAX_DRAIN_EVENTS + 5)]
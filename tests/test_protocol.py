@@ -0,0 +1,121 @@
+"""Framing of the wire protocol"""
+import socket
+
+import pytest
+
+from protocol import (CHECKSUM_ALGORITHM, FRAME_COMMAND, FRAME_DATA, FRAME_RESPONSE, FRAME_TEXT, FRAME_TRAILER,
+                      HEADER, MAX_CONTROL_SIZE, PROTOCOL_VERSION, ChecksumError, Connection, ProtocolError,
+                      decode_header, encode_header, new_checksum, verify_trailer)
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield Connection(a), Connection(b)
+    a.close()
+    b.close()
+
+
+def test_header_round_trip():
+    assert decode_header(encode_header(FRAME_DATA, 12345, 1)) == (FRAME_DATA, 1, 12345)
+
+
+def test_header_of_another_version_is_refused():
+    with pytest.raises(ProtocolError):
+        decode_header(HEADER.pack(PROTOCOL_VERSION + 1, FRAME_COMMAND, 0, 0))
+
+
+def test_control_frames_are_limited_but_data_frames_are_not():
+    with pytest.raises(ProtocolError):
+        decode_header(encode_header(FRAME_RESPONSE, MAX_CONTROL_SIZE + 1))
+    assert decode_header(encode_header(FRAME_DATA, MAX_CONTROL_SIZE + 1))[2] == MAX_CONTROL_SIZE + 1
+
+
+def test_frames_are_decoded_by_type(pair):
+    sender, receiver = pair
+    sender.send_command("LIST_FILES", offset=5)
+    sender.send_message({'type': 'file_list'})
+    sender.send_message("hello")
+
+    frame = receiver.read_frame()
+    assert (frame.type, frame.payload) == (FRAME_COMMAND, {'cmd': 'LIST_FILES', 'offset': 5})
+    frame = receiver.read_frame()
+    assert (frame.type, frame.payload) == (FRAME_RESPONSE, {'type': 'file_list'})
+    frame = receiver.read_frame()
+    assert (frame.type, frame.payload) == (FRAME_TEXT, "hello")
+
+
+def test_data_follows_its_header(pair, tmp_path):
+    sender, receiver = pair
+    path = tmp_path / 'data'
+    path.write_bytes(b'0123456789')
+    with open(path, 'rb') as f:
+        assert sender.send_file_data(f, 2, 5) == 5
+    sender.send_frame(FRAME_DATA, b'xyz')
+
+    frame = receiver.read_frame()
+    assert (frame.type, frame.length, frame.payload) == (FRAME_DATA, 5, None)
+    assert receiver.read_exact(frame.length) == b'23456'
+    frame = receiver.read_frame()
+    assert receiver.discard(frame.length) == 3
+
+
+def test_data_falls_back_to_buffered_sends_when_sendfile_fails(pair, tmp_path, monkeypatch):
+    def unsupported(*args):
+        raise OSError("sendfile not supported")
+
+    monkeypatch.setattr(socket.socket, 'sendfile', unsupported)
+    sender, receiver = pair
+    path = tmp_path / 'data'
+    path.write_bytes(b'0123456789')
+    with open(path, 'rb') as f:
+        assert sender.send_file_data(f, 2, 5) == 5
+    frame = receiver.read_frame()
+    assert receiver.read_exact(frame.length) == b'23456'
+
+
+def test_pipelined_frames_split_across_reads(pair):
+    sender, receiver = pair
+    for i in range(100):
+        sender.send_command("GET_FILE", file_id=str(i))
+    assert [receiver.read_frame().payload['file_id'] for _ in range(100)] == [str(i) for i in range(100)]
+
+
+def test_closed_connection_reads_none(pair):
+    sender, receiver = pair
+    sender.sock.shutdown(socket.SHUT_WR)
+    assert receiver.read_frame() is None
+
+
+def test_closed_mid_frame_is_an_error(pair):
+    sender, receiver = pair
+    sender.sock.sendall(encode_header(FRAME_RESPONSE, 10) + b'{}')
+    sender.sock.shutdown(socket.SHUT_WR)
+    with pytest.raises(ProtocolError):
+        receiver.read_frame()
+
+
+def test_malformed_payload_is_an_error(pair):
+    sender, receiver = pair
+    sender.send_frame(FRAME_RESPONSE, b'[1, 2]')
+    with pytest.raises(ProtocolError):
+        receiver.read_frame()
+
+
+def test_trailer_verifies_the_content(pair):
+    sender, receiver = pair
+    sent = new_checksum()
+    sent.update(b'content')
+    sender.send_trailer(sent)
+    sender.send_trailer(sent)
+
+    received = new_checksum()
+    received.update(b'content')
+    trailer = receiver.read_frame()
+    assert trailer.type == FRAME_TRAILER and CHECKSUM_ALGORITHM in trailer.payload
+    verify_trailer(trailer, received)
+    received.update(b'!')
+    with pytest.raises(ChecksumError):
+        verify_trailer(receiver.read_frame(), received)
+    with pytest.raises(ProtocolError):
+        verify_trailer(None, received)
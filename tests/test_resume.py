@@ -0,0 +1,67 @@
+"""Partial transfers kept on disk"""
+import os
+
+import pytest
+
+from resume import PartialFile, is_partial_file
+
+
+@pytest.fixture
+def partial(tmp_path):
+    return PartialFile(str(tmp_path), 'sub/file.bin', 100, source=1234.5)
+
+
+def write_partial(partial, data, received):
+    with partial.open(0) as f:
+        f.write(data)
+        partial.checkpoint(f, received)
+
+
+def test_sidecars_sit_next_to_the_destination(partial, tmp_path):
+    assert partial.path == os.path.join(str(tmp_path), 'sub', '.file.bin.part')
+    assert is_partial_file(os.path.basename(partial.path))
+    assert is_partial_file(os.path.basename(partial.manifest_path))
+    assert not is_partial_file('file.bin')
+
+
+def test_resumes_from_the_checkpoint(partial):
+    assert partial.resume_offset() == 0
+    write_partial(partial, b'x' * 60, 40)
+    assert partial.resume_offset() == 40
+    with partial.open(40) as f:
+        assert os.fstat(f.fileno()).st_size == 40
+
+
+def test_offset_never_exceeds_what_is_on_disk(partial):
+    write_partial(partial, b'x' * 10, 40)
+    assert partial.resume_offset() == 10
+
+
+@pytest.mark.parametrize('size, source', [(101, 1234.5), (100, 999.0)])
+def test_another_version_is_not_resumed(partial, tmp_path, size, source):
+    write_partial(partial, b'x' * 60, 40)
+    assert PartialFile(str(tmp_path), 'sub/file.bin', size, source).resume_offset() == 0
+
+
+def test_linked_partial_is_not_resumed(partial, tmp_path):
+    write_partial(partial, b'x' * 60, 40)
+    os.link(partial.path, str(tmp_path / 'other'))
+    assert partial.resume_offset() == 0
+    # Starting over replaces the partial file instead of truncating the shared inode
+    with partial.open(0) as f:
+        f.write(b'new')
+    assert (tmp_path / 'other').read_bytes() == b'x' * 60
+
+
+def test_commit_keeps_the_modification_time(partial, tmp_path):
+    write_partial(partial, b'x' * 100, 100)
+    final = str(tmp_path / 'sub' / 'file.bin')
+    partial.commit(final, 1000000000.0)
+    assert os.path.getmtime(final) == 1000000000.0
+    assert not os.path.exists(partial.path) and not os.path.exists(partial.manifest_path)
+
+
+def test_discard_removes_both_sidecars(partial):
+    write_partial(partial, b'x' * 60, 40)
+    partial.discard()
+    assert not os.path.exists(partial.path) and not os.path.exists(partial.manifest_path)
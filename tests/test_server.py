@@ -0,0 +1,285 @@
+"""Transfers between a client and a server, on both server engines"""
+import asyncio
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+import pytest
+
+from benchmark import free_port
+from cli import load_listing
+from client import COMPRESSION_CODECS
+from dedup import DEDUP_MIN_SIZE
+from protocol import (CHECKSUM_ALGORITHM, FRAME_DATA, FRAME_RESPONSE, FRAME_TEXT, HEADER, Connection,
+                      new_checksum)
+from resume import PartialFile
+import server as server_module
+
+MB = 1024 * 1024
+
+
+def listed(client, events):
+    """The server's files by name, as the client lists them"""
+    load_listing(client, events, 10)
+    return client.files_by_name
+
+
+def eventually(predicate, timeout=5):
+    """Wait for predicate() to hold, for state the server updates after replying"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def new_checksum_of(data):
+    checksum = new_checksum()
+    checksum.update(data)
+    return checksum.digest()
+
+
+def printed(capsys, text):
+    """Wait for the server to print text, which it may do after replying"""
+    out = ''
+
+    def seen():
+        nonlocal out
+        out += capsys.readouterr().out
+        return text in out
+    return eventually(seen)
+
+
+def compressible(size):
+    rng = random.Random(size)
+    words = [b'alpha', b'beta', b'gamma', b'delta', b'epsilon']
+    data = b' '.join(rng.choice(words) for _ in range(size // 5))
+    return data[:size]
+
+
+def test_upload_and_download(client, events, server, shared, tmp_path):
+    data = compressible(3 * MB)
+    local = tmp_path / 'report.txt'
+    local.write_bytes(data)
+    os.utime(local, (1000000000, 1000000000))
+    assert client.upload_file(str(local))
+    assert (shared / 'report.txt').read_bytes() == data
+    assert os.path.getmtime(shared / 'report.txt') == 1000000000
+
+    client.compression = list(COMPRESSION_CODECS)
+    assert client.download_file(listed(client, events)['report.txt']['id'])
+    downloaded = tmp_path / 'downloads' / 'report.txt'
+    assert downloaded.read_bytes() == data
+    assert os.path.getmtime(downloaded) == 1000000000
+    assert eventually(lambda: 0 < server.bytes_sent.value < len(data) // 2)
+    assert not events.errors()
+
+
+def test_downloads_are_verified_against_cached_digests(client, events, server, shared, tmp_path):
+    data = os.urandom(3 * MB)
+    (shared / 'data.bin').write_bytes(data)
+    files = listed(client, events)
+    assert client.verify_checksums
+    assert client.download_file(files['data.bin']['id'])
+    # The digest computed on the way is cached, and trails the next download sent with sendfile
+    assert eventually(lambda: server.hashes.cached(os.stat(shared / 'data.bin')) == new_checksum_of(data))
+    os.remove(tmp_path / 'downloads' / 'data.bin')
+    assert client.download_file(files['data.bin']['id'])
+    assert (tmp_path / 'downloads' / 'data.bin').read_bytes() == data
+
+    os.remove(tmp_path / 'downloads' / 'data.bin')
+    server.hashes.store(str(shared / 'data.bin'), bytes(32))
+    assert not client.download_file(files['data.bin']['id'])
+    assert any('Checksum mismatch' in message for message in events.errors())
+    assert not (tmp_path / 'downloads' / 'data.bin').exists()
+
+
+def test_interrupted_upload_is_resumed(client, events, server, shared, tmp_path):
+    data = os.urandom(MB // 2)
+    local = tmp_path / 'upload.bin'
+    local.write_bytes(data)
+    partial = PartialFile(str(shared), 'upload.bin', len(data), os.path.getmtime(local))
+    with partial.open(0) as f:
+        f.write(data[:MB // 4])
+        partial.checkpoint(f, MB // 4)
+
+    assert client.upload_file(str(local))
+    assert (shared / 'upload.bin').read_bytes() == data
+    assert eventually(lambda: server.bytes_received.value == len(data) - MB // 4)
+    assert any(message.startswith("Resuming upload") for message in events.logs('info'))
+
+
+def test_delta_upload_sends_only_the_changes(client, server, shared, tmp_path):
+    base = os.urandom(4 * MB)
+    (shared / 'disk.img').write_bytes(base)
+    server.refresh_file_list()
+    changed = bytearray(base)
+    changed[2 * MB:2 * MB + 100] = b'x' * 100
+    local = tmp_path / 'disk.img'
+    local.write_bytes(changed)
+
+    assert client.upload_file(str(local))
+    assert (shared / 'disk.img').read_bytes() == changed
+    assert eventually(lambda: 0 < server.bytes_received.value < MB // 4)
+
+
+def test_dedup_onto_the_same_file_leaves_other_copies_alone(client, shared, tmp_path):
+    # copy.bin is deduplicated from big.bin, then big.bin is uploaded again as
+    # it is; linking it onto itself used to leave .big.bin.part behind as one
+    # more name of both files, which the next upload of big.bin wrote through
+    data = os.urandom(2 * MB)
+    client.delta_uploads = False
+    for name in ('big.bin', 'copy.bin', 'big.bin'):
+        (tmp_path / name).write_bytes(data)
+        assert client.upload_file(str(tmp_path / name))
+    assert sorted(os.listdir(shared)) == ['big.bin', 'copy.bin']
+
+    (tmp_path / 'big.bin').write_bytes(b'new content')
+    assert client.upload_file(str(tmp_path / 'big.bin'))
+    assert (shared / 'big.bin').read_bytes() == b'new content'
+    assert (shared / 'copy.bin').read_bytes() == data
+
+
+def test_listings_come_in_pages_that_fit_a_control_frame(client, events, server, shared, monkeypatch):
+    monkeypatch.setattr(server_module, 'MAX_CONTROL_SIZE', 20000)
+    names = sorted(f"{'long name ' * 5}{i:04d}.txt" for i in range(1000))
+    for name in names:
+        (shared / name).write_bytes(b'')
+    server.refresh_file_list()
+
+    page = server.list_files()
+    assert (len(page['files']), page['offset'], page['total']) == (1000, 0, 1000)
+    trimmed = json.loads(server.fit_reply(page)[HEADER.size:])
+    assert 0 < len(trimmed['files']) < 1000 and trimmed['total'] == 1000
+    assert sorted(listed(client, events)) == names
+
+
+def test_dedup_keeps_the_uploaded_modification_time(client, shared, tmp_path):
+    data = os.urandom(2 * MB)
+    client.delta_uploads = False
+    for name, mtime in (('big.bin', 1000000000), ('same.bin', 1000000000), ('later.bin', 1500000000)):
+        (tmp_path / name).write_bytes(data)
+        os.utime(tmp_path / name, (mtime, mtime))
+        assert client.upload_file(str(tmp_path / name))
+        assert os.path.getmtime(shared / name) == mtime
+    # A hard link would have changed the time of big.bin as well
+    assert os.path.getmtime(shared / 'big.bin') == 1000000000
+    assert (shared / 'later.bin').read_bytes() == data
+
+
+def test_identical_upload_is_created_without_its_content(client, server, shared, tmp_path, capsys):
+    data = os.urandom(2 * MB)
+    client.delta_uploads = False
+    for name in ('big.bin', 'copy.bin'):
+        (tmp_path / name).write_bytes(data)
+        os.utime(tmp_path / name, (1000000000, 1000000000))
+        assert client.upload_file(str(tmp_path / name))
+    assert printed(capsys, "File uploaded from an identical copy: copy.bin")
+    assert (shared / 'copy.bin').read_bytes() == data
+    assert eventually(lambda: server.bytes_received.value == len(data))
+
+
+def test_small_files_are_always_received(client, server, tmp_path):
+    data = os.urandom(DEDUP_MIN_SIZE - 1)
+    client.delta_uploads = False
+    for name in ('small.bin', 'copy.bin'):
+        (tmp_path / name).write_bytes(data)
+        assert client.upload_file(str(tmp_path / name))
+    assert eventually(lambda: server.bytes_received.value == 2 * len(data))
+
+
+def test_unhashed_files_are_hashed_for_later_uploads(client, server, shared, tmp_path, capsys):
+    # An upload never waits for candidates to be hashed, but queues them
+    data = os.urandom(2 * MB)
+    for path in (shared / 'old.bin', tmp_path / 'new.bin'):
+        path.write_bytes(data)
+        os.utime(path, (1000000000, 1000000000))
+    server.refresh_file_list()
+    client.delta_uploads = False
+    assert client.upload_file(str(tmp_path / 'new.bin'))
+    assert eventually(lambda: server.bytes_received.value == len(data))
+
+    os.remove(shared / 'new.bin')
+    assert eventually(lambda: server.hashes.get(os.stat(shared / 'old.bin')) is not None)
+    assert client.upload_file(str(tmp_path / 'new.bin'))
+    assert printed(capsys, "File uploaded from an identical copy: new.bin")
+    assert (shared / 'new.bin').read_bytes() == data
+
+
+def test_batch_download(client, events, shared, tmp_path):
+    contents = {f'dir/file{i}.txt': os.urandom(i * 100) for i in range(20)}
+    for name, data in contents.items():
+        path = shared.joinpath(*name.split('/'))
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(data)
+    (shared / 'other.txt').write_bytes(b'not requested')
+    files = listed(client, events)
+
+    wanted = ['dir/file1.txt', 'dir/file7.txt', 'other.txt']
+    assert client.download_batch(file_ids=[files[name]['id'] for name in wanted]) == 3
+    assert client.download_folder('dir') == 20
+    downloads = tmp_path / 'downloads'
+    assert (downloads / 'other.txt').read_bytes() == b'not requested'
+    for name, data in contents.items():
+        assert downloads.joinpath(*name.split('/')).read_bytes() == data
+    assert not events.errors()
+
+
+def test_refused_upload_does_not_desync_the_connection(server):
+    # The content and trailer of a refused upload must be skipped, not read as commands
+    sock = socket.create_connection(('127.0.0.1', server.port))
+    sock.settimeout(10)
+    conn = Connection(sock)
+    try:
+        checksum = new_checksum()
+        checksum.update(b'abc')
+        conn.send_command("UPLOAD", name='../evil', size=3, checksum=CHECKSUM_ALGORITHM)
+        conn.send_frame(FRAME_DATA, b'abc')
+        conn.send_trailer(checksum)
+        conn.send_command("STATS")
+
+        refusal = conn.read_frame()
+        assert refusal.type == FRAME_TEXT and refusal.payload.startswith("ERROR")
+        reply = conn.read_frame()
+        assert reply.type == FRAME_RESPONSE and reply.payload['type'] == 'stats'
+        sock.settimeout(0.5)
+        with pytest.raises(socket.timeout):
+            conn.read_frame()
+    finally:
+        conn.close()
+
+
+def test_malformed_upload_is_answered_and_released(server):
+    sock = socket.create_connection(('127.0.0.1', server.port))
+    sock.settimeout(10)
+    conn = Connection(sock)
+    try:
+        conn.send_command("DELTA", name='file.bin', size='many', version='1')
+        reply = conn.read_frame()
+        assert reply.type == FRAME_TEXT and reply.payload.startswith("ERROR: Upload of file.bin failed")
+        conn.send_command("STATS")
+        assert conn.read_frame().payload['uploads_active'] == 0
+    finally:
+        conn.close()
+
+
+def test_io_queue_counts_operations_waiting_for_a_worker(shared):
+    server = server_module.AsyncServer(host='127.0.0.1', port=free_port(), io_workers=1)
+    server.set_shared_space(str(shared))
+    assert server.start_server()
+    release = threading.Event()
+    try:
+        running = [asyncio.run_coroutine_threadsafe(server.run_io(release.wait, 10), server.loop) for _ in range(4)]
+        assert eventually(lambda: server.stats()['io_queue'] == 3)
+        running[3].cancel()
+        assert eventually(lambda: server.stats()['io_queue'] == 2)
+        release.set()
+        assert all(future.result(10) for future in running[:3])
+        assert server.stats()['io_queue'] == 0
+    finally:
+        release.set()
+        server.stop_server()
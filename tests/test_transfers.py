@@ -0,0 +1,95 @@
+"""The queue running transfers a few at a time"""
+import threading
+
+import pytest
+
+from transfers import (CANCELLED, DONE, FAILED, PRIORITY_HIGH, PRIORITY_LOW, QUEUED, RUNNING, TransferQueue,
+                       current_transfer_id)
+
+
+class Recorder:
+    """Transfers that record the order they ran in; the first holds the queue until released"""
+
+    def __init__(self):
+        self.ran = []
+        self.release = threading.Event()
+
+    def blocking(self):
+        self.release.wait(5)
+        return True
+
+    def run(self, name):
+        def run():
+            self.ran.append((name, current_transfer_id()))
+            return True
+        return run
+
+
+@pytest.fixture
+def recorder():
+    recorder = Recorder()
+    yield recorder
+    recorder.release.set()
+
+
+def submit_behind_a_running_transfer(queue, recorder, transfers):
+    blocker = queue.submit('download', 'blocker', recorder.blocking)
+    assert blocker.state == RUNNING
+    return {name: queue.submit('download', name, recorder.run(name), **options) for name, options in transfers}
+
+
+def test_waiting_transfers_start_by_priority_then_submission(recorder):
+    queue = TransferQueue(max_parallel=1)
+    submitted = submit_behind_a_running_transfer(queue, recorder, [
+        ('low', {'priority': PRIORITY_LOW}), ('first', {}), ('high', {'priority': PRIORITY_HIGH}), ('second', {})])
+    assert [transfer.name for transfer in queue.pending()] == ['high', 'first', 'second', 'low']
+    assert all(transfer.state == QUEUED for transfer in submitted.values())
+
+    recorder.release.set()
+    assert queue.wait(5)
+    assert recorder.ran == [(name, submitted[name].id) for name in ('high', 'first', 'second', 'low')]
+    assert all(transfer.state == DONE for transfer in submitted.values())
+
+
+def test_small_first_and_move_to_front(recorder):
+    queue = TransferQueue(max_parallel=1, small_first=True)
+    submit_behind_a_running_transfer(queue, recorder, [
+        ('big', {'size': 300}), ('folder', {}), ('small', {'size': 10}), ('medium', {'size': 100})])
+    assert [transfer.name for transfer in queue.pending()] == ['small', 'medium', 'big', 'folder']
+
+    folder = next(transfer for transfer in queue.pending() if transfer.name == 'folder')
+    assert queue.move_to_front(folder.id)
+    assert queue.set_priority(queue.pending()[-1].id, PRIORITY_HIGH)
+    assert [transfer.name for transfer in queue.pending()] == ['folder', 'big', 'small', 'medium']
+
+
+def test_cancelled_transfers_never_run(recorder):
+    changes = []
+    queue = TransferQueue(max_parallel=1, on_change=lambda transfer: changes.append((transfer.name, transfer.state)))
+    submitted = submit_behind_a_running_transfer(queue, recorder, [('a', {}), ('b', {}), ('c', {})])
+    running = queue.running[0]
+    assert not queue.cancel(running.id)
+    assert queue.cancel(submitted['b'].id)
+    assert submitted['b'].state == CANCELLED and submitted['b'].finished.is_set()
+    assert not queue.cancel(submitted['b'].id)
+    assert queue.counts() == (1, 2)
+
+    queue.cancel_all()
+    assert queue.counts() == (1, 0)
+    recorder.release.set()
+    assert queue.wait(5)
+    assert recorder.ran == []
+    assert ('c', CANCELLED) in changes and running.state == DONE
+
+
+def test_failed_transfers_keep_their_error():
+    queue = TransferQueue(max_parallel=2)
+
+    def broken():
+        raise OSError("disk full")
+
+    refused = queue.submit('upload', 'refused', lambda: False)
+    crashed = queue.submit('upload', 'crashed', broken)
+    assert queue.wait(5)
+    assert refused.state == FAILED and refused.error is None
+    assert crashed.state == FAILED and str(crashed.error) == "disk full"
@@ -0,0 +1,188 @@
+"""Queue of file transfers run a few at a time.
+
+Every transfer runs on a thread of its own and opens its own data
+connection, so transfers running side by side never share a socket. Up to
+max_parallel run at once and the rest wait in the queue, to be started in
+order of priority, then (with small_first) of size, then of submission.
+Waiting transfers can be moved to the front, given another priority or
+cancelled.
+"""
+import itertools
+import threading
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+DEFAULT_PARALLEL_TRANSFERS = 3
+
+# The transfer each worker thread is running
+running_here = threading.local()
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class Transfer:
+    """One queued upload or download"""
+
+    def __init__(self, transfer_id, kind, name, run, size, priority):
+        self.id = transfer_id
+        self.kind = kind
+        self.name = name
+        # Called on a worker thread; returns False (or raises) if the transfer failed
+        self.run = run
+        # Bytes to transfer, None if not known up front (folders, batches)
+        self.size = size
+        self.priority = priority
+        # Position among transfers of the same priority; moved to the front
+        # transfers go before all others of their priority, whatever their size
+        self.sequence = transfer_id
+        self.pinned = False
+        self.state = QUEUED
+        self.error = None
+        self.finished = threading.Event()
+
+    def describe(self):
+        return {'id': self.id, 'kind': self.kind, 'name': self.name, 'size': self.size,
+                'priority': self.priority, 'state': self.state}
+
+
+def current_transfer_id():
+    """Id of the transfer the calling thread runs, None outside transfer threads"""
+    transfer = getattr(running_here, 'transfer', None)
+    return transfer and transfer.id
+
+
+class TransferQueue:
+    def __init__(self, max_parallel=DEFAULT_PARALLEL_TRANSFERS, small_first=False, on_change=None):
+        self.max_parallel = max_parallel
+        self.small_first = small_first
+        # Called with a transfer whenever its state changes
+        self.on_change = on_change
+        self.lock = threading.Condition()
+        self.queued = []
+        self.running = []
+        self.ids = itertools.count(1)
+
+    def submit(self, kind, name, run, size=None, priority=PRIORITY_NORMAL):
+        """Queue a transfer, return it"""
+        with self.lock:
+            transfer = Transfer(next(self.ids), kind, name, run, size, priority)
+            self.queued.append(transfer)
+        self.changed(transfer)
+        self.start_next()
+        return transfer
+
+    def order(self, transfer):
+        """Sort key of a waiting transfer, the smallest starts first"""
+        if transfer.pinned or not self.small_first:
+            size = 0
+        else:
+            size = transfer.size if transfer.size is not None else float('inf')
+        return transfer.priority, not transfer.pinned, size, transfer.sequence
+
+    def pending(self):
+        """Waiting transfers in the order they will start"""
+        with self.lock:
+            return sorted(self.queued, key=self.order)
+
+    def find_queued(self, transfer_id):
+        for transfer in self.queued:
+            if transfer.id == transfer_id:
+                return transfer
+        return None
+
+    def set_priority(self, transfer_id, priority):
+        """Change the priority of a waiting transfer, False if it is no longer waiting"""
+        with self.lock:
+            transfer = self.find_queued(transfer_id)
+            if transfer is None:
+                return False
+            transfer.priority = priority
+        self.changed(transfer)
+        return True
+
+    def move_to_front(self, transfer_id):
+        """Make a waiting transfer the next to start, False if it is no longer waiting"""
+        with self.lock:
+            transfer = self.find_queued(transfer_id)
+            if transfer is None:
+                return False
+            transfer.priority = PRIORITY_HIGH
+            transfer.sequence = min(t.sequence for t in self.queued) - 1
+            transfer.pinned = True
+        self.changed(transfer)
+        return True
+
+    def cancel(self, transfer_id):
+        """Remove a waiting transfer from the queue, False if it already started"""
+        with self.lock:
+            transfer = self.find_queued(transfer_id)
+            if transfer is None:
+                return False
+            self.queued.remove(transfer)
+            transfer.state = CANCELLED
+            transfer.finished.set()
+            self.lock.notify_all()
+        self.changed(transfer)
+        return True
+
+    def cancel_all(self):
+        """Remove every waiting transfer from the queue"""
+        for transfer in self.pending():
+            self.cancel(transfer.id)
+
+    def set_parallelism(self, max_parallel):
+        with self.lock:
+            self.max_parallel = max(1, int(max_parallel))
+        self.start_next()
+
+    def set_small_first(self, small_first):
+        with self.lock:
+            self.small_first = small_first
+
+    def start_next(self):
+        """Start waiting transfers while fewer than max_parallel are running"""
+        started = []
+        with self.lock:
+            while self.queued and len(self.running) < self.max_parallel:
+                transfer = min(self.queued, key=self.order)
+                self.queued.remove(transfer)
+                self.running.append(transfer)
+                transfer.state = RUNNING
+                started.append(transfer)
+        for transfer in started:
+            self.changed(transfer)
+            threading.Thread(target=self.execute, args=(transfer,), daemon=True).start()
+
+    def execute(self, transfer):
+        running_here.transfer = transfer
+        try:
+            transfer.state = FAILED if transfer.run() is False else DONE
+        except Exception as e:
+            transfer.state = FAILED
+            transfer.error = e
+        finally:
+            with self.lock:
+                self.running.remove(transfer)
+                transfer.finished.set()
+                self.lock.notify_all()
+            self.changed(transfer)
+            self.start_next()
+
+    def changed(self, transfer):
+        if self.on_change:
+            self.on_change(transfer)
+
+    def counts(self):
+        """(running, queued) numbers of transfers"""
+        with self.lock:
+            return len(self.running), len(self.queued)
+
+    def wait(self, timeout=None):
+        """Block until no transfer is running or waiting, False on timeout"""
+        with self.lock:
+            return self.lock.wait_for(lambda: not self.queued and not self.running, timeout)